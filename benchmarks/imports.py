@@ -0,0 +1,83 @@
+"""Measure how long importing static takes, in fresh interpreters.
+
+    $ python benchmarks/imports.py [--runs N] [--max-ms MS]
+
+Each statement is run in --runs new interpreters with -X importtime and
+the best and median cumulative time of its top-level import are
+printed, along with any third-party modules it pulled in. Importing
+Cling should need nothing but the standard library: pystache is only
+loaded once a MoustacheMagic is used, brotli and zstandard once
+something is compressed with them.
+
+With --max-ms, exit with status 1 if any statement's best time is over
+budget or loads any of HEAVY, so CI can guard it.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+STATEMENTS = [
+    ('static', 'import static'),
+    ('static.apps', 'from static.apps import Cling'),
+    ('static.cli', 'import static.cli'),
+]
+
+# Modules that have no business being imported with Cling.
+HEAVY = ('brotli', 'pkg_resources', 'pystache', 'setuptools', 'zstandard')
+
+REPORT = ('import sys; sys.stderr.write("modules: " + " ".join(sorted(set('
+          'm.split(".")[0] for m in sys.modules)'
+          ' & set(' + repr(HEAVY) + '))) + "\\n")')
+
+
+def measure(module, statement):
+    """Return the microseconds module took to import, and heavy modules."""
+    process = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c',
+         '%s; %s' % (statement, REPORT)],
+        cwd=ROOT, stderr=subprocess.PIPE, universal_newlines=True)
+    err = process.communicate()[1]
+    if process.returncode:
+        raise RuntimeError(err)
+    micros = None
+    heavy = []
+    for line in err.splitlines():
+        if line.startswith('import time:'):
+            fields = [field.strip() for field in line.split('|')]
+            if fields[2] == module:
+                micros = int(fields[1])
+        elif line.startswith('modules:'):
+            heavy = line.split()[1:]
+    return micros, heavy
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10,
+                        help='interpreters started per statement '
+                             '(default: %(default)s)')
+    parser.add_argument('--max-ms', type=float,
+                        help='fail if a best time is over this budget')
+    args = parser.parse_args(argv)
+    failed = False
+    for module, statement in STATEMENTS:
+        times = []
+        for run in range(args.runs):
+            micros, heavy = measure(module, statement)
+            times.append(micros / 1000.0)
+        times.sort()
+        print('%-32s best %7.1f ms  median %7.1f ms  %s'
+              % (statement, times[0], times[len(times) // 2],
+                 'loads ' + ', '.join(heavy) if heavy else ''))
+        if heavy or (args.max_ms is not None and times[0] > args.max_ms):
+            failed = True
+    if failed and (args.max_ms is not None):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
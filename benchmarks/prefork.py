@@ -0,0 +1,100 @@
+"""Load test the prefork server with more and more workers.
+
+    $ python benchmarks/prefork.py [seconds] [clients]
+
+Starts `static --workers N` on a small tree for N = 1, 2, 4... up to
+the number of CPUs. Each time, client processes make keep-alive
+requests for the given number of seconds, and the total requests per
+second is printed. Requests per second should grow about linearly
+with workers, until the clients run out of CPU themselves.
+"""
+
+import http.client as http_lib
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+PATHS = ['/index.html', '/style.css', '/data.bin']
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def client(args):
+    port, seconds = args
+    connection = http_lib.HTTPConnection('127.0.0.1', port)
+    done = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        connection.request('GET', PATHS[done % len(PATHS)])
+        connection.getresponse().read()
+        done += 1
+    connection.close()
+    return done
+
+
+def wait_for(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except (IOError, OSError):
+            time.sleep(0.05)
+    raise RuntimeError('server did not start')
+
+
+def main(seconds=5.0, clients=None):
+    cpus = multiprocessing.cpu_count()
+    clients = clients or 2 * cpus
+    root = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(root, 'index.html'), 'w') as fp:
+            fp.write('<p>Hello</p>\n' * 20)
+        with open(os.path.join(root, 'style.css'), 'w') as fp:
+            fp.write('body { color: blue; }\n' * 200)
+        with open(os.path.join(root, 'data.bin'), 'wb') as fp:
+            fp.write(os.urandom(256 * 1024))
+        workers = 1
+        while True:
+            port = free_port()
+            server = subprocess.Popen(
+                [sys.executable, '-c',
+                 'import static.cli; static.cli.run()', '127.0.0.1',
+                 str(port), root, '--workers', str(workers),
+                 '--metadata-cache-size', '100'], cwd=ROOT)
+            try:
+                wait_for(port)
+                pool = multiprocessing.Pool(clients)
+                try:
+                    done = sum(pool.map(client,
+                                        [(port, seconds)] * clients))
+                finally:
+                    pool.close()
+                    pool.join()
+            finally:
+                server.terminate()
+                server.wait()
+            print('%2d workers, %3d clients: %8.0f req/s'
+                  % (workers, clients, done / seconds))
+            if workers >= cpus:
+                break
+            workers = min(workers * 2, cpus)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(*[float(arg) for arg in sys.argv[1:2]]
+         + [int(arg) for arg in sys.argv[2:3]])
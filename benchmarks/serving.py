@@ -0,0 +1,400 @@
+"""Measure Cling and Shock serving a synthetic tree.
+
+    $ python benchmarks/serving.py [--requests N] [--server]
+                                   [--output results.json]
+                                   [--compare earlier.json]
+
+A temporary tree is built with many tiny files, a few big ones, deep
+directories, .gz siblings and .stp/.mst templates. Then 200, 304, 404
+and redirect requests are timed against a few app setups. Every case
+reports:
+
+- requests per second and latency percentiles
+- the peak memory allocated per request (tracemalloc)
+- the filesystem calls static made per request (stat, fstat, open,
+  read), counted by wrapping them in static.apps
+
+Requests are made in-process by calling the app. With --server they
+are also made over HTTP to a threaded wsgiref server on localhost.
+
+The results are written as JSON. --compare prints the change in
+requests per second against an earlier run, so regressions show up
+between versions.
+"""
+
+import argparse
+import gzip
+import http.client as http_lib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIRequestHandler, WSGIServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import static  # noqa: E402
+import static.apps  # noqa: E402
+
+ETAG = object()  # stands for the ETag of a GET of the same path
+
+VARIABLES = {'color': 'blue', 'name': 'Hamm',
+             'items': [{'name': 'item%d' % i} for i in range(10)]}
+
+# name, path, request headers, expected status, apps it applies to
+CASES = [
+    ('tiny-200', '/tiny/07/file7.txt', {}, 200, None),
+    ('tiny-304', '/tiny/07/file7.txt', {'If-None-Match': ETAG}, 304, None),
+    ('big-200', '/big/big0.bin', {}, 200, None),
+    ('deep-200', '/deep' + '/d' * 16 + '/leaf.html', {}, 200, None),
+    ('gzip-200', '/gz/style.css', {'Accept-Encoding': 'gzip'}, 200, None),
+    ('missing-404', '/tiny/07/missing.txt', {}, 404, None),
+    ('redirect-301', '/tiny', {}, 301, None),
+    ('stp-200', '/templates/page.html', {}, 200, ('shock',)),
+    ('stp-304', '/templates/page.html', {'If-None-Match': ETAG}, 304,
+     ('shock',)),
+    ('mst-200', '/templates/style.css', {}, 200, ('shock',)),
+]
+
+
+def build_tree(root, tiny_files=2000, big_files=2, big_size=8 * 1024 * 1024,
+               depth=16):
+    """Write the synthetic tree under root."""
+    for i in range(tiny_files):
+        directory = os.path.join(root, 'tiny', '%02d' % (i % 50))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'file%d.txt' % i), 'wb') as fp:
+            fp.write(b'tiny file %d\n' % i * 8)
+    os.makedirs(os.path.join(root, 'big'))
+    for i in range(big_files):
+        with open(os.path.join(root, 'big', 'big%d.bin' % i), 'wb') as fp:
+            fp.write(os.urandom(big_size))
+    deep = os.path.join(root, 'deep', *(['d'] * depth))
+    os.makedirs(deep)
+    with open(os.path.join(deep, 'leaf.html'), 'wb') as fp:
+        fp.write(b'<p>deep</p>\n')
+    os.makedirs(os.path.join(root, 'gz'))
+    css = b'body { color: blue; background: white; }\n' * 500
+    with open(os.path.join(root, 'gz', 'style.css'), 'wb') as fp:
+        fp.write(css)
+    with gzip.open(os.path.join(root, 'gz', 'style.css.gz'), 'wb') as fp:
+        fp.write(css)
+    os.makedirs(os.path.join(root, 'templates'))
+    with open(os.path.join(root, 'templates', 'page.html.stp'), 'w') as fp:
+        fp.write('<p>Hello $name, in $color.</p>\n' * 100)
+    with open(os.path.join(root, 'templates', 'style.css.mst'), 'w') as fp:
+        fp.write('{{#items}}.{{name}} { color: {{color}}; }\n{{/items}}'
+                 * 10)
+
+
+def build_apps(root):
+    """Return the app setups to compare, by name."""
+    return {
+        'cling': static.Cling(root),
+        'cling-cached': static.Cling(root, metadata_cache_size=10000,
+                                     content_cache_bytes=64 * 1024 * 1024),
+        'shock': static.Shock(
+            root, [static.StringMagic(variables=VARIABLES, environ_keys=()),
+                   static.MoustacheMagic(variables=VARIABLES)],
+            metadata_cache_size=10000),
+    }
+
+
+def wsgi_request(app, method, path, headers):
+    """Call app in-process; return status, headers and body length."""
+    environ = {'REQUEST_METHOD': method, 'PATH_INFO': path,
+               'SCRIPT_NAME': '', 'QUERY_STRING': '',
+               'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+               'SERVER_PROTOCOL': 'HTTP/1.1', 'wsgi.url_scheme': 'http'}
+    for name, value in headers.items():
+        environ['HTTP_' + name.upper().replace('-', '_')] = value
+    response = []
+
+    def start_response(status, response_headers, exc_info=None):
+        response[:] = [int(status[:3]), dict(response_headers)]
+    body = app(environ, start_response)
+    size = 0
+    try:
+        for block in body:
+            size += len(block)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    return response[0], response[1], size
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class LocalServer(object):
+    """Serve app from a thread on a free localhost port."""
+
+    def __init__(self, app):
+        self.server = make_server('127.0.0.1', 0, app, ThreadingWSGIServer,
+                                  QuietHandler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def request(self, method, path, headers):
+        client = http_lib.HTTPConnection('127.0.0.1', self.port)
+        try:
+            client.request(method, path, headers=headers)
+            response = client.getresponse()
+            body = response.read()
+            return response.status, dict(response.getheaders()), len(body)
+        finally:
+            client.close()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class CountingFile(object):
+    """A file object that counts its read calls."""
+
+    def __init__(self, file_like, counts):
+        self._file = file_like
+        self._counts = counts
+
+    def read(self, *args):
+        self._counts['read'] += 1
+        return self._file.read(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._file.close()
+
+
+class FileCalls(object):
+    """Count the filesystem calls static.apps makes while in use."""
+
+    names = ('stat', 'fstat', 'open', 'read')
+
+    def __init__(self):
+        self.counts = dict((name, 0) for name in self.names)
+
+    def __enter__(self):
+        counts = self.counts
+        real_stat, real_fstat = static.apps.stat, static.apps.fstat
+
+        def counted(name, function):
+            def call(*args, **kw):
+                counts[name] += 1
+                return function(*args, **kw)
+            return call
+
+        static.apps.stat = counted('stat', real_stat)
+        static.apps.fstat = counted('fstat', real_fstat)
+        static.apps.open = lambda *args, **kw: CountingFile(
+            counted('open', open)(*args, **kw), counts)
+        self._restore = real_stat, real_fstat
+        return self
+
+    def __exit__(self, *exc_info):
+        static.apps.stat, static.apps.fstat = self._restore
+        del static.apps.open
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def time_requests(request, args, requests, concurrency=1):
+    """Time requests calls of request(*args) over concurrency threads."""
+    latencies = []
+
+    def worker(count):
+        mine = []
+        for i in range(count):
+            started = time.perf_counter()
+            request(*args)
+            mine.append(time.perf_counter() - started)
+        latencies.extend(mine)
+    threads = [threading.Thread(target=worker,
+                                args=(requests // concurrency,))
+               for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {'requests': len(latencies),
+            'seconds': elapsed,
+            'rps': len(latencies) / elapsed,
+            'latency_us': dict(
+                (name, percentile(latencies, fraction) * 1e6)
+                for name, fraction in (('p50', 0.5), ('p90', 0.9),
+                                       ('p99', 0.99), ('max', 1.0)))}
+
+
+def allocated(request, args, requests):
+    """Return the median peak of memory allocated per request, in bytes."""
+    peaks = []
+    tracemalloc.start()
+    try:
+        for i in range(requests):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            request(*args)
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    peaks.sort()
+    return percentile(peaks, 0.5)
+
+
+def file_calls(request, args, requests):
+    """Return the filesystem calls made per request, by name."""
+    with FileCalls() as calls:
+        for i in range(requests):
+            request(*args)
+    return dict((name, float(count) / requests)
+                for name, count in calls.counts.items())
+
+
+def run_case(app_name, case, request, target, options):
+    name, request_path, headers, status, only = case
+    headers = dict(headers)
+    if ETAG in headers.values():
+        etag = request(target, 'GET', request_path, {})[1]['ETag']
+        headers = dict((key, etag if value is ETAG else value)
+                       for key, value in headers.items())
+    args = (target, 'GET', request_path, headers)
+    got = request(*args)[0]
+    if got != status:
+        raise AssertionError('%s %s: expected %d, got %d'
+                             % (app_name, name, status, got))
+    for i in range(options.warmup):
+        request(*args)
+    return args
+
+
+def measure(apps, options):
+    results = []
+    for app_name, app in sorted(apps.items()):
+        server = LocalServer(app) if options.server else None
+        try:
+            for case in CASES:
+                if case[4] is not None and app_name not in case[4]:
+                    continue
+                args = run_case(app_name, case, wsgi_request, app, options)
+                result = {'app': app_name, 'case': case[0],
+                          'mode': 'in-process', 'status': case[3]}
+                result.update(time_requests(wsgi_request, args,
+                                            options.requests))
+                result['alloc_peak_bytes'] = allocated(
+                    wsgi_request, args, min(options.requests, 200))
+                result['file_calls'] = file_calls(
+                    wsgi_request, args, min(options.requests, 200))
+                results.append(result)
+                report(result)
+                if server is None:
+                    continue
+                args = run_case(app_name, case, LocalServer.request, server,
+                                options)
+                result = {'app': app_name, 'case': case[0],
+                          'mode': 'server', 'status': case[3],
+                          'concurrency': options.concurrency}
+                result.update(time_requests(
+                    LocalServer.request, args,
+                    max(options.requests // 10, options.concurrency),
+                    options.concurrency))
+                results.append(result)
+                report(result)
+        finally:
+            if server is not None:
+                server.close()
+    return results
+
+
+def report(result):
+    line = ('%-13s %-13s %-10s %9.0f req/s  p50 %8.1fus  p99 %8.1fus'
+            % (result['app'], result['case'], result['mode'], result['rps'],
+               result['latency_us']['p50'], result['latency_us']['p99']))
+    if 'file_calls' in result:
+        calls = result['file_calls']
+        line += '  %6.1fKB  %s' % (
+            result['alloc_peak_bytes'] / 1024.0,
+            ' '.join('%s=%g' % (name, calls[name])
+                     for name in FileCalls.names if calls[name]))
+    print(line.rstrip())
+
+
+def compare(results, earlier_path):
+    with open(earlier_path) as earlier_file:
+        earlier = json.load(earlier_file)
+    before = dict(((r['app'], r['case'], r['mode']), r)
+                  for r in earlier['results'])
+    print('\nCompared with %s (static %s):'
+          % (earlier_path, earlier.get('static_version')))
+    for result in results:
+        old = before.get((result['app'], result['case'], result['mode']))
+        if old is None:
+            continue
+        print('%-13s %-13s %-10s %9.0f -> %9.0f req/s  %+6.1f%%'
+              % (result['app'], result['case'], result['mode'], old['rps'],
+                 result['rps'], (result['rps'] / old['rps'] - 1) * 100))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='timed requests per case (default: '
+                             '%(default)s)')
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--big-size', type=int, default=8 * 1024 * 1024,
+                        help='bytes in each big file')
+    parser.add_argument('--server', action='store_true',
+                        help='also time requests over HTTP to a local '
+                             'server')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='client threads with --server')
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', metavar='EARLIER_JSON')
+    options = parser.parse_args(argv)
+    root = tempfile.mkdtemp()
+    try:
+        build_tree(root, big_size=options.big_size)
+        results = measure(build_apps(root), options)
+    finally:
+        shutil.rmtree(root)
+    with open(options.output, 'w') as output:
+        json.dump({'static_version': static.__version__.strip(),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'started': time.time(),
+                   'options': vars(options),
+                   'results': results}, output, indent=2, sort_keys=True)
+    print('Wrote %s' % options.output)
+    if options.compare:
+        compare(results, options.compare)
+
+
+if __name__ == '__main__':
+    main()
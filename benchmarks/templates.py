@@ -0,0 +1,58 @@
+"""Compare cold and warm renders of StringMagic and MoustacheMagic.
+
+    $ python benchmarks/templates.py [iterations]
+
+Cold renders read and compile the template every time (cache_size=0),
+as magics did before compiled templates were cached.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import static  # noqa: E402
+
+STRING_TEMPLATE = 'body { color: $color; background: $background; }\n' * 200
+MOUSTACHE_TEMPLATE = ('<ul>{{#items}}<li>{{name}}: {{value}}</li>{{/items}}'
+                      '</ul>\n<p>{{color}}</p>\n') * 20
+VARIABLES = {'color': 'blue', 'background': 'white',
+             'items': [{'name': 'item%d' % i, 'value': i}
+                       for i in range(10)]}
+
+
+def render_time(magic, template_path, iterations):
+    def render():
+        with magic.file_like(template_path) as file_like:
+            magic.body({}, file_like)
+    render()
+    return timeit.timeit(render, number=iterations) / iterations
+
+
+def main(iterations=2000):
+    root = tempfile.mkdtemp()
+    try:
+        cases = [('StringMagic', static.StringMagic, 'style.css.stp',
+                  STRING_TEMPLATE),
+                 ('MoustacheMagic', static.MoustacheMagic, 'page.html.mst',
+                  MOUSTACHE_TEMPLATE)]
+        for name, magic_class, file_name, source in cases:
+            template_path = os.path.join(root, file_name)
+            with open(template_path, 'w') as template_file:
+                template_file.write(source)
+            cold = render_time(magic_class(variables=VARIABLES,
+                                           cache_size=0),
+                               template_path, iterations)
+            warm = render_time(magic_class(variables=VARIABLES),
+                               template_path, iterations)
+            print('%-15s cold %8.1fus  warm %8.1fus  %5.1fx'
+                  % (name, cold * 1e6, warm * 1e6, cold / warm))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
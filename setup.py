@@ -29,17 +29,22 @@ setup(name=PROJECT,
       license='MIT',
       packages=find_packages(exclude=['tests']),
       include_package_data=True,
+      python_requires='>=3.7',
       install_requires=REQS,
+      extras_require={'brotli': ['brotli'], 'zstd': ['zstandard']},
       entry_points=ENTRYPOINTS,
       classifiers=['Development Status :: 4 - Beta',
                    'Intended Audience :: Developers',
                    'License :: OSI Approved :: MIT License',
                    'Natural Language :: English',
                    'Operating System :: OS Independent',
-                   'Programming Language :: Python :: 2.6',
-                   'Programming Language :: Python :: 2.7',
-                   'Programming Language :: Python :: 3.2',
-                   'Programming Language :: Python :: 3.3',
-                   'Programming Language :: Python :: 3.4',
+                   'Programming Language :: Python :: 3',
+                   'Programming Language :: Python :: 3 :: Only',
+                   'Programming Language :: Python :: 3.7',
+                   'Programming Language :: Python :: 3.8',
+                   'Programming Language :: Python :: 3.9',
+                   'Programming Language :: Python :: 3.10',
+                   'Programming Language :: Python :: 3.11',
+                   'Programming Language :: Python :: 3.12',
                    'Topic :: Software Development :: Libraries',
                    'Topic :: Utilities'])
@@ -1,27 +1,35 @@
-import pkg_resources
-
-version_file = pkg_resources.resource_filename(__name__, 'VERSION')
-with open(version_file) as vf:
-    __version__ = vf.read()
-del version_file
-
+from os import path
 
 from static.apps import (
     BaseMagic,
     cling_wrap,
     Cling,
+    FileWrapper,
     MagicError,
     MoustacheMagic,
     Shock,
     StatusApp,
     StringMagic)
+from static.access import AccessLog
+from static.metrics import Instrument, Instruments, Metrics
+from static.policy import CachePolicy, CacheRule
 
+with open(path.join(path.dirname(path.abspath(__file__)), 'VERSION')) as vf:
+    __version__ = vf.read()
+del path
 
 __all__ = ['__version__',
+           'AccessLog',
            'BaseMagic',
+           'CachePolicy',
+           'CacheRule',
            'cling_wrap',
            'Cling',
+           'FileWrapper',
+           'Instrument',
+           'Instruments',
            'MagicError',
+           'Metrics',
            'MoustacheMagic',
            'Shock',
            'StatusApp',
@@ -0,0 +1,179 @@
+"""Access logs written in batches by a background thread.
+
+    from static.access import AccessLog
+    app = Cling('/var/www', access_log=AccessLog('/var/log/static.log'))
+
+AccessLog is an Instrument: Cling tells it about every response once
+its body has been sent. The request handler only copies a few fields
+out of environ and puts them on a bounded queue; a writer thread
+formats whatever has queued up and writes it with one call. When the
+queue is full, entries are dropped (and counted in dropped) unless
+block=True, which makes requests wait for the writer instead.
+
+Formats are 'common' and 'combined' (Apache's), and 'json', one object
+per line, which also has the time taken. timing=True appends the
+microseconds taken to the text formats too, like Apache's %D.
+
+The writer thread is started on first use in each process, so an
+AccessLog made before forking workers works in each of them. Log
+files are opened for appending, so workers can share one.
+"""
+
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+from static.metrics import Instrument
+
+FORMATS = ('common', 'combined', 'json')
+
+_STOP = object()
+
+
+def _quote(value):
+    """Escape a value for the inside of a double-quoted log field."""
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
+_last_stamp = [None, None]
+
+
+def _log_time(now):
+    """Return now in the log's format, formatting once per second."""
+    second = int(now)
+    if _last_stamp[0] != second:
+        _last_stamp[:] = [second, time.strftime('%d/%b/%Y:%H:%M:%S %z',
+                                                time.localtime(second))]
+    return _last_stamp[1]
+
+
+def _request_line(entry):
+    method, path_info, query, protocol = entry[3:7]
+    target = path_info + '?' + query if query else path_info
+    return '%s %s %s' % (method, target, protocol)
+
+
+def format_entry(entry, log_format='combined', timing=False):
+    """Return the log line (without newline) for an entry from AccessLog."""
+    (now, host, user, method, path_info, query, protocol, referer,
+     agent, status, bytes_sent, seconds) = entry
+    if log_format == 'json':
+        return json.dumps({
+            'time': now, 'remote_addr': host, 'remote_user': user,
+            'method': method, 'path': path_info, 'query': query,
+            'protocol': protocol, 'status': int(status),
+            'bytes_sent': bytes_sent, 'seconds': round(seconds, 6),
+            'referer': referer, 'user_agent': agent},
+            separators=(',', ':'))
+    line = '%s - %s [%s] "%s" %s %s' % (
+        host or '-', user or '-',
+        _log_time(now),
+        _quote(_request_line(entry)), status, bytes_sent or '-')
+    if log_format == 'combined':
+        line += ' "%s" "%s"' % (_quote(referer or '-'), _quote(agent or '-'))
+    if timing:
+        line += ' %d' % (seconds * 1000000)
+    return line
+
+
+class AccessLog(Instrument):
+    """Log every response to output, a file name or a file-like object.
+
+    Up to max_queue entries wait for the writer, which writes up to
+    batch_size of them at a time.
+    """
+
+    times_operations = False
+
+    def __init__(self, output=None, log_format='combined', timing=False,
+                 max_queue=10000, batch_size=500, block=False):
+        if log_format not in FORMATS:
+            raise ValueError('log_format must be one of %s'
+                             % ', '.join(FORMATS))
+        self.output = sys.stderr if output is None else output
+        self.log_format = log_format
+        self.show_timing = timing
+        self.batch_size = batch_size
+        self.block = block
+        self.queue = queue.Queue(max_queue)
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._file = None
+        self._thread = None
+
+    def response(self, environ, status, bytes_sent, seconds):
+        if self._pid != os.getpid():
+            self._start()
+        entry = (time.time(), environ.get('REMOTE_ADDR'),
+                 environ.get('REMOTE_USER'), environ.get('REQUEST_METHOD'),
+                 environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''),
+                 environ.get('QUERY_STRING'),
+                 environ.get('SERVER_PROTOCOL', 'HTTP/1.0'),
+                 environ.get('HTTP_REFERER'), environ.get('HTTP_USER_AGENT'),
+                 status[:3], bytes_sent, seconds)
+        try:
+            self.queue.put(entry, self.block)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Write out what is queued and stop the writer."""
+        with self._lock:
+            thread = self._thread
+            if thread is None or self._pid != os.getpid():
+                return
+            self._thread = None
+        self.queue.put(_STOP)
+        thread.join()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            # Entries queued in the parent before forking are its to write.
+            self.queue = queue.Queue(self.queue.maxsize)
+            if isinstance(self.output, str):
+                self._file = open(self.output, 'ab', 0)
+            self._thread = threading.Thread(target=self._write_batches,
+                                            name='static-access-log')
+            self._thread.daemon = True
+            self._thread.start()
+        atexit.register(self.close)
+
+    def _write_batches(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size and batch[-1] is not _STOP:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is _STOP
+            if stopping:
+                batch.pop()
+            if batch:
+                self._write(''.join(
+                    format_entry(entry, self.log_format, self.show_timing)
+                    + '\n' for entry in batch))
+            if stopping:
+                return
+
+    def _write(self, text):
+        try:
+            if self._file is not None:
+                self._file.write(text.encode('utf-8'))
+            else:
+                self.output.write(text)
+                self.output.flush()
+        except (IOError, OSError, ValueError):
+            pass
@@ -1,22 +1,40 @@
-#!/usr/bin/env python2.4
+#!/usr/bin/env python3
 """static - A very simple WSGI way to serve static (or mixed) content.
 
 (See the docstrings of the various functions and classes.)
 """
 
+import binascii
+import codecs
+import errno
 import logging
 import mimetypes
-from os import path, stat
+import os
+from os import fstat, path, stat
 from email.utils import formatdate, parsedate
+from stat import S_ISDIR
 import string
 import sys
 import time
-
+from urllib.parse import parse_qs
 from wsgiref import util
 
-from pkg_resources import resource_filename, Requirement
-
-import pystache
+from static import autoindex as listings
+from static.cache import LRUCache, SingleFlight
+from static.etags import (content_hash, digest_etag, etag_matches, HashStore,
+                          variant_etag)
+from static.compression import (
+    acceptable,
+    AVAILABLE,
+    choose_encoding,
+    compress,
+    EXTENSIONS,
+    is_compressible,
+    parse_accept_encoding,
+    parse_qvalues)
+from static import manifest as manifests
+from static.metrics import (Instruments, MeteredBody, MeteredFile, Metrics,
+                            timed, timer)
 
 
 class MagicError(Exception):
@@ -41,6 +59,43 @@ class StatusApp:
             return [b""]
 
 
+_UNCHECKED = object()
+
+
+class FileInfo(object):
+    """What Cling knows about one path, gathered from a single stat."""
+
+    __slots__ = ('full_path', 'is_dir', 'mtime', 'size', 'ino',
+                 'content_type', 'etag', 'last_modified', 'siblings',
+                 'magic', 'checked')
+
+    def __init__(self, full_path, is_dir, mtime, size, ino, content_type,
+                 checked):
+        self.full_path = full_path
+        self.is_dir = is_dir
+        self.mtime = mtime
+        self.size = size
+        self.ino = ino
+        self.content_type = content_type
+        self.etag = str(mtime)
+        self.last_modified = formatdate(mtime)
+        self.siblings = {}
+        self.magic = _UNCHECKED
+        self.checked = checked
+
+    @classmethod
+    def from_stat(cls, full_path, st, content_type, checked):
+        """Return the FileInfo for full_path given the result of stat."""
+        return cls(full_path, S_ISDIR(st.st_mode), st.st_mtime, st.st_size,
+                   st.st_ino, content_type, checked)
+
+    def same_file(self, st):
+        """Check that st describes the same file this info was made from."""
+        return (st.st_mtime == self.mtime
+                and st.st_size == self.size
+                and st.st_ino == self.ino)
+
+
 class Cling(object):
     """A very simple way to serve static content via WSGI.
 
@@ -50,8 +105,102 @@ class Cling(object):
     or use 'text/plain' if the extension is not found.
 
     Serve up the contents of the file or delegate to self.not_found.
+
+    Range requests get the requested bytes (206 Partial Content, as
+    multipart/byteranges for several ranges) unless If-Range no longer
+    matches. Up to max_ranges ranges are honoured; more than that, or
+    overlapping ones, get the whole file.
+
+    Set metadata_cache_size to keep the FileInfo of that many paths in
+    memory, so hot paths skip the stat, sibling and mimetypes lookups.
+    Cached entries are revalidated with one stat once they are older than
+    metadata_ttl seconds (0 means on every request, None means never,
+    for trees that don't change while being served).
+    self.metadata_cache.hits and .misses help with sizing.
+
+    Set negative_cache_size to remember that many paths found missing,
+    so floods of requests for missing paths are turned away after a dict
+    lookup. A miss is trusted for negative_ttl seconds (None means for
+    good), then for as long as its directory's mtime stays the same;
+    directories are stat'ed at most once per negative_ttl.
+
+    Set content_cache_bytes to keep the contents of files no bigger than
+    content_cache_max_file in memory, up to that many bytes in total.
+    Cached contents are served without opening the file for as long as
+    the file's mtime, size and inode match its FileInfo.
+
+    Pass compress=True (or a list of content-codings, most preferred
+    first) to compress text and other compressible files of up to
+    compress_max_file bytes on the fly, for clients whose Accept-Encoding
+    allows it. Compressed bytes are kept in an LRU of up to
+    compressed_cache_bytes.
+
+    Either cache can be given instead as content_cache or
+    compressed_cache, such as a static.shared.SharedCache so that all the
+    worker processes on a host share one copy and one budget.
+
+    Precompressed siblings (foo.css.gz next to foo.css, as written by
+    `static compress`) are preferred to compressing on the fly.
+    precompressed lists the content-codings to look for siblings of, most
+    preferred first. Which siblings exist is remembered for up to
+    sibling_cache_size paths, for metadata_ttl seconds and as long as
+    the original's mtime, size and inode stay the same, so each one
+    costs a stat per path and metadata_ttl rather than per request.
+    Only gzip is looked for by default.
+
+    image_variants lists image types, most preferred first, to look
+    for siblings of (photo.jpg.avif and photo.jpg.webp for
+    ('image/avif', 'image/webp')). Clients whose Accept names one
+    explicitly get the smallest such sibling, if it is smaller than the
+    image asked for. Wildcards like image/* don't count, since browsers
+    send them for types they can't show. Like precompressed siblings,
+    these are remembered in the sibling cache.
+
+    ETags come from the file's mtime unless etags='hash', which makes
+    them strong validators from a BLAKE2 hash of the content, so they
+    survive a redeploy of identical bytes. Hashes are kept for up to
+    hash_cache_size files and, given hash_store (a file name), on disk
+    so a restart doesn't rehash. Manifests built with `static manifest
+    --hash` carry them too.
+
+    Give a static.policy.CachePolicy as cache_policy to send
+    Cache-Control headers chosen by request path.
+
+    For trees that don't change while being served, pass manifest=True
+    to record the metadata of the whole tree at startup, or the name of
+    a file written by `static manifest`. Lookups are then answered from
+    the manifest with no stat calls at all, and paths missing from it
+    are not found.
+
+    Pass a static.metrics.Instrument as instrument to have it told how
+    long resolving paths, stat calls, opening files and sending bodies
+    take, and about every response. Given metrics_path (and no
+    instrument), a static.metrics.Metrics is used and its Prometheus
+    text is served at that path.
+
+    Concurrent requests that miss the same entry of the content,
+    compressed or rendered caches wait for one of them to read, compress
+    or render it, for up to coalesce_timeout seconds (0 turns this off).
+
+    Give a static.access.AccessLog as access_log to log every response
+    from a background thread, without slowing requests down.
+
+    Pass autoindex=True to list directories without an index_file, as
+    HTML or, given ?format=json or Accept: application/json, as JSON.
+    Listings show autoindex_page_size entries per page (?page=2 for the
+    next). The sorted names of up to autoindex_cache_size directories
+    and their rendered pages are kept until the directory's mtime
+    changes, so only a page's worth of entries is ever stat'ed.
     """
 
+    max_ranges = 16
+    compress_min_file = 256
+
+    # Methods timed when instrumented, by the event they are reported as.
+    instrumented_methods = (('resolve', '_full_path'),
+                            ('stat', '_load_info'),
+                            ('open', '_file_like'))
+
     def __init__(self, root,
                  block_size=16 * 4096,
                  index_file='index.html',
@@ -59,11 +208,38 @@ class Cling(object):
                  not_modified=None,
                  moved_permanently=None,
                  method_not_allowed=None,
+                 range_not_satisfiable=None,
                  log_name='static',
                  log_level=logging.WARN,
                  log_format=('[%(asctime)s - %(module)20s '
                              '- %(process)5d] %(message)s'),
-                 log=None):
+                 log=None,
+                 metadata_cache_size=0,
+                 metadata_ttl=1.0,
+                 negative_cache_size=0,
+                 negative_ttl=1.0,
+                 content_cache_bytes=0,
+                 content_cache_max_file=16 * 1024,
+                 manifest=None,
+                 compress=False,
+                 compressed_cache_bytes=16 * 1024 * 1024,
+                 compress_max_file=1024 * 1024,
+                 precompressed=('gzip',),
+                 etags='mtime',
+                 hash_cache_size=100000,
+                 hash_store=None,
+                 cache_policy=None,
+                 instrument=None,
+                 metrics_path=None,
+                 autoindex=False,
+                 autoindex_page_size=1000,
+                 autoindex_cache_size=64,
+                 content_cache=None,
+                 compressed_cache=None,
+                 access_log=None,
+                 coalesce_timeout=10.0,
+                 image_variants=(),
+                 sibling_cache_size=1024):
         self.root = root
         self.block_size = block_size
         self.index_file = index_file
@@ -73,69 +249,364 @@ class Cling(object):
             = moved_permanently or StatusApp('301 Moved Permanently')
         self.method_not_allowed \
             = method_not_allowed or StatusApp('405 Method Not Allowed')
+        self.range_not_satisfiable = range_not_satisfiable \
+            or StatusApp('416 Range Not Satisfiable')
         self.log = log or self._stderr_logger(log_name, log_level, log_format)
+        self.metadata_cache = LRUCache(metadata_cache_size)
+        self.metadata_ttl = metadata_ttl
+        self.missing_cache = LRUCache(negative_cache_size)
+        self.directory_mtimes = LRUCache(negative_cache_size)
+        self.negative_ttl = negative_ttl
+        if content_cache is None:
+            content_cache = LRUCache(content_cache_bytes and sys.maxsize,
+                                     content_cache_bytes)
+        self.content_cache = content_cache
+        self.content_cache_max_file = content_cache_max_file
+        if compress is True:
+            compress = AVAILABLE
+        self.compress = tuple(compress or ())
+        if compressed_cache is None:
+            compressed_cache = LRUCache(sys.maxsize if self.compress else 0,
+                                        compressed_cache_bytes)
+        self.compressed_cache = compressed_cache
+        self.compress_max_file = compress_max_file
+        self.precompressed = tuple(precompressed)
+        self.image_variants = tuple(image_variants)
+        self.sibling_cache = LRUCache(sibling_cache_size)
+        self.etags = etags
+        self.hash_cache = LRUCache(hash_cache_size)
+        self.hash_store = None
+        if hash_store is not None:
+            self.hash_store = HashStore(hash_store)
+            for key, digest in self.hash_store.load().items():
+                self.hash_cache.set(key, digest)
+        self.cache_policy = cache_policy
+        self.manifest = None
+        if manifest is True:
+            self.manifest = manifests.index_manifest(
+                manifests.build_manifest(root, self._guess_type), root)
+        elif manifest is not None:
+            self.manifest = manifests.index_manifest(
+                manifests.read_manifest(manifest), root)
+        if metrics_path is not None and instrument is None:
+            instrument = Metrics()
+        if access_log is not None:
+            instrument = access_log if instrument is None \
+                else Instruments(instrument, access_log)
+        self.instrument = instrument
+        self.metrics_path = metrics_path
+        self.flights = SingleFlight(coalesce_timeout)
+        self.autoindex = autoindex
+        self.autoindex_page_size = autoindex_page_size
+        self.listing_cache = LRUCache(
+            autoindex_cache_size if autoindex else 0)
+        if instrument is not None \
+                and getattr(instrument, 'times_operations', True):
+            for event, name in self.instrumented_methods:
+                setattr(self, name, timed(instrument, event,
+                                          getattr(self, name)))
 
     def _stderr_logger(self, log_name, log_level, log_format):
         log = logging.getLogger(log_name)
         log.setLevel(log_level)
-        hdlr = logging.StreamHandler(sys.stderr)
-        hdlr.setFormatter(logging.Formatter(log_format))
-        log.addHandler(hdlr)
+        if not log.handlers:
+            hdlr = logging.StreamHandler(sys.stderr)
+            hdlr.setFormatter(logging.Formatter(log_format))
+            log.addHandler(hdlr)
         return log
 
     def __call__(self, environ, start_response):
         """Respond to a request when called in the usual WSGI way."""
+        if self.instrument is not None:
+            return self._instrumented(environ, start_response)
+        return self._respond(environ, start_response)
+
+    def _instrumented(self, environ, start_response):
+        """Respond, telling self.instrument about the response."""
+        if (self.metrics_path is not None
+                and environ.get('PATH_INFO') == self.metrics_path):
+            start_response('200 OK', [
+                ('Content-Type', 'text/plain; version=0.0.4')])
+            return [self.instrument.exposition(self).encode('utf-8')]
+        started = timer()
+        response = []
+
+        def recording_start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+            if exc_info is None:
+                return start_response(status, headers)
+            return start_response(status, headers, exc_info)
+        body = self._respond(environ, recording_start_response)
+        status, headers = response
+        if isinstance(body, list):
+            self.instrument.response(environ, status,
+                                     sum(len(block) for block in body),
+                                     timer() - started)
+            return body
+        if hasattr(body, 'close') and (hasattr(body, 'fileno')
+                                       or hasattr(body, 'filelike')):
+            # Wrapping would hide the file from servers using sendfile().
+            MeteredFile(body, self.instrument, environ, status, started,
+                        int(dict(headers).get('Content-Length', 0)))
+            return body
+        return MeteredBody(body, self.instrument, environ, status, started)
+
+    def _respond(self, environ, start_response):
         if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
             return self.method_not_allowed(environ, start_response)
         path_info = environ.get('PATH_INFO', '')
         full_path = self._full_path(path_info)
-        if not self._is_under_root(full_path):
+        if self.manifest is None and not self._is_under_root(full_path):
             return self.not_found(environ, start_response)
-        if path.isdir(full_path):
-            if full_path[-1] != '/' or full_path == self.root:
-                location = util.request_uri(environ, include_query=False) + '/'
-                if environ.get('QUERY_STRING'):
-                    location += '?' + environ.get('QUERY_STRING')
-                headers = [('Location', location)]
-                return self.moved_permanently(environ, start_response, headers)
-            else:
-                full_path = self._full_path(path_info + self.index_file)
-        prezipped = ('gzip' in environ.get('HTTP_ACCEPT_ENCODING', '')
-                     and path.exists(full_path + '.gz'))
-        if prezipped:
-            full_path += '.gz'
-        content_type = self._guess_type(full_path)
         try:
-            etag, last_modified = self._conditions(full_path, environ)
+            info = self._file_info(full_path)
+            if info.is_dir:
+                if full_path[-1] != '/' or full_path == self.root:
+                    return self._add_slash(environ, start_response)
+                else:
+                    index = self._index_info(path_info)
+                    if index is None:
+                        return self._listing(environ, start_response,
+                                             path_info, info)
+                    path_info, full_path, info = index
+            info, image_variant = self._image_variant(environ, info)
+            coding, info, content, varies = self._negotiate(
+                environ, info.full_path, info)
+            full_path = info.full_path
+            etag, last_modified = self._conditions(full_path, environ, info)
+            if content is not None:
+                etag = variant_etag(etag, coding)
+            if image_variant:
+                etag = variant_etag(etag, image_variant)
             headers = [('Date', formatdate(time.time())),
                        ('Last-Modified', last_modified),
                        ('ETag', etag)]
-            if_modified = environ.get('HTTP_IF_MODIFIED_SINCE')
-            if if_modified and (parsedate(if_modified)
-                                >= parsedate(last_modified)):
+            vary = self._vary(full_path, info, image_variant, varies)
+            if vary:
+                headers.append(('Vary', ', '.join(vary)))
+            if self.cache_policy is not None:
+                headers.extend(self.cache_policy.headers(path_info))
+            dated = self._dated(full_path, info)
+            if self._is_not_modified(environ, etag,
+                                     last_modified if dated else None):
                 return self.not_modified(environ, start_response, headers)
-            if_none = environ.get('HTTP_IF_NONE_MATCH')
-            if if_none and (if_none == '*' or etag in if_none):
-                return self.not_modified(environ, start_response, headers)
-            file_like = self._file_like(full_path)
-            headers.append(('Content-Type', content_type))
-            if prezipped:
-                headers.extend([('Content-Encoding', 'gzip'),
-                                ('Vary', 'Accept-Encoding')])
-            start_response("200 OK", headers)
-            if environ['REQUEST_METHOD'] == 'GET':
-                return self._body(full_path, environ, file_like)
-            else:
-                return ['']
+            headers.append(('Content-Type', info.content_type))
+            if coding is not None:
+                headers.append(('Content-Encoding', coding))
+            return self._send(environ, start_response, full_path, info,
+                              headers, content)
         except (IOError, OSError):
             return self.not_found(environ, start_response)
 
+    def _send(self, environ, start_response, full_path, info, headers,
+              content=None):
+        """Start the response and return the whole body or the ranges.
+
+        The body is content if given, else the contents of the file.
+        """
+        if content is None:
+            content = self._cached_content(full_path, info)
+        file_like = None
+        if content is not None:
+            length = len(content)
+        else:
+            length = self._content_length(full_path, info)
+            file_like = self._file_like(full_path, info)
+            if length is not None:
+                opened = self._opened_info(info, file_like)
+                if opened is not info:
+                    # The validators were those of the file cached.
+                    headers = [header for header in headers if header[0]
+                               not in ('ETag', 'Last-Modified')]
+                    info, length = opened, opened.size
+        ranges = None
+        if length is not None:
+            headers.append(('Accept-Ranges', 'bytes'))
+            ranges = self._ranges(environ, length, headers)
+            if ranges == []:
+                if file_like is not None:
+                    file_like.close()
+                headers = [('Content-Range', 'bytes */%d' % length)]
+                return self.range_not_satisfiable(environ, start_response,
+                                                  headers)
+        if environ['REQUEST_METHOD'] != 'GET':
+            if file_like is not None:
+                file_like.close()
+            file_like = content = None
+        if ranges:
+            return self._send_ranges(start_response, headers, ranges, length,
+                                     content, file_like)
+        if length is not None:
+            headers.append(('Content-Length', str(length)))
+        start_response("200 OK", headers)
+        if content is not None:
+            return [content]
+        elif file_like is not None:
+            return self._body(full_path, environ, file_like, info)
+        else:
+            return [b'']
+
+    def _ranges(self, environ, length, headers):
+        """Return the byte ranges to send, [] if unsatisfiable or None.
+
+        None means the whole body, because there was no usable Range
+        header or If-Range did not match the current validators.
+        """
+        range_header = environ.get('HTTP_RANGE')
+        if not range_header:
+            return None
+        if_range = environ.get('HTTP_IF_RANGE')
+        if if_range is not None:
+            validators = dict(headers)
+            if (if_range != validators.get('Last-Modified')
+                    and not etag_matches(validators.get('ETag'), if_range,
+                                         weak=False)):
+                return None
+        return parse_range(range_header, length, self.max_ranges)
+
+    def _send_ranges(self, start_response, headers, ranges, length,
+                     content, file_like):
+        """Start a 206 response and return the body for the ranges.
+
+        The body comes from content if given, else from file_like, and is
+        empty if neither is (for HEAD).
+        """
+        if len(ranges) == 1:
+            start, stop = ranges[0]
+            headers.extend([
+                ('Content-Range', 'bytes %d-%d/%d' % (start, stop - 1,
+                                                      length)),
+                ('Content-Length', str(stop - start))])
+            start_response('206 Partial Content', headers)
+            if content is not None:
+                return [content[start:stop]]
+            elif file_like is not None:
+                return FileWrapper(file_like, self.block_size, start,
+                                   stop - start)
+            else:
+                return [b'']
+        boundary = binascii.hexlify(os.urandom(16)).decode('ascii')
+        content_type = dict(headers)['Content-Type']
+        part_headers = [
+            ('--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d'
+             '\r\n\r\n' % (boundary, content_type, start, stop - 1, length)
+             ).encode('ascii')
+            for start, stop in ranges]
+        closing = ('--%s--\r\n' % boundary).encode('ascii')
+        body_length = (sum(len(part) + stop - start + 2 for part, (start, stop)
+                           in zip(part_headers, ranges))
+                       + len(closing))
+        headers = [(name, value) for name, value in headers
+                   if name != 'Content-Type']
+        headers.extend([
+            ('Content-Type', 'multipart/byteranges; boundary=' + boundary),
+            ('Content-Length', str(body_length))])
+        start_response('206 Partial Content', headers)
+        if content is not None:
+            body = []
+            for part, (start, stop) in zip(part_headers, ranges):
+                body.extend([part, content[start:stop], b'\r\n'])
+            return body + [closing]
+        elif file_like is not None:
+            return ByteRangesWrapper(file_like, self.block_size,
+                                     list(zip(part_headers, ranges)), closing)
+        else:
+            return [b'']
+
+    def _index_info(self, path_info):
+        """Return path_info, full_path and FileInfo of a directory's index.
+
+        Return None instead of raising OSError if it has no index_file and
+        directories are listed.
+        """
+        path_info += self.index_file
+        full_path = self._full_path(path_info)
+        try:
+            return path_info, full_path, self._file_info(full_path)
+        except (IOError, OSError):
+            if self.autoindex:
+                return None
+            raise
+
+    def _listing(self, environ, start_response, path_info, info):
+        """Send a page of the listing of the directory described by info."""
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        as_json = (query.get('format') == ['json']
+                   or 'application/json' in environ.get('HTTP_ACCEPT', ''))
+        try:
+            page = int(query.get('page', ['1'])[0])
+        except ValueError:
+            page = 0
+        content_type, render = (
+            ('application/json', listings.render_json) if as_json
+            else ('text/html; charset=utf-8', listings.render_html))
+        key = (info.full_path, info.mtime, page, as_json)
+        content = self.listing_cache.get(key)
+        if content is None:
+            names_key = (info.full_path, info.mtime)
+            entries = self.listing_cache.get(names_key)
+            if entries is None:
+                entries = listings.scan(info.full_path)
+                self.listing_cache.set(names_key, entries)
+            pages = listings.page_count(entries, self.autoindex_page_size)
+            if not 1 <= page <= pages:
+                return self.not_found(environ, start_response)
+            rows = listings.page_rows(info.full_path, entries, page,
+                                      self.autoindex_page_size)
+            content = render(environ.get('SCRIPT_NAME', '') + path_info,
+                             rows, page, pages, len(entries))
+            self.listing_cache.set(key, content)
+        etag = digest_etag(info.full_path, info.mtime, page, as_json)
+        headers = [('Date', formatdate(time.time())),
+                   ('Last-Modified', info.last_modified),
+                   ('ETag', etag),
+                   ('Vary', 'Accept')]
+        if self._is_not_modified(environ, etag, info.last_modified):
+            return self.not_modified(environ, start_response, headers)
+        headers.extend([('Content-Type', content_type),
+                        ('Content-Length', str(len(content)))])
+        start_response('200 OK', headers)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return [b'']
+        return [content]
+
+    def _add_slash(self, environ, start_response):
+        """Redirect a request for a directory to its trailing slash form."""
+        location = util.request_uri(environ, include_query=False) + '/'
+        if environ.get('QUERY_STRING'):
+            location += '?' + environ.get('QUERY_STRING')
+        headers = [('Location', location)]
+        return self.moved_permanently(environ, start_response, headers)
+
+    def _is_not_modified(self, environ, etag, last_modified):
+        """Check the request's conditional headers against the validators.
+
+        If-None-Match wins over If-Modified-Since when both are given.
+        If-Modified-Since is ignored if last_modified is None.
+        """
+        if_none = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none:
+            return etag_matches(etag, if_none)
+        if_modified = environ.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified and last_modified and (
+                parsedate(if_modified) >= parsedate(last_modified)):
+            return True
+        return False
+
     def _full_path(self, path_info):
         """Return the full path from which to read."""
         return self.root + path_info
 
     def _is_under_root(self, full_path):
-        """Guard against arbitrary file retrieval."""
+        """Guard against arbitrary file retrieval.
+
+        Paths that are the root plus '/...' with no '..' in them can't
+        leave it, so only the others are normalized and compared.
+        """
+        if full_path.startswith(self.root):
+            relative = full_path[len(self.root):]
+            if relative[:1] in ('', '/') and '..' not in relative:
+                return True
         abs_destination = path.abspath(full_path) + path.sep
         abs_root = path.abspath(self.root) + path.sep
         if abs_destination.startswith(abs_root):
@@ -143,37 +614,454 @@ class Cling(object):
         else:
             return False
 
+    def _file_info(self, full_path):
+        """Return the FileInfo for full_path, from the cache if fresh.
+
+        Raise OSError if there is nothing at full_path.
+        """
+        if self.manifest is not None:
+            return self._manifest_info(full_path)
+        if self.missing_cache.max_entries <= 0:
+            return self._cached_info(full_path)
+        if self._known_missing(full_path):
+            raise OSError(errno.ENOENT, 'Known to be missing', full_path)
+        try:
+            return self._cached_info(full_path)
+        except OSError as error:
+            if error.errno in (errno.ENOENT, errno.ENOTDIR):
+                self._remember_missing(full_path)
+            raise
+
+    def _known_missing(self, full_path):
+        """Check the negative cache for full_path.
+
+        A miss is trusted for negative_ttl seconds, then for as long as
+        the mtime of its directory (itself checked at most once per
+        negative_ttl) stays the same.
+        """
+        entry = self.missing_cache.get(full_path)
+        if entry is None:
+            return False
+        directory, mtime, checked = entry
+        now = time.time()
+        if self.negative_ttl is None or now - checked < self.negative_ttl:
+            return True
+        if mtime is not None and self._directory_mtime(directory,
+                                                       now) == mtime:
+            return True
+        self.missing_cache.pop(full_path)
+        return False
+
+    def _remember_missing(self, full_path):
+        directory = path.dirname(full_path)
+        now = time.time()
+        self.missing_cache.set(
+            full_path, (directory, self._directory_mtime(directory, now),
+                        now))
+
+    def _directory_mtime(self, directory, now):
+        """Return the mtime of directory (None if missing), maybe cached."""
+        entry = self.directory_mtimes.get(directory)
+        if entry is not None and (self.negative_ttl is None
+                                  or now - entry[1] < self.negative_ttl):
+            return entry[0]
+        try:
+            mtime = stat(directory).st_mtime
+        except OSError:
+            mtime = None
+        self.directory_mtimes.set(directory, (mtime, now))
+        return mtime
+
+    def _cached_info(self, full_path):
+        """Return the FileInfo for full_path through the metadata cache."""
+        cache = self.metadata_cache
+        if cache.max_entries <= 0:
+            return self._load_info(full_path)
+        info = cache.get(full_path)
+        now = time.time()
+        if info is None:
+            info = self._load_info(full_path, now)
+            cache.set(full_path, info)
+        elif (self.metadata_ttl is not None
+              and now - info.checked >= self.metadata_ttl):
+            try:
+                st = stat(full_path)
+            except OSError:
+                cache.pop(full_path)
+                raise
+            if info.same_file(st):
+                info.checked = now
+                info.siblings = {}
+            else:
+                info = self._load_info(full_path, now, st)
+                cache.set(full_path, info)
+        return info
+
+    def _load_info(self, full_path, now=None, st=None):
+        """Return a fresh FileInfo for full_path."""
+        if st is None:
+            st = stat(full_path)
+        return FileInfo.from_stat(full_path, st, self._guess_type(full_path),
+                                  now or time.time())
+
+    def _manifest_info(self, full_path):
+        """Return the FileInfo for full_path from the manifest."""
+        entry = self.manifest.get(full_path)
+        if entry is None:
+            raise OSError(errno.ENOENT, 'Not in the manifest', full_path)
+        if isinstance(entry, FileInfo):
+            return entry
+        _, is_dir, size, mtime, ino, content_type = entry[:6]
+        info = FileInfo(full_path, is_dir, mtime, size, ino, content_type,
+                        None)
+        if len(entry) > 6:
+            self.hash_cache.set((ino, size, mtime), entry[6])
+        self.manifest[full_path] = info
+        return info
+
+    def _negotiate(self, environ, full_path, info):
+        """Choose the content-coding for the response from Accept-Encoding.
+
+        Return (coding, info, content, varies): coding is None for
+        identity, info is the FileInfo of the file to send (the prezipped
+        sibling if that was chosen), content is the body if it was
+        compressed on the fly and varies is true if other clients might
+        get another coding.
+        """
+        accepted = parse_accept_encoding(
+            environ.get('HTTP_ACCEPT_ENCODING'))
+        varies = False
+        for coding in self.precompressed:
+            sibling = self._sibling(info, coding)
+            if sibling is not None:
+                if acceptable(accepted, coding):
+                    return coding, sibling, None, True
+                varies = True
+        if not self._compressible(full_path, info):
+            return None, info, None, varies
+        coding = choose_encoding(accepted, self.compress)
+        if coding is not None:
+            content = self._compressed_content(full_path, info, coding)
+            if content is not None:
+                return coding, info, content, True
+        return None, info, None, True
+
+    def _image_variant(self, environ, info):
+        """Choose the smallest image variant the client's Accept names.
+
+        Return (info, variant): info is the FileInfo to send (a sibling
+        if one was chosen) and variant its extension, '' if there are
+        variants but the original was kept, or None if there are none.
+        """
+        if (not self.image_variants or info.content_type is None
+                or not info.content_type.startswith('image/')):
+            return info, None
+        variant = None
+        accepted = None
+        chosen = info
+        for media_type in self.image_variants:
+            sibling = self._sibling(info, media_type)
+            if sibling is None:
+                continue
+            if accepted is None:
+                variant = ''
+                accepted = parse_qvalues(environ.get('HTTP_ACCEPT'))
+            if (accepted.get(media_type, 0) > 0
+                    and sibling.size < chosen.size):
+                chosen, variant = sibling, media_type.partition('/')[2]
+        return chosen, variant
+
+    def _vary(self, full_path, info, image_variant, varies):
+        """Return the request headers the response was chosen by."""
+        vary = []
+        if image_variant is not None:
+            vary.append('Accept')
+        if varies:
+            vary.append('Accept-Encoding')
+        return vary
+
+    def _dated(self, full_path, info):
+        """Check whether Last-Modified changes whenever the response does."""
+        return True
+
+    def _compressible(self, full_path, info):
+        """Check whether info may be compressed on the fly."""
+        return (bool(self.compress)
+                and self.compress_min_file <= info.size
+                and info.size <= self.compress_max_file
+                and is_compressible(info.content_type))
+
+    def _compressed_content(self, full_path, info, coding):
+        """Return the compressed contents of a file, from memory if cached.
+
+        Return None if compressing doesn't make the file smaller.
+        """
+        key = (full_path, info.mtime, info.size, info.ino, coding)
+        content = self.compressed_cache.get(key, _UNCHECKED)
+        if content is not _UNCHECKED:
+            return content
+        return self.flights.call(key, self._compress, full_path, info,
+                                 coding, key)
+
+    def _compress(self, full_path, info, coding, key):
+        """Compress a file into the compressed cache and return it."""
+        original = self._read(full_path, info)
+        content = compress(original, coding)
+        if len(content) >= len(original):
+            content = None
+        self.compressed_cache.set(key, content,
+                                  len(content) if content else 0)
+        return content
+
+    def _sibling(self, info, coding):
+        """Return the FileInfo of the precompressed version of info or None.
+
+        Given a media type like image/webp as coding, look for that image
+        variant (info's path plus .webp) instead. Precompressed siblings
+        have info's type, whatever their extension suggests. The answer
+        is remembered in info.siblings, shared through the sibling cache.
+        """
+        if not info.siblings:
+            info.siblings = self._known_siblings(info)
+        try:
+            return info.siblings[coding]
+        except KeyError:
+            pass
+        if '/' in coding:
+            sibling_path = info.full_path + '.' + coding.partition('/')[2]
+        else:
+            sibling_path = info.full_path + EXTENSIONS[coding]
+        try:
+            if self.manifest is not None:
+                sibling = self._manifest_info(sibling_path)
+            else:
+                sibling = self._load_info(sibling_path)
+        except OSError:
+            sibling = None
+        if sibling is not None:
+            sibling.content_type = coding if '/' in coding \
+                else info.content_type
+        info.siblings[coding] = sibling
+        return sibling
+
+    def _known_siblings(self, info):
+        """Return the siblings found for info's path while still valid."""
+        cache = self.sibling_cache
+        if cache.max_entries <= 0:
+            return info.siblings
+        validator = (info.mtime, info.size, info.ino)
+        now = time.time()
+        entry = cache.get(info.full_path)
+        if (entry is not None and entry[0] == validator
+                and (self.metadata_ttl is None
+                     or now - entry[1] < self.metadata_ttl)):
+            return entry[2]
+        cache.set(info.full_path, (validator, now, info.siblings))
+        return info.siblings
+
+    def _cached_content(self, full_path, info):
+        """Return the contents of a small file from memory or None."""
+        cache = self.content_cache
+        if cache.max_entries <= 0 or info.size > self.content_cache_max_file:
+            return None
+        validator = (info.mtime, info.size, info.ino)
+        entry = cache.get(full_path)
+        if entry is not None and entry[0] == validator:
+            return entry[1]
+        return self.flights.call((full_path, validator), self._load_content,
+                                 full_path, info, validator)
+
+    def _load_content(self, full_path, info, validator):
+        """Read a small file into the content cache and return it."""
+        content = self._read(full_path, info)
+        if len(content) == info.size:
+            self.content_cache.set(full_path, (validator, content),
+                                   len(content))
+        return content
+
+    def _read(self, full_path, info):
+        """Return the whole contents of the file."""
+        with open(full_path, 'rb') as file_like:
+            return file_like.read()
+
     def _guess_type(self, full_path):
         """Guess the mime type using the mimetypes module."""
         return mimetypes.guess_type(full_path)[0] or 'text/plain'
 
-    def _conditions(self, full_path, environ):
+    def _conditions(self, full_path, environ, info=None):
         """Return a tuple of etag, last_modified by mtime from stat."""
-        mtime = stat(full_path).st_mtime
-        return str(mtime), formatdate(mtime)
+        if info is None:
+            info = self._file_info(full_path)
+        return self._etag(info), info.last_modified
+
+    def _etag(self, info):
+        """Return the ETag for info, hashing its content if configured to.
 
-    def _file_like(self, full_path):
+        Hashes are computed on first use and remembered by inode, size and
+        mtime (and written to self.hash_store, if there is one).
+        """
+        if self.etags != 'hash':
+            return info.etag
+        key = (info.ino, info.size, info.mtime)
+        digest = self.hash_cache.get(key)
+        if digest is None:
+            digest = content_hash(info.full_path, self.block_size)
+            self.hash_cache.set(key, digest)
+            if self.hash_store is not None:
+                self.hash_store.add(key, digest)
+        return '"%s"' % digest
+
+    def _content_length(self, full_path, info):
+        """Return the length of the body from the stat in info."""
+        return info.size
+
+    def _opened_info(self, info, file_like):
+        """Return the FileInfo of the file just opened as file_like.
+
+        Cached metadata can be metadata_ttl old, and the file replaced
+        since. Then the entry is dropped and a FileInfo made from fstat,
+        so that the length sent is that of the file sent.
+        """
+        try:
+            st = fstat(file_like.fileno())
+        except (AttributeError, EnvironmentError, ValueError):
+            return info
+        if st.st_ino == info.ino and st.st_size == info.size:
+            return info
+        self.metadata_cache.pop(info.full_path)
+        return FileInfo.from_stat(info.full_path, st, info.content_type,
+                                  time.time())
+
+    def _file_like(self, full_path, info=None):
         """Return the appropriate file object."""
         return open(full_path, 'rb')
 
-    def _body(self, full_path, environ, file_like):
-        """Return an iterator over the body of the response."""
-        way_to_send = environ.get('wsgi.file_wrapper', _iter_and_close)
-        return way_to_send(file_like, self.block_size)
+    def _body(self, full_path, environ, file_like, info=None):
+        """Return an iterator over the body of the response.
+
+        The server's wsgi.file_wrapper is trusted to send no more than
+        Content-Length; FileWrapper stops at info.size.
+        """
+        way_to_send = environ.get('wsgi.file_wrapper')
+        if way_to_send is not None:
+            return way_to_send(file_like, self.block_size)
+        return FileWrapper(file_like, self.block_size, 0,
+                           None if info is None else info.size)
+
 
+class FileWrapper(object):
+    """Iterate over a file by block, then close it.
 
-def _iter_and_close(file_like, block_size):
-    """Yield file contents by block then close the file."""
-    while 1:
+    This is what Cling uses when the server has no wsgi.file_wrapper.
+    It exposes fileno() so servers that look for it can sendfile() the
+    file instead of iterating. Blocks are read(), not sliced out of a
+    memory map: a map gains nothing when every block must be copied to
+    bytes anyway, and a file truncated mid-response (as in-place
+    deploys do) would kill the process with SIGBUS.
+
+    Give offset and length to send only part of the file (the file is
+    positioned at offset up front for the benefit of sendfile()).
+    """
+
+    def __init__(self, file_like, block_size=16 * 4096, offset=0,
+                 length=None):
+        self.file_like = file_like
+        self.block_size = block_size
+        self.offset = offset
+        self.length = length
+        if offset:
+            file_like.seek(offset)
+
+    def fileno(self):
+        return self.file_like.fileno()
+
+    def close(self):
+        self.file_like.close()
+
+    def __iter__(self):
         try:
-            block = file_like.read(block_size)
-            if block:
+            stop = None
+            if self.length is not None:
+                stop = self.offset + self.length
+            for block in self._blocks(self.offset, stop):
                 yield block
+        finally:
+            self.close()
+
+    def _blocks(self, start, stop):
+        """Yield the bytes from start to stop (or the end) by block."""
+        self.file_like.seek(start)
+        while stop is None or start < stop:
+            size = self.block_size
+            if stop is not None:
+                size = min(size, stop - start)
+            block = self.file_like.read(size)
+            if not block:
+                break
+            start += len(block)
+            yield block
+
+
+class ByteRangesWrapper(FileWrapper):
+    """Iterate over a multipart/byteranges body taken from a file.
+
+    parts is a list of (part_header, (start, stop)) and closing is the
+    final boundary line.
+    """
+
+    def __init__(self, file_like, block_size, parts, closing):
+        super(ByteRangesWrapper, self).__init__(file_like, block_size)
+        self.parts = parts
+        self.closing = closing
+
+    def __iter__(self):
+        try:
+            for part_header, (start, stop) in self.parts:
+                yield part_header
+                for block in self._blocks(start, stop):
+                    yield block
+                yield b'\r\n'
+            yield self.closing
+        finally:
+            self.close()
+
+
+def parse_range(header, length, max_ranges=None):
+    """Parse a Range header into a list of (start, stop) byte offsets.
+
+    Return None if the header should be ignored (it is malformed, not in
+    bytes, asks for more than max_ranges or overlapping ranges) and an
+    empty list if none of the ranges can be satisfied.
+    """
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        first, dash, last = spec.strip().partition('-')
+        if not dash:
+            return None
+        try:
+            if first:
+                start = int(first)
+                stop = int(last) + 1 if last else length
+                if start < 0 or last and stop <= start:
+                    return None
             else:
-                raise StopIteration
-        except StopIteration:
-            file_like.close()
-            break
+                start, stop = max(length - int(last), 0), length
+                if int(last) == 0:
+                    continue
+        except ValueError:
+            return None
+        if start < length:
+            ranges.append((start, min(stop, length)))
+    if max_ranges is not None and len(ranges) > max_ranges:
+        return None
+    ordered = sorted(ranges)
+    for (_, stop), (start, _) in zip(ordered, ordered[1:]):
+        if start < stop:
+            return None
+    return ranges
 
 
 def cling_wrap(package_name, dir_name, **kw):  # pragma: no cover
@@ -186,6 +1074,7 @@ def cling_wrap(package_name, dir_name, **kw):  # pragma: no cover
     requirements for static content, in which case you probably
     shouldn't be serving it through a WSGI app.
     """
+    from pkg_resources import resource_filename, Requirement
     resource = Requirement.parse(package_name)
     return Cling(resource_filename(resource, dir_name), **kw)
 
@@ -214,29 +1103,127 @@ class Shock(Cling):
     This is really nice if you have a color variable in your css files or
     something trivial like that. It seems silly to create or change a
     handful of objects for a couple of dynamic bits of text.
+
+    The output of magics that declare environ_keys (see BaseMagic) is
+    kept in an LRU of up to rendered_cache_bytes, keyed on its ETag. Its
+    responses Vary on the request headers among those keys. Magic output
+    is only revalidated by ETag: the template's mtime doesn't cover the
+    variables or request it was rendered with, so If-Modified-Since
+    alone never gets a 304.
+
+    Magic files bigger than stream_threshold bytes are rendered a chunk
+    at a time by magics that can stream (see BaseMagic.stream), instead
+    of being read, rendered and encoded whole.
     """
 
-    def __init__(self, root, magics, **kw):
-        super(Shock, self).__init__(root, **kw)
+    instrumented_methods = Cling.instrumented_methods + (
+        ('render', '_render'),)
+
+    def __init__(self, root, magics, rendered_cache_bytes=16 * 1024 * 1024,
+                 stream_threshold=1024 * 1024, **kw):
+        # Set first: building a manifest guesses types through them.
         self.magics = magics
+        super(Shock, self).__init__(root, **kw)
+        self.stream_threshold = stream_threshold
+        self.rendered_cache = LRUCache(rendered_cache_bytes and sys.maxsize,
+                                       rendered_cache_bytes)
+
+    @property
+    def magics(self):
+        return self._magics
+
+    @magics.setter
+    def magics(self, magics):
+        """Set the magics and index them by extension.
+
+        Magics that override matches() can't be indexed, so if there are
+        any, every lookup scans self.magics in order, as it always did.
+        """
+        self._magics = magics
+        self._magic_table = {}
+        self._scan_magics = False
+        for index, magic in enumerate(magics):
+            if type(magic).matches is not BaseMagic.matches:
+                self._scan_magics = True
+            self._magic_table.setdefault(magic.extension, (index, magic))
+        self._suffix_lengths = sorted(
+            set(len(extension) for extension in self._magic_table))
+        self._existence_checks = []
+        extensions = set()
+        for magic in magics:
+            simple = type(magic).exists is BaseMagic.exists
+            if simple and magic.extension in extensions:
+                continue
+            extensions.add(magic.extension)
+            self._existence_checks.append((magic, simple))
 
     def _match_magic(self, full_path):
         """Return the first magic that matches this path or None."""
-        for magic in self.magics:
-            if magic.matches(full_path):
-                return magic
+        if self._scan_magics:
+            for magic in self.magics:
+                if magic.matches(full_path):
+                    return magic
+            return None
+        best = None
+        for length in self._suffix_lengths:
+            entry = self._magic_table.get(full_path[-length:] if length
+                                          else '')
+            if entry is not None and (best is None or entry[0] < best[0]):
+                best = entry
+        if best is not None:
+            return best[1]
 
     def _full_path(self, path_info):
-        """Return the full path from which to read."""
+        """Return the full path from which to read.
+
+        Existence is checked through the FileInfo lookups, so with
+        metadata caching a hot path costs no stat calls.
+        """
         full_path = self.root + path_info
-        if path.exists(full_path):
+        if not self._is_under_root(full_path):
             return full_path
-        else:
-            for magic in self.magics:
-                if magic.exists(full_path):
+        if self._exists(full_path):
+            return full_path
+        for magic, simple in self._existence_checks:
+            if simple:
+                if self._exists(magic.new_path(full_path)):
                     return magic.new_path(full_path)
-            else:
-                return full_path
+            elif magic.exists(full_path):
+                return magic.new_path(full_path)
+        return full_path
+
+    def _exists(self, full_path):
+        try:
+            self._file_info(full_path)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def _file_info(self, full_path):
+        """Return the FileInfo for full_path with its magic resolved.
+
+        The matching magic and the mime type it implies are worked out
+        once per FileInfo, so cached paths skip the magic lookup too.
+        """
+        info = super(Shock, self)._file_info(full_path)
+        self._magic(full_path, info)
+        return info
+
+    def _magic(self, full_path, info):
+        """Return the magic for full_path, remembering it in info if given.
+
+        The mime type the magic implies is stored in info at the same time.
+        """
+        if info is None:
+            return self._match_magic(full_path)
+        if info.magic is _UNCHECKED:
+            magic = self._match_magic(full_path)
+            if magic is not None:
+                info.content_type = (
+                    mimetypes.guess_type(magic.old_path(full_path))[0]
+                    or 'text/plain')
+            info.magic = magic
+        return info.magic
 
     def _guess_type(self, full_path):
         """Guess the mime type magically or using the mimetypes module."""
@@ -247,31 +1234,108 @@ class Shock(Cling):
         else:
             return mimetypes.guess_type(full_path)[0] or 'text/plain'
 
-    def _conditions(self, full_path, environ):
+    def _conditions(self, full_path, environ, info=None):
         """Return Etag and Last-Modified values defaults to now for both."""
-        magic = self._match_magic(full_path)
-        if magic is not None:
+        magic = self._magic(full_path, info)
+        if magic is not None and magic.environ_keys is not None:
+            return magic.validators(info or self._file_info(full_path),
+                                    environ)
+        elif magic is not None:
             return magic.conditions(full_path, environ)
         else:
-            mtime = stat(full_path).st_mtime
-            return str(mtime), formatdate(mtime)
+            return super(Shock, self)._conditions(full_path, environ, info)
+
+    def _vary(self, full_path, info, image_variant, varies):
+        """Add the request headers a magic's output depends on."""
+        vary = super(Shock, self)._vary(full_path, info, image_variant,
+                                        varies)
+        magic = self._magic(full_path, info)
+        if magic is not None and magic.environ_keys is not None:
+            vary.extend(magic.request_headers())
+        return vary
+
+    def _dated(self, full_path, info):
+        """Magic output changes with more than the template's mtime."""
+        return self._magic(full_path, info) is None
+
+    def _send(self, environ, start_response, full_path, info, headers,
+              content=None):
+        """Send the output of magics with environ_keys as content."""
+        magic = self._magic(full_path, info)
+        if (content is None and magic is not None
+                and magic.environ_keys is not None
+                and not self._streams(magic, info)):
+            content = self._rendered(magic, full_path, environ,
+                                     dict(headers)['ETag'])
+        return super(Shock, self)._send(environ, start_response, full_path,
+                                        info, headers, content)
+
+    def _streams(self, magic, info):
+        """Check whether the magic should stream the file of info."""
+        return (magic.can_stream and info is not None
+                and info.size > self.stream_threshold)
+
+    def _rendered(self, magic, full_path, environ, etag):
+        """Return the output tagged etag, from the cache or rendered now."""
+        content = self.rendered_cache.get(etag)
+        if content is None:
+            content = self.flights.call(etag, self._render_into_cache,
+                                        magic, full_path, environ, etag)
+        return content
+
+    def _render_into_cache(self, magic, full_path, environ, etag):
+        """Render a magic with environ_keys into the rendered cache."""
+        file_like = magic.file_like(full_path)
+        try:
+            content = b''.join(self._render(
+                magic, magic.render_environ(environ), file_like))
+        finally:
+            file_like.close()
+        self.rendered_cache.set(etag, content, len(content))
+        return content
 
-    def _file_like(self, full_path):
+    def _render(self, magic, environ, file_like):
+        """Return the output of magic for file_like."""
+        return magic.body(environ, file_like)
+
+    def _compressible(self, full_path, info):
+        """Only compress plain files on the fly."""
+        if self._magic(full_path, info) is not None:
+            return False
+        return super(Shock, self)._compressible(full_path, info)
+
+    def _cached_content(self, full_path, info):
+        """Return cached contents for plain files only."""
+        if self._magic(full_path, info) is not None:
+            return None
+        return super(Shock, self)._cached_content(full_path, info)
+
+    def _content_length(self, full_path, info):
+        """Return None for magic files, whose length is not known yet."""
+        if self._magic(full_path, info) is not None:
+            return None
+        return super(Shock, self)._content_length(full_path, info)
+
+    def _file_like(self, full_path, info=None):
         """Return the appropriate file object."""
-        magic = self._match_magic(full_path)
+        magic = self._magic(full_path, info)
         if magic is not None:
             return magic.file_like(full_path)
         else:
             return open(full_path, 'rb')
 
-    def _body(self, full_path, environ, file_like):
+    def _body(self, full_path, environ, file_like, info=None):
         """Return an iterator over the body of the response."""
-        magic = self._match_magic(full_path)
+        magic = self._magic(full_path, info)
         if magic is not None:
-            return magic.body(environ, file_like)
+            if magic.environ_keys is not None:
+                environ = magic.render_environ(environ)
+            if self._streams(magic, info):
+                return magic.stream(environ, file_like, self.block_size)
+            return self._render(magic, environ, file_like)
         else:
-            way_to_send = environ.get('wsgi.file_wrapper', _iter_and_close)
-            return way_to_send(file_like, self.block_size)
+            return super(Shock, self)._body(full_path, environ, file_like,
+                                            info)
 
 
 class BaseMagic(object):
@@ -283,9 +1347,19 @@ class BaseMagic(object):
     (See StringMagic in this module for a simple example of subclassing.)
 
     In a more complex case you may need to override many or all methods.
+
+    A magic whose output depends only on its template file, its
+    variables and the environ keys listed in environ_keys can say so by
+    setting environ_keys. Its responses then get real validators (see
+    validators()) and Shock keeps the rendered output, so repeats are
+    answered without rendering. Only those keys are passed to body().
+    environ_keys of None means the output may depend on anything.
     """
 
     extension = ''
+    environ_keys = None
+    variables = {}
+    can_stream = False
 
     def exists(self, full_path):
         """Check that self.new_path(full_path) exists."""
@@ -310,6 +1384,28 @@ class BaseMagic(object):
         mtime = int(time.time())
         return str(mtime), formatdate(mtime)
 
+    def validators(self, info, environ):
+        """Return Etag and Last-Modified values for a magic with environ_keys.
+
+        The ETag covers the template file, self.variables and the values
+        of environ_keys, so it changes whenever the output can. Last-Modified
+        is the template's mtime.
+        """
+        return (digest_etag(info.full_path, info.mtime, info.size, info.ino,
+                            sorted(self.variables.items()),
+                            [environ.get(key) for key in self.environ_keys]),
+                info.last_modified)
+
+    def request_headers(self):
+        """Return the names of the request headers in environ_keys."""
+        return [key[5:].replace('_', '-').title()
+                for key in self.environ_keys if key.startswith('HTTP_')]
+
+    def render_environ(self, environ):
+        """Return the part of environ a magic with environ_keys may see."""
+        return dict((key, environ[key]) for key in self.environ_keys
+                    if key in environ)
+
     def file_like(self, full_path):
         """Return a file object for path."""
         return open(full_path, 'rb')
@@ -318,19 +1414,95 @@ class BaseMagic(object):
         """Return an iterator over the body of the response."""
         raise NotImplemented
 
+    def stream(self, environ, file_like, chunk_size):  # pragma: no cover
+        """Return an iterator rendering the body about chunk_size at a time.
+
+        Only called if can_stream is true. The iterator closes file_like.
+        """
+        raise NotImplementedError
+
+
+class CompiledTemplate(object):
+    """A string.Template split up front into literals and placeholders.
+
+    safe_substitute() then just joins the pieces, instead of scanning the
+    whole template with a regular expression on every render.
+    """
+
+    def __init__(self, source):
+        self.parts = []
+        position = 0
+        for match in string.Template.pattern.finditer(source):
+            self.parts.append(source[position:match.start()])
+            if match.group('escaped') is not None:
+                self.parts.append(match.group('escaped'))
+            elif match.group('invalid') is not None:
+                self.parts.append(match.group())
+            else:
+                name = match.group('named') or match.group('braced')
+                self.parts.append((name, match.group()))
+            position = match.end()
+        self.parts.append(source[position:])
+
+    def safe_substitute(self, *mappings):
+        """Fill in placeholders from the first mapping that has them.
+
+        Placeholders no mapping has are left as they are.
+        """
+        result = []
+        for part in self.parts:
+            if isinstance(part, tuple):
+                name, original = part
+                for mapping in mappings:
+                    if name in mapping:
+                        part = '%s' % (mapping[name],)
+                        break
+                else:
+                    part = original
+            result.append(part)
+        return ''.join(result)
+
+
+def _placeholder_start(text):
+    """Return where the last placeholder (or '$$') in text could start.
+
+    No placeholder spans a run of '$' that starts there, so text can be
+    cut there. 0 if there is no '$' after the start.
+    """
+    start = text.rfind(u'$')
+    while start > 0 and text[start - 1] == u'$':
+        start -= 1
+    return max(start, 0)
+
 
 class StringMagic(BaseMagic):
     """Magic to replace variables in file contents using string.Template.
 
     Using this requires Python2.4.
+
+    Compiled templates are kept for up to cache_size files, keyed on the
+    path, mtime, size and inode of the template file, so a warm request
+    only costs the substitution. Requests arriving while a template is
+    being compiled wait for it rather than compiling it again.
+
+    Placeholders never span lines, so big files can be streamed a few
+    lines at a time. Lines longer than max_carry characters are cut
+    before a '$' instead, so memory stays bounded.
     """
 
     default_extension = '.stp'
+    can_stream = True
+    max_carry = 64 * 1024
 
-    def __init__(self, extension=None, variables=None):
+    def __init__(self, extension=None, variables=None, cache_size=128,
+                 environ_keys=None):
         """Keyword arguments populate self.variables."""
         self.extension = extension or self.default_extension
         self.variables = variables or {}
+        self.templates = LRUCache(cache_size)
+        self.compiling = SingleFlight()
+        if environ_keys is not None:
+            self.environ_keys = tuple(environ_keys)
 
     def body(self, environ, file_like):
         """Pass environ and self.variables in to template.
@@ -338,20 +1510,92 @@ class StringMagic(BaseMagic):
         self.variables overrides environ so that suprises in environ don't
         cause unexpected output if you are passing a value in explicitly.
         """
-        variables = environ.copy()
-        variables.update(self.variables)
-        template = string.Template(file_like.read().decode('utf-8'))
-        result = template.safe_substitute(variables)
+        template = self.template(file_like)
+        result = template.safe_substitute(self.variables, environ)
         return [result.encode('utf-8')]
 
+    def stream(self, environ, file_like, chunk_size):
+        """Substitute and yield whole lines, about chunk_size bytes at once."""
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        try:
+            rest = u''
+            for block in iter(lambda: file_like.read(chunk_size), b''):
+                text = rest + decoder.decode(block)
+                cut = text.rfind(u'\n') + 1
+                if not cut and len(text) > self.max_carry:
+                    cut = _placeholder_start(text) or len(text)
+                if cut:
+                    yield self._substitute(text[:cut], environ)
+                rest = text[cut:]
+            rest += decoder.decode(b'', True)
+            if rest:
+                yield self._substitute(rest, environ)
+        finally:
+            file_like.close()
+
+    def _substitute(self, chunk, environ):
+        template = CompiledTemplate(chunk)
+        return template.safe_substitute(self.variables,
+                                        environ).encode('utf-8')
+
+    def template(self, file_like):
+        """Return the compiled template read from file_like, maybe cached."""
+        key = self._template_key(file_like)
+        template = None
+        if key is not None:
+            template = self.templates.get(key)
+        if template is None and key is not None:
+            template = self.compiling.call(key, self._compile_into_cache,
+                                           file_like, key)
+        elif template is None:
+            template = self.compile(file_like.read().decode('utf-8'))
+        return template
+
+    def _compile_into_cache(self, file_like, key):
+        template = self.compile(file_like.read().decode('utf-8'))
+        self.templates.set(key, template)
+        return template
+
+    def compile(self, source):
+        """Return the compiled form of the template source."""
+        return CompiledTemplate(source)
+
+    def _template_key(self, file_like):
+        """Return what identifies the version of the template or None."""
+        try:
+            st = fstat(file_like.fileno())
+            return (file_like.name, st.st_mtime, st.st_size, st.st_ino)
+        except (AttributeError, EnvironmentError, ValueError):
+            return None
+
 
 class MoustacheMagic(StringMagic):
-    """Like StringMagic only using Moustache templates."""
+    """Like StringMagic only using Moustache templates.
+
+    Sections can span any number of lines, so these are never streamed.
+    pystache is only imported once one of these is used.
+    """
 
     default_extension = '.mst'
+    can_stream = False
+
+    _renderer = None
+
+    @property
+    def renderer(self):
+        """The pystache.Renderer shared by every render of this magic."""
+        if self._renderer is None:
+            import pystache
+            self._renderer = pystache.Renderer()
+        return self._renderer
 
     def body(self, environ, file_like):
         """Pass environ and **self.variables into the template."""
-        return [pystache.Renderer().render(file_like.read(),
-                                           environ=environ,
-                                           **self.variables).encode('utf-8')]
+        return [self.renderer.render(self.template(file_like),
+                                     environ=environ,
+                                     **self.variables).encode('utf-8')]
+
+    def compile(self, source):
+        """Return the parsed Moustache template."""
+        import pystache
+        return pystache.parse(source)
@@ -0,0 +1,201 @@
+"""Serve files straight out of a zip archive (a zipapp, wheel or egg).
+
+    from static.archive import ArchiveCling, package_cling
+    app = ArchiveCling('assets.zip', prefix='site/')
+    app = package_cling('mypackage', 'static')
+
+The central directory is read once at startup and turned into a
+manifest, so lookups never touch the disk. Stored entries are sent from
+the archive file itself with the entry's offset and length, so they
+are read (or handed to sendfile) like any other file.
+Deflated entries are sent as they are, wrapped as gzip, to clients that
+accept gzip. Other clients get them inflated.
+
+ETags come from each entry's CRC-32 and size.
+"""
+
+import errno
+import mmap
+import struct
+import time
+import zipfile
+import zlib
+
+from static.apps import Cling, FileWrapper
+from static.compression import acceptable, parse_accept_encoding
+from static import manifest as manifests
+
+_LOCAL_HEADER = struct.Struct('<4s22xHH')
+
+# A gzip member header: deflate, no flags, no mtime, unknown OS.
+_GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+class EntryFile(object):
+    """One stored entry of an open archive, read like a file of its own."""
+
+    def __init__(self, file_like, base, size):
+        self.file_like = file_like
+        self.base = base
+        self.size = size
+        self.position = 0
+
+    def seek(self, position, whence=0):
+        if whence == 1:
+            position += self.position
+        elif whence == 2:
+            position += self.size
+        self.position = max(0, position)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        remaining = max(0, self.size - self.position)
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        self.file_like.seek(self.base + self.position)
+        data = self.file_like.read(size)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        self.file_like.close()
+
+
+class ArchiveCling(Cling):
+    """Serve the files in a zip archive (under prefix, if given).
+
+    Takes the same keyword arguments as Cling, except manifest.
+    """
+
+    def __init__(self, archive, prefix='', **kw):
+        super(ArchiveCling, self).__init__(archive, **kw)
+        self.archive = archive
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.zip_file = zipfile.ZipFile(archive)
+        with open(archive, 'rb') as archive_file:
+            self.archive_map = mmap.mmap(archive_file.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+        self.entries = {}
+        self.manifest = manifests.index_manifest(self._index(), self.root)
+
+    def _index(self):
+        """Return manifest rows for the archive, remembering each entry."""
+        rows = {'': ['', True, 0, 0, 0, None]}
+        for entry in self.zip_file.infolist():
+            if not entry.filename.startswith(self.prefix):
+                continue
+            name = entry.filename[len(self.prefix):].rstrip('/')
+            parts = name.split('/')
+            for depth in range(1, len(parts)):
+                directory = '/' + '/'.join(parts[:depth])
+                rows.setdefault(directory, [directory, True, 0, 0, 0, None])
+            if not name or entry.is_dir():
+                if name:
+                    rows.setdefault('/' + name,
+                                    ['/' + name, True, 0, 0, 0, None])
+                continue
+            relative = '/' + name
+            rows[relative] = [
+                relative, False, entry.file_size,
+                time.mktime(entry.date_time + (0, 0, -1)),
+                entry.header_offset, self._guess_type(relative)]
+            self.entries[self.root + relative] = (entry,
+                                                  self._data_offset(entry))
+        return list(rows.values())
+
+    def _data_offset(self, entry):
+        """Return where the data of entry starts in the archive."""
+        offset = entry.header_offset
+        signature, name_length, extra_length = _LOCAL_HEADER.unpack(
+            self.archive_map[offset:offset + _LOCAL_HEADER.size])
+        if signature != b'PK\x03\x04':
+            raise zipfile.BadZipfile('Bad local header for %s'
+                                     % entry.filename)
+        return offset + _LOCAL_HEADER.size + name_length + extra_length
+
+    def _entry(self, full_path):
+        try:
+            return self.entries[full_path]
+        except KeyError:
+            raise OSError(errno.ENOENT, 'Not in the archive', full_path)
+
+    def _stored(self, full_path):
+        entry = self.entries.get(full_path)
+        return entry is not None \
+            and entry[0].compress_type == zipfile.ZIP_STORED
+
+    def _negotiate(self, environ, full_path, info):
+        """Pass deflated entries through as gzip to clients accepting it."""
+        entry = self.entries.get(full_path)
+        if entry is None or entry[0].compress_type != zipfile.ZIP_DEFLATED:
+            return super(ArchiveCling, self)._negotiate(environ, full_path,
+                                                        info)
+        accepted = parse_accept_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+        if acceptable(accepted, 'gzip'):
+            return 'gzip', info, self._gzipped(full_path, info), True
+        coding, info, content, varies = super(
+            ArchiveCling, self)._negotiate(environ, full_path, info)
+        return coding, info, content, True
+
+    def _gzipped(self, full_path, info):
+        """Return a deflated entry as a gzip member, from memory if cached."""
+        key = (full_path, info.mtime, info.size, info.ino, 'zip')
+        content = self.compressed_cache.get(key)
+        if content is None:
+            entry, offset = self._entry(full_path)
+            content = b''.join([
+                _GZIP_HEADER,
+                self.archive_map[offset:offset + entry.compress_size],
+                struct.pack('<II', entry.CRC, entry.file_size & 0xffffffff)])
+            self.compressed_cache.set(key, content, len(content))
+        return content
+
+    def _read(self, full_path, info):
+        """Return the contents of an entry, inflated if need be."""
+        entry, offset = self._entry(full_path)
+        if entry.compress_type == zipfile.ZIP_STORED:
+            return self.archive_map[offset:offset + entry.file_size]
+        if entry.compress_type == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(
+                self.archive_map[offset:offset + entry.compress_size], -15)
+        return self.zip_file.read(entry)
+
+    def _cached_content(self, full_path, info):
+        """Return compressed entries whole; only stored ones are streamed."""
+        content = super(ArchiveCling, self)._cached_content(full_path, info)
+        if content is None and not self._stored(full_path):
+            content = self._read(full_path, info)
+        return content
+
+    def _etag(self, info):
+        entry, offset = self._entry(info.full_path)
+        return '"%08x-%x"' % (entry.CRC, entry.file_size)
+
+    def _file_like(self, full_path, info=None):
+        entry, offset = self._entry(full_path)
+        return EntryFile(open(self.archive, 'rb'), offset, entry.file_size)
+
+    def _body(self, full_path, environ, file_like, info=None):
+        """Send the stored entry's bytes of the archive file."""
+        return FileWrapper(file_like.file_like, self.block_size,
+                           file_like.base, file_like.size)
+
+
+def package_cling(package, directory='', **kw):
+    """Return a Cling for directory in package, zipped or not.
+
+    Packages imported from a zip file (a zipapp, or a zipped egg or
+    wheel) get an ArchiveCling over the archive, so nothing is
+    extracted. Others get a plain Cling on the directory.
+    """
+    from importlib import resources
+    files = resources.files(package)
+    root = getattr(files, 'root', None)
+    if isinstance(root, zipfile.ZipFile):
+        prefix = files.at + directory
+        return ArchiveCling(root.filename, prefix=prefix, **kw)
+    return Cling(str(files.joinpath(directory)) if directory else str(files),
+                 **kw)
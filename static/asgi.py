@@ -0,0 +1,160 @@
+"""ASGI versions of Cling and Shock.
+
+AsyncCling and AsyncShock take the same arguments as Cling and Shock
+(plus max_threads) and answer requests with the very same resolution,
+conditional-request and magic logic. The blocking parts (stat calls,
+opening and reading files, rendering magic) run in a bounded thread
+pool, one short job at a time, so thousands of slow downloads share a
+handful of threads while the event loop waits on the clients. Servers
+offering the http.response.zerocopysend extension are handed the file
+instead.
+
+This module needs Python 3 and is not imported by `import static`:
+
+    from static.asgi import AsyncCling
+    app = AsyncCling('/var/www', metadata_cache_size=10000)
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import io
+import sys
+
+from static.apps import ByteRangesWrapper, Cling, FileWrapper, Shock
+
+_DONE = object()
+
+
+class AsyncCling(object):
+    """Serve static content via ASGI using a Cling.
+
+    The WSGI app doing the work is available as self.app.
+    """
+
+    wsgi_class = Cling
+
+    def __init__(self, *args, **kw):
+        self.max_threads = kw.pop('max_threads', 8)
+        self.app = self.wsgi_class(*args, **kw)
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                self.max_threads, thread_name_prefix='static')
+        return self._executor
+
+    def close(self):
+        """Shut down the thread pool."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError('Cannot handle ASGI %r scopes' % scope['type'])
+        loop = asyncio.get_running_loop()
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+
+        body = await loop.run_in_executor(
+            self.executor, self.app, self._environ(scope), start_response)
+        status, headers = response
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'),
+                             value.encode('latin-1'))
+                            for name, value in headers]})
+            await self._send_body(scope, send, body, loop)
+        finally:
+            close = getattr(body, 'close', None)
+            if close is not None:
+                close()
+
+    async def _send_body(self, scope, send, body, loop):
+        """Send the body iterable, reading files off the event loop."""
+        if isinstance(body, list):
+            await send({'type': 'http.response.body',
+                        'body': b''.join(body)})
+            return
+        extensions = scope.get('extensions') or {}
+        if ('http.response.zerocopysend' in extensions
+                and isinstance(body, FileWrapper)
+                and not isinstance(body, ByteRangesWrapper)):
+            message = {'type': 'http.response.zerocopysend',
+                       'file': body.file_like, 'offset': body.offset}
+            if body.length is not None:
+                message['count'] = body.length
+            await send(message)
+            return
+        blocks = iter(body)
+        try:
+            while True:
+                block = await loop.run_in_executor(self.executor, next,
+                                                   blocks, _DONE)
+                if block is _DONE:
+                    break
+                await send({'type': 'http.response.body', 'body': block,
+                            'more_body': True})
+        finally:
+            close = getattr(blocks, 'close', None)
+            if close is not None:
+                close()
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _environ(self, scope):
+        """Return a WSGI environ for the request described by scope."""
+        root_path = scope.get('root_path', '')
+        path_info = scope['path']
+        if root_path and path_info.startswith(root_path):
+            path_info = path_info[len(root_path):]
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': root_path,
+            'PATH_INFO': path_info,
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False}
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+        for name, value in scope.get('headers', ()):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = 'HTTP_' + name
+            if name in environ:
+                value = environ[name] + ',' + value
+            environ[name] = value
+        return environ
+
+
+class AsyncShock(AsyncCling):
+    """Serve mixed content via ASGI using a Shock."""
+
+    wsgi_class = Shock
@@ -0,0 +1,99 @@
+"""Directory listings for Cling's autoindex mode.
+
+Names and types come from one os.scandir pass (no stat per entry on
+most systems). Only the entries on the page being rendered are stat'ed
+for their size and mtime, so a page of a directory with 50,000 entries
+costs a page's worth of stat calls. Cling caches both the sorted names
+and the rendered pages, keyed on the directory's mtime.
+"""
+
+import json
+import math
+import os
+from os import path
+from email.utils import formatdate
+from html import escape
+from urllib.parse import quote
+
+
+def scan(directory, hidden=False):
+    """Return the sorted (name, is_dir) pairs in directory.
+
+    Directories come first. Names starting with '.' are left out unless
+    hidden is true.
+    """
+    entries = []
+    for entry in os.scandir(directory):
+        if not hidden and entry.name.startswith('.'):
+            continue
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            continue
+        entries.append((not is_dir, entry.name))
+    entries.sort()
+    return [(name, not is_file) for is_file, name in entries]
+
+
+def page_count(entries, page_size):
+    return max(1, int(math.ceil(len(entries) / float(page_size))))
+
+
+def page_rows(directory, entries, page, page_size):
+    """Return (name, is_dir, size, mtime) for the entries on page (from 1).
+
+    Entries that vanished since the scan are skipped.
+    """
+    rows = []
+    for name, is_dir in entries[(page - 1) * page_size:page * page_size]:
+        try:
+            st = os.stat(path.join(directory, name))
+        except OSError:
+            continue
+        rows.append((name, is_dir, None if is_dir else st.st_size,
+                     st.st_mtime))
+    return rows
+
+
+def render_json(request_path, rows, page, pages, total):
+    return json.dumps({
+        'path': request_path,
+        'page': page,
+        'pages': pages,
+        'total': total,
+        'entries': [{'name': name,
+                     'type': 'directory' if is_dir else 'file',
+                     'size': size,
+                     'mtime': mtime}
+                    for name, is_dir, size, mtime in rows]},
+        separators=(',', ':')).encode('utf-8')
+
+
+def render_html(request_path, rows, page, pages, total):
+    title = escape('Index of %s' % request_path)
+    lines = ['<!DOCTYPE html>',
+             '<html><head><meta charset="utf-8"><title>%s</title></head>'
+             % title,
+             '<body><h1>%s</h1>' % title,
+             '<table><tr><th>Name</th><th>Size</th><th>Modified</th></tr>']
+    if request_path != '/':
+        lines.append('<tr><td><a href="../">../</a></td><td></td><td></td>'
+                     '</tr>')
+    for name, is_dir, size, mtime in rows:
+        suffix = '/' if is_dir else ''
+        lines.append('<tr><td><a href="%s%s">%s%s</a></td><td>%s</td>'
+                     '<td>%s</td></tr>'
+                     % (quote(name), suffix, escape(name), suffix,
+                        '-' if size is None else size,
+                        formatdate(mtime, usegmt=True)))
+    lines.append('</table>')
+    if pages > 1:
+        links = []
+        if page > 1:
+            links.append('<a href="?page=%d">Previous</a>' % (page - 1))
+        if page < pages:
+            links.append('<a href="?page=%d">Next</a>' % (page + 1))
+        lines.append('<p>Page %d of %d (%d entries) %s</p>'
+                     % (page, pages, total, ' '.join(links)))
+    lines.append('</body></html>\n')
+    return '\n'.join(lines).encode('utf-8')
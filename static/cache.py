@@ -0,0 +1,137 @@
+"""Small, thread-safe caches used by the apps in static.apps.
+
+(See the docstrings of the various classes.)
+"""
+
+from collections import OrderedDict
+import threading
+
+
+class LRUCache(object):
+    """A bounded mapping that forgets the least recently used entries.
+
+    max_entries caps the number of entries kept and max_bytes, if given,
+    caps the total of the sizes passed to set(). hits and misses count
+    lookups through get() so that the cache can be sized sensibly.
+
+    All operations take a lock, so one instance can be shared between
+    the threads of a threaded WSGI server.
+    """
+
+    def __init__(self, max_entries, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """Return the value for key, marking it as recently used."""
+        with self._lock:
+            try:
+                entry = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size=0):
+        """Store value under key, evicting old entries as needed.
+
+        Values bigger than max_bytes on their own are not stored.
+        """
+        if self.max_entries <= 0:
+            return
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            self._forget(key)
+            self._entries[key] = (value, size)
+            self.bytes += size
+            while (len(self._entries) > self.max_entries
+                   or (self.max_bytes is not None
+                       and self.bytes > self.max_bytes)):
+                self.bytes -= self._entries.popitem(last=False)[1][1]
+
+    def pop(self, key, default=None):
+        """Forget key and return its value (or default)."""
+        with self._lock:
+            entry = self._forget(key)
+            return default if entry is None else entry[0]
+
+    def clear(self):
+        """Forget every entry and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def _forget(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+        return entry
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False
+
+
+class SingleFlight(object):
+    """Run one call at a time per key, sharing its result with the callers
+    that asked for the same key while it ran.
+
+    A caller that has waited timeout seconds, or whose leader raised, runs
+    the function itself, so a stuck call can't hold everyone up. A
+    timeout of 0 turns coalescing off. coalesced counts the calls that
+    got another's result.
+    """
+
+    def __init__(self, timeout=10.0):
+        self.timeout = timeout
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def call(self, key, function, *args):
+        """Return function(*args), or the result of one running for key."""
+        if not self.timeout:
+            return function(*args)
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                leading = True
+            else:
+                leading = False
+        if leading:
+            try:
+                flight.result = function(*args)
+            except BaseException:
+                flight.failed = True
+                raise
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+            return flight.result
+        if flight.done.wait(self.timeout) and not flight.failed:
+            with self._lock:
+                self.coalesced += 1
+            return flight.result
+        return function(*args)
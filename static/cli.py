@@ -1,13 +1,202 @@
+import argparse
 import sys
+import time
 
+from static import access
 from static import Cling
+from static import compression
+from static import manifest as manifests
 
 
-def run():
-    host, port, directory = sys.argv[1:4]
-    app = Cling(directory)
+def serve(argv):
+    """Serve a directory: static [options] <host> <port> <directory>"""
+    parser = argparse.ArgumentParser(prog='static')
+    parser.add_argument('host')
+    parser.add_argument('port', type=int)
+    parser.add_argument('directory')
+    parser.add_argument('--manifest',
+                        help='serve from a manifest built by '
+                             '`static manifest`')
+    server = parser.add_argument_group(
+        'production server',
+        'Give --workers to serve with forked worker processes, each '
+        'with a thread pool and keep-alive. Send the server TERM or INT '
+        'to stop gracefully, or HUP to replace the workers.')
+    server.add_argument('--workers', type=int, default=0,
+                        help='worker processes (0 means the single '
+                             'threaded wsgiref server, the default)')
+    server.add_argument('--threads', type=int, default=8,
+                        help='threads per worker (default: %(default)s)')
+    server.add_argument('--backlog', type=int, default=1024)
+    server.add_argument('--reuse-port', action='store_true',
+                        help='give each worker its own SO_REUSEPORT '
+                             'socket instead of sharing one')
+    server.add_argument('--keep-alive', type=float, default=5.0,
+                        help='seconds to keep idle connections open '
+                             '(default: %(default)s)')
+    server.add_argument('--graceful-timeout', type=float, default=30.0,
+                        help='seconds to let requests finish when '
+                             'stopping (default: %(default)s)')
+    server.add_argument('--access-log', metavar='FILE', nargs='?',
+                        const='-',
+                        help='log every request to FILE (or stderr)')
+    server.add_argument('--access-log-format', default='combined',
+                        choices=access.FORMATS)
+    cling = parser.add_argument_group('Cling options')
+    cling.add_argument('--block-size', type=int, default=16 * 4096)
+    cling.add_argument('--index-file', default='index.html')
+    cling.add_argument('--metadata-cache-size', type=int, default=0,
+                       help='paths whose metadata is kept in memory')
+    cling.add_argument('--metadata-ttl', type=float, default=1.0,
+                       help='seconds before cached metadata is rechecked')
+    cling.add_argument('--negative-cache-size', type=int, default=0,
+                       help='missing paths remembered as missing')
+    cling.add_argument('--content-cache-bytes', type=int, default=0,
+                       help='memory for the contents of small files')
+    cling.add_argument('--shared-cache', action='store_true',
+                       help='with --workers, keep the content and '
+                            'compressed caches in memory shared by all '
+                            'workers')
+    cling.add_argument('--compress', action='store_true',
+                       help='compress text files on the fly')
+    cling.add_argument('--precompressed', default='gzip',
+                       help='comma separated content-codings whose '
+                            'siblings (written by `static compress`) '
+                            'are served, most preferred first '
+                            '(default: %(default)s)')
+    cling.add_argument('--image-variants', action='store_true',
+                       help='serve .avif/.webp siblings of images to '
+                            'clients that accept them')
+    cling.add_argument('--etags', choices=('mtime', 'hash'),
+                       default='mtime')
+    cling.add_argument('--metrics-path',
+                       help='serve Prometheus metrics at this path')
+    cling.add_argument('--autoindex', action='store_true',
+                       help='list directories without an index file')
+    args = parser.parse_args(argv)
+    precompressed = [coding.strip() for coding
+                     in args.precompressed.split(',') if coding.strip()]
+    for coding in precompressed:
+        if coding not in compression.EXTENSIONS:
+            parser.error('%s is not a known content-coding (know: %s)'
+                         % (coding, ', '.join(sorted(
+                             compression.EXTENSIONS))))
+    shared = {}
+    if args.shared_cache and args.workers:
+        shared = shared_caches(args.content_cache_bytes, args.compress)
+
+    def app_factory():
+        access_log = None
+        if args.access_log:
+            access_log = access.AccessLog(
+                None if args.access_log == '-' else args.access_log,
+                args.access_log_format)
+        return Cling(args.directory, manifest=args.manifest,
+                     block_size=args.block_size,
+                     index_file=args.index_file,
+                     metadata_cache_size=args.metadata_cache_size,
+                     metadata_ttl=args.metadata_ttl,
+                     negative_cache_size=args.negative_cache_size,
+                     content_cache_bytes=args.content_cache_bytes,
+                     compress=args.compress,
+                     precompressed=precompressed,
+                     etags=args.etags,
+                     metrics_path=args.metrics_path,
+                     autoindex=args.autoindex,
+                     access_log=access_log,
+                     image_variants=(('image/avif', 'image/webp')
+                                     if args.image_variants else ()),
+                     **shared)
+    if args.workers:
+        from static.server import PreforkServer
+        PreforkServer(app_factory, args.host, args.port, args.workers,
+                      args.threads, args.backlog, args.reuse_port,
+                      args.keep_alive, args.graceful_timeout).run()
+        return
     try:
         from wsgiref.simple_server import make_server
-        make_server(host, int(port), app).serve_forever()
+        make_server(args.host, args.port, app_factory()).serve_forever()
     except KeyboardInterrupt:
         print("Cio, baby!")
+
+
+def shared_caches(content_cache_bytes, compress,
+                  compressed_cache_bytes=16 * 1024 * 1024):
+    """Return Cling keyword arguments for caches shared by forked workers.
+
+    They are in anonymous memory: workers inherit the mappings, and no
+    other process can open them.
+    """
+    from static.shared import SharedCache
+    caches = {}
+    for name, size in (('content_cache', content_cache_bytes),
+                       ('compressed_cache',
+                        compressed_cache_bytes if compress else 0)):
+        if size:
+            caches[name] = SharedCache(None, size)
+    return caches
+
+
+def manifest(argv):
+    """Write a manifest: static manifest <directory> <output>"""
+    parser = argparse.ArgumentParser(
+        prog='static manifest',
+        description='Record the metadata of every file under directory so '
+                    'Cling can serve it without stat calls.')
+    parser.add_argument('directory')
+    parser.add_argument('output')
+    parser.add_argument('--hash', action='store_true',
+                        help='record content hashes for etags=hash')
+    args = parser.parse_args(argv)
+    started = time.time()
+    rows = manifests.build_manifest(args.directory, hashes=args.hash)
+    manifests.write_manifest(rows, args.output)
+    print("Wrote %d entries to %s in %.2fs"
+          % (len(rows), args.output, time.time() - started))
+
+
+def compress(argv):
+    """Precompress a tree: static compress [options] <directory>"""
+    parser = argparse.ArgumentParser(
+        prog='static compress',
+        description='Write .gz (and .br/.zst if brotli/zstandard are '
+                    'installed) siblings of the compressible files under '
+                    'directory, for Cling to serve.')
+    parser.add_argument('directory')
+    parser.add_argument('--encodings', default=','.join(compression.AVAILABLE),
+                        help='comma separated content-codings to write '
+                             '(default: %(default)s)')
+    parser.add_argument('--min-saving', type=float, default=0.05,
+                        help='drop siblings that are not at least this '
+                             'fraction smaller (default: %(default)s)')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes (default: one per CPU)')
+    parser.add_argument('--force', action='store_true',
+                        help='rewrite siblings even if they are up to date')
+    args = parser.parse_args(argv)
+    codings = [coding.strip() for coding in args.encodings.split(',')]
+    for coding in codings:
+        if coding not in compression.AVAILABLE:
+            parser.error('%s is not available (have: %s)'
+                         % (coding, ', '.join(compression.AVAILABLE)))
+    started = time.time()
+    totals = compression.precompress_tree(
+        args.directory, codings, args.min_saving, args.processes,
+        args.force)
+    elapsed = max(time.time() - started, 1e-6)
+    print("Compressed %(files)d files into %(siblings)d siblings: "
+          "read %(bytes_read)d bytes, wrote %(bytes_written)d, "
+          "saved %(bytes_saved)d" % totals)
+    print("%.2fs, %.1f MB/s" % (elapsed,
+                                totals['bytes_read'] / elapsed / 1e6))
+
+
+COMMANDS = {'compress': compress, 'manifest': manifest}
+
+
+def run(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+    return serve(argv)
@@ -0,0 +1,224 @@
+"""Content-coding negotiation and the encoders static can use.
+
+gzip is always available. br needs the brotli package and zstd the
+zstandard package; they are left out of ENCODERS when not installed,
+and only imported once something is compressed with them.
+"""
+
+import gzip
+from importlib.util import find_spec
+import io
+import mimetypes
+import os
+from os import path
+
+
+def _gzip(data, level=6):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level,
+                       mtime=0) as gz:
+        gz.write(data)
+    return buf.getvalue()
+
+
+def _brotli(data, level=5):
+    import brotli
+    return brotli.compress(data, quality=level)
+
+
+def _zstd(data, level=3):
+    import zstandard
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+# In order of preference when the client likes several equally.
+ENCODERS = [('br', _brotli), ('zstd', _zstd), ('gzip', _gzip)]
+_MODULES = {'br': 'brotli', 'zstd': 'zstandard'}
+ENCODERS = [(coding, encoder) for coding, encoder in ENCODERS
+            if coding not in _MODULES or find_spec(_MODULES[coding])]
+
+AVAILABLE = tuple(coding for coding, encoder in ENCODERS)
+
+EXTENSIONS = {'gzip': '.gz', 'br': '.br', 'zstd': '.zst'}
+
+# Levels worth paying for when compressing ahead of time.
+BEST_LEVELS = {'gzip': 9, 'br': 11, 'zstd': 19}
+
+COMPRESSIBLE_TYPES = frozenset([
+    'application/javascript',
+    'application/json',
+    'application/manifest+json',
+    'application/rss+xml',
+    'application/atom+xml',
+    'application/wasm',
+    'application/xhtml+xml',
+    'application/xml',
+    'font/otf',
+    'font/ttf',
+    'image/bmp',
+    'image/svg+xml',
+    'image/x-icon',
+    'image/vnd.microsoft.icon'])
+
+
+def compress(data, coding, level=None):
+    """Return data compressed with the named content-coding."""
+    encoder = dict(ENCODERS)[coding]
+    if level is None:
+        return encoder(data)
+    return encoder(data, level)
+
+
+def is_compressible(content_type):
+    """Check whether content of this type is worth compressing."""
+    return (content_type.startswith('text/')
+            or content_type in COMPRESSIBLE_TYPES)
+
+
+def parse_accept_encoding(header):
+    """Return a dict of content-coding to q-value from Accept-Encoding."""
+    accepted = parse_qvalues(header)
+    if 'x-gzip' in accepted:
+        accepted.setdefault('gzip', accepted.pop('x-gzip'))
+    return accepted
+
+
+def parse_qvalues(header):
+    """Return a dict of (lowercased) item to q-value from an Accept-* header.
+
+    Media type parameters other than q are dropped.
+    """
+    accepted = {}
+    if not header:
+        return accepted
+    for item in header.split(','):
+        token, _, params = item.partition(';')
+        token = token.strip().lower()
+        if not token:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[token] = q
+    return accepted
+
+
+def acceptable(accepted, coding):
+    """Check whether the parsed Accept-Encoding allows coding."""
+    if coding in accepted:
+        return accepted[coding] > 0
+    return accepted.get('*', 0) > 0
+
+
+def choose_encoding(accepted, codings):
+    """Return the coding from codings the client likes best, or None.
+
+    Ties go to the earlier coding in codings.
+    """
+    best, best_q = None, 0
+    for coding in codings:
+        q = accepted.get(coding, accepted.get('*', 0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def compressible_files(root):
+    """Yield the paths of the files under root worth precompressing.
+
+    Files of unknown or incompressible types are skipped, and so are
+    precompressed siblings themselves.
+    """
+    extensions = tuple(EXTENSIONS.values())
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            if name.endswith(extensions):
+                continue
+            content_type = mimetypes.guess_type(name)[0]
+            if content_type and is_compressible(content_type):
+                yield path.join(dirpath, name)
+
+
+def precompress_file(job):
+    """Write the precompressed siblings of one file.
+
+    job is (source, codings, min_saving, force). A sibling is left alone
+    if it is newer than source (unless force), and is not written (and
+    any stale one is removed) unless it is at least min_saving (a
+    fraction) smaller than source.
+
+    Return (bytes read, bytes written, bytes saved, siblings written).
+    """
+    source, codings, min_saving, force = job
+    try:
+        source_stat = os.stat(source)
+        data = None
+        read = written = saved = count = 0
+        for coding in codings:
+            target = source + EXTENSIONS[coding]
+            if not force and path.exists(target) \
+                    and os.stat(target).st_mtime >= source_stat.st_mtime:
+                continue
+            if data is None:
+                with open(source, 'rb') as source_file:
+                    data = source_file.read()
+                read = len(data)
+            compressed = compress(data, coding, BEST_LEVELS[coding])
+            if len(compressed) > len(data) * (1 - min_saving):
+                if path.exists(target):
+                    os.remove(target)
+                continue
+            _write_atomically(target, compressed, source_stat.st_mode)
+            written += len(compressed)
+            saved += len(data) - len(compressed)
+            count += 1
+        return read, written, saved, count
+    except (IOError, OSError):
+        return 0, 0, 0, 0
+
+
+def _write_atomically(target, data, mode):
+    import tempfile
+    fd, temp_path = tempfile.mkstemp(dir=path.dirname(target) or '.',
+                                     prefix='.static-')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(data)
+        os.chmod(temp_path, mode & 0o777)
+        os.rename(temp_path, target)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+def precompress_tree(root, codings=AVAILABLE, min_saving=0.05,
+                     processes=None, force=False):
+    """Write precompressed siblings for the files under root in parallel.
+
+    Return a dict of totals: files, bytes_read, bytes_written,
+    bytes_saved and siblings.
+    """
+    jobs = ((source, tuple(codings), min_saving, force)
+            for source in compressible_files(root))
+    totals = dict(files=0, bytes_read=0, bytes_written=0, bytes_saved=0,
+                  siblings=0)
+    # Only needed by `static compress`, so not imported with the apps.
+    import multiprocessing
+    pool = multiprocessing.Pool(processes)
+    try:
+        for read, written, saved, count in pool.imap_unordered(
+                precompress_file, jobs, chunksize=16):
+            totals['files'] += 1
+            totals['bytes_read'] += read
+            totals['bytes_written'] += written
+            totals['bytes_saved'] += saved
+            totals['siblings'] += count
+    finally:
+        pool.close()
+        pool.join()
+    return totals
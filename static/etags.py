@@ -0,0 +1,108 @@
+"""Content-hash entity tags and If-None-Match/If-Range comparison.
+
+(See the docstrings of the various functions and classes.)
+"""
+
+import hashlib
+import threading
+
+if hasattr(hashlib, 'blake2b'):
+    def _new_hash():
+        return hashlib.blake2b(digest_size=16)
+else:  # pragma: no cover
+    def _new_hash():
+        return hashlib.sha256()
+
+
+def content_hash(full_path, block_size=16 * 4096):
+    """Return a hex digest of the contents of the file at full_path."""
+    digest = _new_hash()
+    with open(full_path, 'rb') as file_like:
+        for block in iter(lambda: file_like.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def digest_etag(*parts):
+    """Return a strong ETag hashing the repr of parts."""
+    digest = _new_hash()
+    digest.update(repr(parts).encode('utf-8'))
+    return '"%s"' % digest.hexdigest()
+
+
+def parse_etags(header):
+    """Return the entity tags listed in an If-None-Match style header.
+
+    '*' comes back as ['*']. Weak tags keep their W/ prefix.
+    """
+    return [tag.strip() for tag in header.split(',') if tag.strip()]
+
+
+def is_weak(tag):
+    return tag.startswith('W/')
+
+
+def _opaque(tag):
+    return tag[2:] if is_weak(tag) else tag
+
+
+def etag_matches(etag, header, weak=True):
+    """Check whether etag is among the tags listed in header.
+
+    Use weak comparison (as If-None-Match does) unless weak is false, in
+    which case a weak tag on either side never matches (as for If-Range).
+    """
+    for tag in parse_etags(header):
+        if tag == '*':
+            return True
+        if weak:
+            if _opaque(tag) == _opaque(etag):
+                return True
+        elif not is_weak(tag) and not is_weak(etag) and tag == etag:
+            return True
+    return False
+
+
+def variant_etag(etag, suffix):
+    """Return the ETag of an encoded variant of the entity tagged etag."""
+    if etag.endswith('"'):
+        return '%s-%s"' % (etag[:-1], suffix)
+    return '%s-%s' % (etag, suffix)
+
+
+class HashStore(object):
+    """Content hashes kept on disk, so a restart doesn't rehash.
+
+    Hashes are keyed by (inode, size, mtime) and appended, one per line,
+    to the file at store_path as they are computed.
+    """
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Return a dict of every (inode, size, mtime) to hash stored."""
+        hashes = {}
+        try:
+            with open(self.store_path) as store:
+                for line in store:
+                    fields = line.split()
+                    if len(fields) != 4:
+                        continue
+                    ino, size, mtime, digest = fields
+                    try:
+                        hashes[(int(ino), int(size), float(mtime))] = digest
+                    except ValueError:
+                        continue
+        except (IOError, OSError):
+            pass
+        return hashes
+
+    def add(self, key, digest):
+        """Append the hash for key to the store."""
+        ino, size, mtime = key
+        line = '%d %d %r %s\n' % (ino, size, mtime, digest)
+        with self._lock:
+            with open(self.store_path, 'a') as store:
+                store.write(line)
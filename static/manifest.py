@@ -0,0 +1,79 @@
+"""Frozen manifests: the metadata of a whole tree, gathered up front.
+
+A manifest records every file and directory under a root with what
+Cling needs to serve it (size, mtime, inode and mime type), so a Cling
+given a manifest answers lookups from a dict without touching the disk.
+
+Build one ahead of time with `static manifest <dir> <output>` or pass
+manifest=True to Cling to walk the tree at startup.
+"""
+
+import json
+import mimetypes
+import os
+from os import path
+
+from static.etags import content_hash
+
+MANIFEST_VERSION = 1
+
+
+def _guess_type(full_path):
+    return mimetypes.guess_type(full_path)[0] or 'text/plain'
+
+
+def build_manifest(root, guess_type=_guess_type, hashes=False):
+    """Walk root and return a list of manifest rows.
+
+    Each row is [relative_path, is_dir, size, mtime, inode, content_type]
+    where relative_path is '' for the root and otherwise starts with '/'.
+    With hashes, file rows also get the content hash used for ETags when
+    Cling has etags='hash'.
+    Symlinks are followed, just as Cling follows them when serving.
+    """
+    rows = []
+    base = root.rstrip(os.sep)
+    for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+        relative_dir = dirpath[len(base):].replace(os.sep, '/').rstrip('/')
+        st = os.stat(dirpath)
+        rows.append([relative_dir, True, st.st_size, st.st_mtime, st.st_ino,
+                     None])
+        for name in filenames:
+            full_path = path.join(dirpath, name)
+            try:
+                st = os.stat(full_path)
+                row = [relative_dir + '/' + name, False, st.st_size,
+                       st.st_mtime, st.st_ino, guess_type(full_path)]
+                if hashes:
+                    row.append(content_hash(full_path))
+            except (IOError, OSError):
+                continue
+            rows.append(row)
+    return rows
+
+
+def write_manifest(rows, output):
+    """Write manifest rows to the file named output."""
+    with open(output, 'w') as manifest_file:
+        json.dump({'version': MANIFEST_VERSION, 'entries': rows},
+                  manifest_file, separators=(',', ':'))
+
+
+def read_manifest(manifest_path):
+    """Return the rows stored in the manifest file at manifest_path."""
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError('Unsupported manifest version in %s: %r'
+                         % (manifest_path, manifest.get('version')))
+    return manifest['entries']
+
+
+def index_manifest(rows, root):
+    """Return a dict of full path (as Cling builds it) to manifest row.
+
+    Directories are indexed both with and without a trailing slash.
+    """
+    index = dict((root + row[0], row) for row in rows)
+    index.update((root + row[0] + '/', row) for row in rows if row[1])
+    return index
@@ -0,0 +1,287 @@
+"""Instrumentation hooks for Cling and built-in Prometheus metrics.
+
+Give Cling an Instrument (or subclass) as instrument and it calls:
+
+- timing(event, seconds) after path resolution ('resolve'), stat
+  calls ('stat'), opening files ('open'), rendering magic ('render')
+  and iterating streamed bodies ('body')
+- response(environ, status, bytes_sent, seconds) once per response
+
+Without an instrument none of this is set up, so it costs nothing.
+
+Metrics is an Instrument keeping counters and histograms, which Cling
+serves in the Prometheus text format at metrics_path:
+
+    app = Cling('/var/www', metrics_path='/_metrics')
+"""
+
+import bisect
+import threading
+import time
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# Seconds, for operations taking microseconds up to whole downloads.
+BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05,
+           0.1, 0.5, 1.0, 5.0)
+
+# Cling attributes holding an LRUCache, by the label they are shown as.
+CACHES = (('metadata', 'metadata_cache'),
+          ('missing', 'missing_cache'),
+          ('content', 'content_cache'),
+          ('compressed', 'compressed_cache'),
+          ('sibling', 'sibling_cache'),
+          ('hash', 'hash_cache'),
+          ('rendered', 'rendered_cache'),
+          ('listing', 'listing_cache'))
+
+
+class Instrument(object):
+    """Hooks called by an instrumented Cling. These ones do nothing.
+
+    Set times_operations to False in instruments that ignore timing(),
+    so the operations aren't timed for nothing.
+    """
+
+    times_operations = True
+
+    def timing(self, event, seconds):
+        """Called with the time one operation took."""
+
+    def response(self, environ, status, bytes_sent, seconds):
+        """Called when a response is done, with its status line."""
+
+
+class Instruments(Instrument):
+    """Pass the hooks on to several instruments.
+
+    Metrics are served from the first of them with an exposition().
+    """
+
+    def __init__(self, *instruments):
+        self.instruments = instruments
+        self.times_operations = any(
+            getattr(instrument, 'times_operations', True)
+            for instrument in instruments)
+
+    def timing(self, event, seconds):
+        for instrument in self.instruments:
+            instrument.timing(event, seconds)
+
+    def response(self, environ, status, bytes_sent, seconds):
+        for instrument in self.instruments:
+            instrument.response(environ, status, bytes_sent, seconds)
+
+    def exposition(self, app=None):
+        for instrument in self.instruments:
+            if hasattr(instrument, 'exposition'):
+                return instrument.exposition(app)
+        return ''
+
+
+def timed(instrument, event, function):
+    """Return function reporting how long each call takes to instrument."""
+    def call(*args, **kw):
+        started = timer()
+        try:
+            return function(*args, **kw)
+        finally:
+            instrument.timing(event, timer() - started)
+    return call
+
+
+class MeteredBody(object):
+    """Wrap a streamed body to count its bytes and time its iteration."""
+
+    def __init__(self, body, instrument, environ, status, started):
+        self.body = body
+        self.instrument = instrument
+        self.environ = environ
+        self.status = status
+        self.started = started
+        self.bytes_sent = 0
+        self.seconds = 0.0
+
+    def __iter__(self):
+        blocks = iter(self.body)
+        while True:
+            started = timer()
+            try:
+                block = next(blocks)
+            except StopIteration:
+                return
+            finally:
+                self.seconds += timer() - started
+            self.bytes_sent += len(block)
+            yield block
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.instrument.timing('body', self.seconds)
+            self.instrument.response(self.environ, self.status,
+                                     self.bytes_sent, timer() - self.started)
+
+
+class MeteredFile(object):
+    """Report a file body's response once the server closes the body.
+
+    The body is left to the server as it is, so the server can still
+    tell it is its wsgi.file_wrapper, or find its fileno(), and use
+    sendfile(): only its close() is replaced. The bytes sent are how far
+    the file's position moved, as both reading and sendfile() move it.
+    """
+
+    def __init__(self, body, instrument, environ, status, started, length):
+        self.file_like = getattr(body, 'filelike',
+                                 getattr(body, 'file_like', None))
+        self.close_body = body.close
+        self.instrument = instrument
+        self.environ = environ
+        self.status = status
+        self.started = started
+        self.length = length
+        self.start = self._position()
+        body.close = self.close
+
+    def _position(self):
+        try:
+            return self.file_like.tell()
+        except (AttributeError, OSError, ValueError):
+            return None
+
+    def close(self):
+        if self.close_body is None:
+            return
+        end = self._position()
+        close_body, self.close_body = self.close_body, None
+        try:
+            close_body()
+        finally:
+            if self.start is None or end is None:
+                bytes_sent = self.length
+            else:
+                bytes_sent = end - self.start
+            self.instrument.response(self.environ, self.status, bytes_sent,
+                                     timer() - self.started)
+
+
+class Histogram(object):
+    """Counts of observations by bucket, with their sum."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels=''):
+        """Return the exposition lines, labels being like 'a="b",'."""
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            lines.append('%s_bucket{%sle="%s"} %d'
+                         % (name, labels, bound, total))
+        labels = labels.rstrip(',')
+        labels = '{%s}' % labels if labels else ''
+        lines.append('%s_sum%s %r' % (name, labels, self.sum))
+        lines.append('%s_count%s %d' % (name, labels, total))
+        return lines
+
+
+class Metrics(Instrument):
+    """Counters and histograms of what Cling does, for Prometheus.
+
+    Responses are counted by status along with the bytes sent; each
+    instrumented operation and each whole response gets a latency
+    histogram. Cache hit rates are read from the app's caches when the
+    metrics are rendered, so they cost nothing per request.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.statuses = {}
+        self.bytes_sent = 0
+        self.operations = {}
+        self.responses = Histogram(buckets)
+        self._lock = threading.Lock()
+
+    def timing(self, event, seconds):
+        with self._lock:
+            histogram = self.operations.get(event)
+            if histogram is None:
+                histogram = self.operations[event] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def response(self, environ, status, bytes_sent, seconds):
+        code = status[:3]
+        with self._lock:
+            self.statuses[code] = self.statuses.get(code, 0) + 1
+            self.bytes_sent += bytes_sent
+            self.responses.observe(seconds)
+
+    def exposition(self, app=None):
+        """Return the metrics (and app's cache stats) as Prometheus text."""
+        with self._lock:
+            lines = [
+                '# HELP static_requests_total Responses by status code.',
+                '# TYPE static_requests_total counter']
+            for code, count in sorted(self.statuses.items()):
+                lines.append('static_requests_total{status="%s"} %d'
+                             % (code, count))
+            requests = sum(self.statuses.values())
+            lines.extend([
+                '# HELP static_bytes_sent_total Body bytes sent.',
+                '# TYPE static_bytes_sent_total counter',
+                'static_bytes_sent_total %d' % self.bytes_sent,
+                '# HELP static_not_modified_ratio Share of responses that '
+                'were 304 Not Modified.',
+                '# TYPE static_not_modified_ratio gauge',
+                'static_not_modified_ratio %r'
+                % (float(self.statuses.get('304', 0)) / requests
+                   if requests else 0.0),
+                '# HELP static_operation_seconds Time taken by resolve, '
+                'stat, open, render and body.',
+                '# TYPE static_operation_seconds histogram'])
+            for event, histogram in sorted(self.operations.items()):
+                lines.extend(histogram.lines('static_operation_seconds',
+                                             'event="%s",' % event))
+            lines.extend([
+                '# HELP static_response_seconds Time taken by responses.',
+                '# TYPE static_response_seconds histogram'])
+            lines.extend(self.responses.lines('static_response_seconds'))
+        if app is not None:
+            lines.extend(self._cache_lines(app))
+        if getattr(app, 'flights', None) is not None:
+            lines.extend([
+                '# HELP static_coalesced_total Cache fills shared with '
+                'concurrent requests instead of being redone.',
+                '# TYPE static_coalesced_total counter',
+                'static_coalesced_total %d' % app.flights.coalesced])
+        return '\n'.join(lines) + '\n'
+
+    def _cache_lines(self, app):
+        caches = [(label, getattr(app, attribute))
+                  for label, attribute in CACHES
+                  if getattr(app, attribute, None) is not None]
+        lines = []
+        for name, kind, help_text, value in (
+                ('static_cache_hits_total', 'counter', 'Cache hits.',
+                 lambda cache: cache.hits),
+                ('static_cache_misses_total', 'counter', 'Cache misses.',
+                 lambda cache: cache.misses),
+                ('static_cache_entries', 'gauge', 'Entries cached.', len),
+                ('static_cache_bytes', 'gauge', 'Bytes cached.',
+                 lambda cache: cache.bytes)):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for label, cache in caches:
+                lines.append('%s{cache="%s"} %d'
+                             % (name, label, value(cache)))
+        return lines
@@ -0,0 +1,112 @@
+"""Cache-Control policies for Cling.
+
+A CachePolicy maps request paths to Cache-Control header values:
+
+    policy = CachePolicy([CacheRule(prefix='/api-docs/', no_cache=True),
+                          CacheRule(extension='.html', max_age=60),
+                          CacheRule(glob='/images/*', max_age=86400,
+                                    stale_while_revalidate=3600)],
+                         default=CacheRule(max_age=300))
+    app = Cling('/var/www', cache_policy=policy)
+
+Fingerprinted file names like app.3f9a1c.js change whenever their
+content does, so those no rule matches get a year of immutable caching.
+"""
+
+from fnmatch import fnmatchcase
+import re
+
+from static.cache import LRUCache
+
+ONE_YEAR = 365 * 24 * 60 * 60
+
+# Hex before the extension: 8 or more digits, or 6 or 7 with both
+# numbers and letters, so words like 'facade' don't count.
+FINGERPRINT = re.compile(r'[.-](?:[0-9a-f]{8,64}'
+                         r'|(?=[0-9a-f]*[0-9])(?=[0-9a-f]*[a-f])[0-9a-f]{6,7})'
+                         r'\.[^./]+$')
+
+
+class CacheRule(object):
+    """Paths matching this rule get one Cache-Control value.
+
+    Match by any of glob (fnmatch style, against the whole path),
+    extension (like '.css') or prefix (like '/static/'); a rule with none
+    of them matches everything. The rest of the arguments make up the
+    header value, which is built once, here.
+    """
+
+    def __init__(self, glob=None, extension=None, prefix=None,
+                 max_age=None, immutable=False, no_cache=False,
+                 no_store=False, private=False,
+                 stale_while_revalidate=None):
+        self.glob = glob
+        self.extension = extension
+        self.prefix = prefix
+        directives = []
+        if no_store:
+            directives.append('no-store')
+        else:
+            if no_cache:
+                directives.append('no-cache')
+            directives.append('private' if private else 'public')
+        if max_age is not None:
+            directives.append('max-age=%d' % max_age)
+        if stale_while_revalidate is not None:
+            directives.append(
+                'stale-while-revalidate=%d' % stale_while_revalidate)
+        if immutable:
+            directives.append('immutable')
+        self.headers = [('Cache-Control', ', '.join(directives))]
+
+    def matches(self, request_path):
+        """Check whether the rule applies to request_path."""
+        if self.prefix is not None \
+                and not request_path.startswith(self.prefix):
+            return False
+        if self.extension is not None \
+                and not request_path.endswith(self.extension):
+            return False
+        if self.glob is not None and not fnmatchcase(request_path,
+                                                     self.glob):
+            return False
+        return True
+
+
+class CachePolicy(object):
+    """Choose the caching headers for each request path.
+
+    The first matching rule wins, then fingerprinted paths (see
+    FINGERPRINT, or pass fingerprint=None to turn that off) get the
+    fingerprinted rule, then default (None means no header). Decisions
+    are remembered for up to cache_size paths, so the hot path is a
+    lookup.
+    """
+
+    def __init__(self, rules=(), default=None, fingerprint=FINGERPRINT,
+                 fingerprinted=None, cache_size=10000):
+        self.rules = list(rules)
+        self.default = default
+        self.fingerprint = fingerprint
+        self.fingerprinted = fingerprinted or CacheRule(max_age=ONE_YEAR,
+                                                        immutable=True)
+        self._decisions = LRUCache(cache_size)
+
+    def headers(self, request_path):
+        """Return the list of caching headers for request_path."""
+        headers = self._decisions.get(request_path)
+        if headers is None:
+            rule = self.rule(request_path)
+            headers = rule.headers if rule is not None else []
+            self._decisions.set(request_path, headers)
+        return headers
+
+    def rule(self, request_path):
+        """Return the CacheRule for request_path, or None."""
+        for rule in self.rules:
+            if rule.matches(request_path):
+                return rule
+        if self.fingerprint is not None \
+                and self.fingerprint.search(request_path):
+            return self.fingerprinted
+        return self.default
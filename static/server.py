@@ -0,0 +1,469 @@
+"""A prefork HTTP/1.1 server for running Cling in production.
+
+    from static.server import PreforkServer
+    PreforkServer(lambda: Cling('/var/www'), '0.0.0.0', 8080,
+                  workers=4).run()
+
+The parent process binds the listening socket and forks workers that
+inherit it. With reuse_port, each worker binds its own SO_REUSEPORT
+socket instead, and the kernel spreads connections between them.
+Every worker builds its own app by calling the factory. It answers
+requests from a pool of threads and keeps connections alive when the
+response length is known. File bodies are sent with sendfile.
+
+Signals to the parent:
+
+- TERM or INT: stop accepting, finish the requests in flight, then exit.
+- HUP: start a fresh set of workers, then retire the old ones the same
+  way. This picks up changes to manifests, for instance.
+
+Workers that die are replaced. This needs os.fork, so POSIX only.
+"""
+
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import os
+import selectors
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from wsgiref import simple_server
+
+
+class ServerHandler(simple_server.ServerHandler):
+    """Speak HTTP/1.1, closing only when the length is unknown."""
+
+    http_version = '1.1'
+
+    def start_response(self, status, headers, exc_info=None):
+        # Headers are added below; keep them out of the app's own list.
+        return simple_server.ServerHandler.start_response(
+            self, status, list(headers), exc_info)
+
+    def cleanup_headers(self):
+        simple_server.ServerHandler.cleanup_headers(self)
+        if 'Content-Length' not in self.headers \
+                or self.request_handler.server.stopping:
+            self.request_handler.close_connection = True
+        if self.request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+        elif self.request_handler.request_version == 'HTTP/1.0':
+            self.headers['Connection'] = 'keep-alive'
+
+    def sendfile(self):
+        """Send a wsgi.file_wrapper body with socket.sendfile."""
+        file_like = self.result.filelike
+        try:
+            file_like.fileno()
+        except (AttributeError, OSError, ValueError):
+            return False
+        if not self.headers_sent:
+            self.send_headers()
+        self._flush()
+        # Never past Content-Length, even if the file grew since.
+        count = self.headers.get('Content-Length')
+        self.bytes_sent += self.request_handler.connection.sendfile(
+            file_like, count=None if count is None else int(count))
+        return True
+
+
+class BodyReader(object):
+    """wsgi.input reading no further than the request's Content-Length."""
+
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.readline(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b''))
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def drain(self, limit):
+        """Discard the unread body. Return False if it is over limit."""
+        if self.remaining > limit:
+            return False
+        while self.remaining:
+            if not self.read(min(self.remaining, 65536)):
+                return False
+        return True
+
+
+class RequestHandler(simple_server.WSGIRequestHandler):
+    """Handle requests on a connection until either side closes it.
+
+    Whatever the app leaves unread of a request body is read and thrown
+    away (up to max_drain bytes), so it can't be taken for the next
+    request. Connections with chunked, bigger or expected bodies are
+    closed after the response instead.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    max_drain = 64 * 1024
+
+    def __init__(self, request, client_address, server):
+        # Only set up: PooledServer calls serve() when requests arrive.
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.setup()
+
+    def serve(self):
+        """Answer the requests that have arrived on the connection.
+
+        Return True if it is to be kept open for more, once no more are
+        waiting to be read.
+        """
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            if not self._buffered():
+                return True
+            self.handle_one_request()
+        return False
+
+    def _buffered(self):
+        """Return whether the next request can be read without waiting."""
+        self.request.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except (BlockingIOError, OSError):
+            return False
+        finally:
+            self.request.settimeout(self.server.keep_alive)
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except (socket.timeout, OSError):
+            self.close_connection = True
+            return
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = self.request_version = self.command = ''
+            self.send_error(414)
+            return
+        if not self.parse_request():
+            return
+        stdin = self.rfile
+        length = self.headers.get('Content-Length', '0').strip() or '0'
+        if 'Transfer-Encoding' in self.headers \
+                or 'Expect' in self.headers:
+            self.close_connection = True
+        elif not length.isdigit():
+            self.close_connection = True
+            self.send_error(400, 'Bad Content-Length')
+            return
+        else:
+            stdin = BodyReader(self.rfile, int(length))
+        handler = ServerHandler(stdin, self.wfile, self.get_stderr(),
+                                self.get_environ(), multithread=True,
+                                multiprocess=True)
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        if stdin is not self.rfile and not self.close_connection \
+                and not stdin.drain(self.max_drain):
+            self.close_connection = True
+
+    def log_request(self, code='-', size='-'):
+        if self.server.log_requests:
+            simple_server.WSGIRequestHandler.log_request(self, code, size)
+
+
+class PooledServer(simple_server.WSGIServer):
+    """A WSGIServer on an already listening socket, using a thread pool.
+
+    Connections waiting for a request are parked in a selector, which
+    hands them to the pool once there is something to read, so idle
+    keep-alive connections don't hold threads. Those idle for
+    keep_alive seconds are closed.
+    """
+
+    def __init__(self, sock, app, threads=8, keep_alive=5.0,
+                 log_requests=False):
+        simple_server.WSGIServer.__init__(
+            self, sock.getsockname()[:2], RequestHandler,
+            bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.server_name, self.server_port = sock.getsockname()[:2]
+        self.setup_environ()
+        self.set_app(app)
+        self.pool = ThreadPoolExecutor(threads)
+        self.keep_alive = keep_alive
+        self.log_requests = log_requests
+        self.stopping = False
+        self._parking = []
+        self._parked_lock = threading.Lock()
+        self._waker, self._wake = socket.socketpair()
+        self._parker = threading.Thread(target=self._watch,
+                                        name='static-keep-alive')
+        self._parker.daemon = True
+        self._parker.start()
+
+    def process_request(self, request, client_address):
+        request.settimeout(self.keep_alive)
+        # Headers and body are separate writes; don't wait for ACKs.
+        request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            return
+        self._park(handler)
+
+    def _serve(self, handler):
+        try:
+            keep = handler.serve()
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+            keep = False
+        if keep and not self.stopping:
+            self._park(handler)
+        else:
+            self._close(handler)
+
+    def _close(self, handler):
+        try:
+            handler.finish()
+        except OSError:
+            pass
+        self.shutdown_request(handler.request)
+
+    def _park(self, handler):
+        """Have the selector thread watch handler's connection."""
+        with self._parked_lock:
+            parked = self._parking is not None
+            if parked:
+                self._parking.append(handler)
+        if not parked:
+            self._close(handler)
+            return
+        try:
+            self._wake.send(b'\0')
+        except OSError:
+            pass
+
+    def _watch(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self._waker, selectors.EVENT_READ)
+        # Deadlines only ever grow, so the oldest parking expires first.
+        expiring = collections.deque()
+        while True:
+            with self._parked_lock:
+                parking = self._parking
+                if not self.stopping:
+                    self._parking = []
+            if self.stopping:
+                break
+            deadline = time.time() + self.keep_alive
+            for handler in parking:
+                handler.parked_until = deadline
+                selector.register(handler.request, selectors.EVENT_READ,
+                                  handler)
+                expiring.append((deadline, handler))
+            timeout = None
+            if expiring:
+                timeout = max(0, expiring[0][0] - time.time())
+            for key, events in selector.select(timeout):
+                if key.data is None:
+                    self._waker.recv(4096)
+                    continue
+                selector.unregister(key.fileobj)
+                key.data.parked_until = None
+                self.pool.submit(self._serve, key.data)
+            now = time.time()
+            while expiring and expiring[0][0] <= now:
+                deadline, handler = expiring.popleft()
+                if handler.parked_until == deadline:
+                    selector.unregister(handler.request)
+                    self._close(handler)
+        with self._parked_lock:
+            parking, self._parking = self._parking, None
+        for key in list(selector.get_map().values()):
+            if key.data is not None:
+                self._close(key.data)
+        for handler in parking:
+            self._close(handler)
+        selector.close()
+
+    def stop(self):
+        """Stop accepting, then wait for the requests in flight."""
+        self.stopping = True
+        self.shutdown()
+        try:
+            self._wake.send(b'\0')
+        except OSError:
+            pass
+        self._parker.join()
+        self.pool.shutdown(wait=True)
+
+    def server_close(self):
+        simple_server.WSGIServer.server_close(self)
+        self._waker.close()
+        self._wake.close()
+
+
+def listen(host, port, backlog=1024, reuse_port=False):
+    """Return a listening TCP socket."""
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+class PreforkServer(object):
+    """Run app_factory() in workers forked off a parent process."""
+
+    def __init__(self, app_factory, host, port, workers=None, threads=8,
+                 backlog=1024, reuse_port=False, keep_alive=5.0,
+                 graceful_timeout=30.0, log_requests=False):
+        self.app_factory = app_factory
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.threads = threads
+        self.backlog = backlog
+        self.reuse_port = reuse_port
+        self.keep_alive = keep_alive
+        self.graceful_timeout = graceful_timeout
+        self.log_requests = log_requests
+        self.sock = None
+        self.children = {}
+        self._signals = []
+
+    def run(self):
+        """Serve until told to stop."""
+        if self.reuse_port:
+            # Bind once up front, so a port of 0 is resolved for everyone.
+            probe = listen(self.host, self.port, self.backlog, True)
+            self.port = probe.getsockname()[1]
+            probe.close()
+        else:
+            self.sock = listen(self.host, self.port, self.backlog)
+            self.sock.setblocking(False)
+            self.port = self.sock.getsockname()[1]
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, self._signalled)
+        generation = 0
+        self.spawn(generation)
+        while True:
+            if self._signals:
+                signum = self._signals.pop(0)
+                if signum == signal.SIGHUP:
+                    generation += 1
+                    retiring = list(self.children)
+                    self.spawn(generation)
+                    self.stop(retiring)
+                    continue
+                self.stop(list(self.children))
+                break
+            self.reap(generation)
+            time.sleep(0.1)
+        if self.sock is not None:
+            self.sock.close()
+
+    def _signalled(self, signum, frame):
+        self._signals.append(signum)
+
+    def spawn(self, generation):
+        """Fork workers until there are self.workers of this generation."""
+        while sum(1 for child in self.children.values()
+                  if child == generation) < self.workers:
+            pid = os.fork()
+            if pid == 0:
+                code = 1
+                try:
+                    self.work()
+                    code = 0
+                except Exception:
+                    traceback.print_exc()
+                finally:
+                    os._exit(code)
+            self.children[pid] = generation
+
+    def reap(self, generation):
+        """Forget exited workers and replace those of this generation."""
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if self.children.pop(pid, None) == generation:
+                sys.stderr.write('static: worker %d exited (%d), '
+                                 'restarting\n' % (pid, status))
+        self.spawn(generation)
+
+    def stop(self, pids):
+        """Stop workers gracefully, killing any left after the timeout."""
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.time() + self.graceful_timeout
+        while any(pid in self.children for pid in pids) \
+                and time.time() < deadline:
+            self._forget_exited()
+            time.sleep(0.05)
+        for pid in pids:
+            if pid in self.children:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                    os.waitpid(pid, 0)
+                except (ProcessLookupError, ChildProcessError):
+                    pass
+                self.children.pop(pid, None)
+
+    def _forget_exited(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self.children.pop(pid, None)
+
+    def work(self):
+        """Serve in a worker until SIGTERM or SIGINT."""
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        sock = self.sock
+        if sock is None:
+            sock = listen(self.host, self.port, self.backlog, True)
+        server = PooledServer(sock, self.app_factory(), self.threads,
+                              self.keep_alive, self.log_requests)
+
+        def stop(signum, frame):
+            threading.Thread(target=server.stop).start()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        server.serve_forever(poll_interval=0.5)
+        server.stop()
@@ -0,0 +1,358 @@
+"""A cache shared by every worker process on a host.
+
+    from static.shared import SharedCache
+    cache = SharedCache('static-www', max_bytes=256 * 1024 * 1024)
+    app = Cling('/var/www', content_cache=cache)
+
+SharedCache keeps its entries in one file mapped into memory (under
+/dev/shm where there is one), so workers that open the same name, or
+inherit the cache over fork, share a single budget and a single copy of
+each hot file instead of holding one each. The file is created for the
+current user only, and an existing one must belong to them. Without a
+name, the memory is anonymous and only shared with forked children.
+
+The file holds a set-associative index (each key hashes to a set of
+`ways` slots) and an arena of fixed-size blocks, chained together for
+values larger than one block, so the arena never fragments. Writes
+take a lock (a thread lock plus an fcntl lock on the file). Reads take
+none: each slot has a version number, odd while the slot is being
+changed, and a read that sees it change is treated as a miss. Reads
+stamp the slot with the time, and when space runs out the least
+recently used entries of the whole cache are evicted, in batches.
+
+Values must be marshallable (bytes, str, numbers, None and tuples of
+them), which covers the caches of static.apps. POSIX only.
+"""
+
+import errno
+import fcntl
+import hashlib
+import marshal
+import mmap
+import os
+import stat
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+import struct
+
+_MAGIC = b'staticS1'
+_HEADER = struct.Struct('<8sIIIIiIIQ')
+_SLOT = struct.Struct('<Q16siIQ')
+_VERSION = struct.Struct('<Q')
+_USED = struct.Struct('<Q')
+_NEXT = struct.Struct('<i')
+_USED_OFFSET = 32
+
+
+def _now():
+    return int(time.time() * 1000000)
+
+
+def shared_path(name):
+    """Return the file for name: under /dev/shm if possible, unless a path."""
+    if os.sep in name:
+        return name
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') \
+        else tempfile.gettempdir()
+    return os.path.join(directory, name)
+
+
+def _open(path):
+    """Open path, creating it unless it exists and belongs to this user.
+
+    Names under /dev/shm are easy to guess: a file someone else made
+    first could be read or written by them.
+    """
+    flags = os.O_RDWR | getattr(os, 'O_NOFOLLOW', 0)
+    try:
+        return os.open(path, flags | os.O_CREAT | os.O_EXCL, 0o600)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+    fd = os.open(path, flags)
+    st = os.fstat(fd)
+    if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid() \
+            or st.st_mode & 0o077:
+        os.close(fd)
+        raise ValueError('%s is not a private file of this user' % path)
+    return fd
+
+
+class SharedCache(object):
+    """An LRU cache of up to max_bytes in a file mapped by many processes.
+
+    It has LRUCache's interface, so it can stand in for any of Cling's
+    caches. Processes opening the same name must pass the same sizes.
+    With name None, the cache is in anonymous memory shared with the
+    processes forked after it is made. hits and misses count this
+    process's lookups only.
+    """
+
+    def __init__(self, name, max_bytes=64 * 1024 * 1024, max_entries=None,
+                 block_size=4096, ways=8):
+        self.path = None if name is None else shared_path(name)
+        blocks = max(1, max_bytes // block_size)
+        if max_entries is None:
+            max_entries = blocks
+        self.sets = max(1, -(-max_entries // ways))
+        self.ways = ways
+        self.blocks = blocks
+        self.block_size = block_size
+        self.max_entries = self.sets * ways
+        self.max_bytes = blocks * block_size
+        self.hits = 0
+        self.misses = 0
+        self._slots = _HEADER.size
+        self._next = self._slots + self.sets * ways * _SLOT.size
+        self._data = self._next + blocks * _NEXT.size
+        self._lock = threading.Lock()
+        if self.path is None:
+            # The file is only there to lock; the entries are anonymous.
+            self._fd, lock_path = tempfile.mkstemp(prefix='static-')
+            os.unlink(lock_path)
+        else:
+            self._fd = _open(self.path)
+        try:
+            with self._locked():
+                size = 0
+                if self.path is None:
+                    self._map = mmap.mmap(-1, self._data + self.max_bytes)
+                else:
+                    size = os.fstat(self._fd).st_size
+                    if size == 0:
+                        os.ftruncate(self._fd, self._data + self.max_bytes)
+                    self._map = mmap.mmap(self._fd,
+                                          self._data + self.max_bytes)
+                if size == 0:
+                    self._format()
+                elif self._header()[:5] != (_MAGIC, self.sets, ways, blocks,
+                                            block_size):
+                    raise ValueError('%s was made with other sizes'
+                                     % self.path)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    def __len__(self):
+        return self._header()[7]
+
+    @property
+    def bytes(self):
+        return self._header()[8]
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def get(self, key, default=None):
+        """Return the value for key, marking it as recently used."""
+        value = self._lookup(key)
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return marshal.loads(value)
+
+    def set(self, key, value, size=0):
+        """Store value under key, evicting old entries as needed.
+
+        Values taking more than max_bytes are not stored. size is
+        ignored; the space taken is that of the marshalled value.
+        """
+        data = marshal.dumps(value)
+        needed = max(1, -(-len(data) // self.block_size))
+        if needed > self.blocks:
+            return
+        digest = self._digest(key)
+        with self._locked():
+            first = self._set_offset(digest)
+            found = self._find(digest, first)
+            offset = self._victim(first) if found is None else found[0]
+            self._evict(offset)
+            if self._header()[6] < needed:
+                self._make_room(needed)
+            self._store(offset, digest, data, needed)
+
+    def pop(self, key, default=None):
+        """Forget key and return its value (or default)."""
+        digest = self._digest(key)
+        with self._locked():
+            found = self._find(digest, self._set_offset(digest))
+            if found is None:
+                return default
+            offset = found[0]
+            value = self._read(offset)
+            self._evict(offset)
+        return default if value is None else marshal.loads(value)
+
+    def clear(self):
+        """Forget every entry and reset the counters."""
+        with self._locked():
+            for offset in range(self._slots, self._next, _SLOT.size):
+                self._evict(offset)
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    def unlink(self):
+        """Remove the file; processes that have it open keep their copy."""
+        if self.path is None:
+            return
+        try:
+            os.unlink(self.path)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def _format(self):
+        """Write an empty index and chain every block into the free list."""
+        self._map[:self._data] = b'\0' * self._data
+        empty = _SLOT.pack(0, b'\0' * 16, -1, 0, 0)
+        self._map[self._slots:self._next] = empty * (self.sets * self.ways)
+        self._map[self._next:self._data] = b''.join(
+            _NEXT.pack(i + 1) for i in range(self.blocks - 1)) + _NEXT.pack(-1)
+        self._write_header(0, self.blocks, 0, 0)
+
+    def _header(self):
+        return _HEADER.unpack_from(self._map, 0)
+
+    def _write_header(self, free_head, free_count, entries, used):
+        _HEADER.pack_into(self._map, 0, _MAGIC, self.sets, self.ways,
+                          self.blocks, self.block_size, free_head,
+                          free_count, entries, used)
+
+    def _digest(self, key):
+        return hashlib.blake2b(repr(key).encode('utf-8'),
+                               digest_size=16).digest()
+
+    def _set_offset(self, digest):
+        index = int.from_bytes(digest[:8], 'little') % self.sets
+        return self._slots + index * self.ways * _SLOT.size
+
+    def _find(self, digest, first):
+        """Return the offset and version of digest's slot, or None."""
+        for offset in range(first, first + self.ways * _SLOT.size,
+                            _SLOT.size):
+            version, found, block, length, used = _SLOT.unpack_from(
+                self._map, offset)
+            if found == digest and block >= 0 and not version & 1:
+                return offset, version
+        return None
+
+    def _victim(self, first):
+        """Return the empty or else least recently used slot of a set."""
+        best = None
+        for offset in range(first, first + self.ways * _SLOT.size,
+                            _SLOT.size):
+            version, digest, block, length, used = _SLOT.unpack_from(
+                self._map, offset)
+            if block < 0:
+                return offset
+            if best is None or used < best[0]:
+                best = (used, offset)
+        return best[1]
+
+    def _lookup(self, key):
+        """Return the marshalled value for key or None, without locking."""
+        digest = self._digest(key)
+        found = self._find(digest, self._set_offset(digest))
+        if found is None:
+            return None
+        offset, version = found
+        value = self._read(offset)
+        # The version must be the one seen with the digest: any change to
+        # the slot since (even to another key and back) bumps it.
+        if value is None \
+                or _SLOT.unpack_from(self._map, offset)[:2] != (version,
+                                                                digest):
+            return None
+        _USED.pack_into(self._map, offset + _USED_OFFSET, _now())
+        return value
+
+    def _read(self, offset):
+        """Copy out the value in a slot, or None if it changed under us."""
+        version, digest, block, length, used = _SLOT.unpack_from(
+            self._map, offset)
+        if block < 0 or version & 1:
+            return None
+        parts = []
+        remaining = length
+        while remaining > 0:
+            if not 0 <= block < self.blocks:
+                return None
+            start = self._data + block * self.block_size
+            parts.append(self._map[start:start + min(remaining,
+                                                     self.block_size)])
+            remaining -= self.block_size
+            block = _NEXT.unpack_from(self._map,
+                                      self._next + block * _NEXT.size)[0]
+        return b''.join(parts)
+
+    def _chain(self, block, count):
+        """Return the blocks of a chain of count blocks starting at block."""
+        blocks = [block]
+        for i in range(count - 1):
+            block = _NEXT.unpack_from(self._map,
+                                      self._next + block * _NEXT.size)[0]
+            blocks.append(block)
+        return blocks
+
+    def _evict(self, offset):
+        """Empty a slot, giving its blocks back to the free list."""
+        version, digest, block, length, used = _SLOT.unpack_from(
+            self._map, offset)
+        if block < 0:
+            return
+        count = max(1, -(-length // self.block_size))
+        free_head, free_count, entries, total = self._header()[5:]
+        _VERSION.pack_into(self._map, offset, version + 1)
+        last = self._chain(block, count)[-1]
+        _NEXT.pack_into(self._map, self._next + last * _NEXT.size, free_head)
+        _SLOT.pack_into(self._map, offset, version + 2, b'\0' * 16, -1, 0, 0)
+        self._write_header(block, free_count + count, entries - 1,
+                           total - length)
+
+    def _make_room(self, needed):
+        """Evict the least recently used entries until needed blocks are
+        free, plus a few more so the next sets don't scan again."""
+        target = min(self.blocks, needed + self.blocks // 32)
+        slots = self._map[self._slots:self._next]
+        used = sorted(
+            (entry[4], self._slots + index * _SLOT.size)
+            for index, entry in enumerate(_SLOT.iter_unpack(slots))
+            if entry[2] >= 0)
+        for stamp, offset in used:
+            if self._header()[6] >= target:
+                break
+            self._evict(offset)
+
+    def _store(self, offset, digest, data, count):
+        """Take count blocks off the free list and put data in the slot."""
+        free_head, free_count, entries, total = self._header()[5:]
+        blocks = self._chain(free_head, count)
+        next_free = _NEXT.unpack_from(
+            self._map, self._next + blocks[-1] * _NEXT.size)[0]
+        version = _VERSION.unpack_from(self._map, offset)[0]
+        _VERSION.pack_into(self._map, offset, version + 1)
+        for i, block in enumerate(blocks):
+            start = self._data + block * self.block_size
+            piece = data[i * self.block_size:(i + 1) * self.block_size]
+            self._map[start:start + len(piece)] = piece
+        _NEXT.pack_into(self._map, self._next + blocks[-1] * _NEXT.size, -1)
+        self._write_header(next_free, free_count - count, entries + 1,
+                           total + len(data))
+        _SLOT.pack_into(self._map, offset, version + 2, digest, blocks[0],
+                        len(data), _now())
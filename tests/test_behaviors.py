@@ -1,18 +1,41 @@
-from os import stat
+import asyncio
+import gzip
+import http.client as http_lib
+import io
+import json
+import logging
+import os
+from os import path, stat
 from email.utils import formatdate
+import shutil
+import signal
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import threading
 import time
+import wsgiref.util
+import zipfile
 
 from unittest import TestCase
 
 from wsgi_intercept import http_client_intercept
 import wsgi_intercept
 
-try:
-    import http.client as http_lib
-except ImportError:
-    import httplib as http_lib
-
 import static
+import static.archive
+import static.access
+import static.asgi
+import static.autoindex
+import static.cache
+import static.cli
+import static.compression
+import static.etags
+import static.manifest
+import static.server
+import static.shared
 
 
 class StripAcceptEncoding(object):
@@ -57,6 +80,31 @@ class Intercepted(TestCase):
                 self.assertEqual(real_headers[k], v)
 
 
+class TemporaryTree(Intercepted):
+    """Intercepted tests of an app serving a fresh directory, self.root.
+
+    Subclasses write their files and set self._app after calling setUp.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        super(TemporaryTree, self).setUp()
+
+    def tearDown(self):
+        super(TemporaryTree, self).tearDown()
+        shutil.rmtree(self.root)
+
+    def get_app(self):
+        return self._app
+
+    def write(self, name, content):
+        """Write content to name under self.root and return its path."""
+        full_path = path.join(self.root, name)
+        with open(full_path, 'wb') as fp:
+            fp.write(content)
+        return full_path
+
+
 class StaticClingWithIndexTests(Intercepted):
 
     def get_app(self):
@@ -257,3 +305,1885 @@ class StaticClingWithPrezipping(Intercepted):
             {'Accept-Encoding': 'gzip, deflate'},
             200,
             file_content="tests/data/prezip/nogzipversionpresent.txt")
+
+
+class StaticClingWithMetadataCache(TemporaryTree):
+
+    def setUp(self):
+        super(StaticClingWithMetadataCache, self).setUp()
+        self.file_path = self.write('static.txt', b'first')
+        self._app = static.Cling(self.root, metadata_cache_size=10,
+                                 metadata_ttl=None)
+
+    def test_repeat_requests_hit_the_cache(self):
+        for i in range(3):
+            self.assert_response('GET', '/static.txt', {}, 200, b'first')
+        self.assertEqual(self._app.metadata_cache.misses, 1)
+        self.assertEqual(self._app.metadata_cache.hits, 2)
+
+    def test_cached_info_is_used_without_revalidation(self):
+        self.assert_response('GET', '/static.txt', {}, 200, b'first')
+        mtime = stat(self.file_path).st_mtime
+        self.assert_response(
+            'GET', '/static.txt', {}, 200,
+            response_headers={'ETag': str(mtime)})
+        os.utime(self.file_path, (mtime + 10, mtime + 10))
+        self.assert_response(
+            'GET', '/static.txt', {}, 200,
+            response_headers={'ETag': str(mtime)})
+
+    def test_changes_are_seen_once_the_ttl_runs_out(self):
+        self._app.metadata_ttl = 0
+        self.assert_response('GET', '/static.txt', {}, 200, b'first')
+        mtime = stat(self.file_path).st_mtime
+        os.utime(self.file_path, (mtime + 10, mtime + 10))
+        self.assert_response(
+            'GET', '/static.txt', {}, 200,
+            response_headers={'ETag': str(mtime + 10)})
+
+    def test_removed_files_are_not_found_once_the_ttl_runs_out(self):
+        self._app.metadata_ttl = 0
+        self.assert_response('GET', '/static.txt', {}, 200, b'first')
+        os.remove(self.file_path)
+        self.assert_response('GET', '/static.txt', {}, 404)
+        self.assertFalse(self.file_path in self._app.metadata_cache)
+
+    def test_replaced_files_are_sent_with_their_own_length(self):
+        self.assert_response('GET', '/static.txt', {}, 200, b'first')
+        replacement = path.join(self.root, 'replacement')
+        with open(replacement, 'wb') as fp:
+            fp.write(b'x' * 5000)
+        os.replace(replacement, self.file_path)
+        client = http_lib.HTTPConnection('statictest')
+        client.request('GET', '/static.txt')
+        response = client.getresponse()
+        self.assertEqual(response.read(), b'x' * 5000)
+        self.assertEqual(response.getheader('Content-Length'), '5000')
+        self.assertEqual(response.getheader('ETag'), None)
+        self.assertFalse(self.file_path in self._app.metadata_cache)
+        self.assert_response(
+            'GET', '/static.txt', {}, 200, b'x' * 5000,
+            response_headers={'ETag': str(stat(self.file_path).st_mtime)})
+
+    def test_sendfile_stops_at_the_length_sent(self):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/static.txt'}
+        body = self._app(environ, lambda status, headers: None)
+        with open(self.file_path, 'ab') as fp:
+            fp.write(b' and more')
+        self.assertEqual(b''.join(body), b'first')
+        server = static.server.PooledServer(
+            static.server.listen('127.0.0.1', 0), self._app, threads=1)
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.start()
+        real_opened_info = self._app._opened_info
+
+        def grow_after_open(info, file_like):
+            opened = real_opened_info(info, file_like)
+            with open(self.file_path, 'ab') as fp:
+                fp.write(b'!' * 100)
+            return opened
+        self._app._opened_info = grow_after_open
+        try:
+            client = http_lib.HTTPConnection('127.0.0.1', server.server_port)
+            client.request('GET', '/static.txt')
+            response = client.getresponse()
+            self.assertEqual(response.read(), b'first and more')
+            client.request('GET', '/static.txt')
+            response = client.getresponse()
+            self.assertEqual(response.status, 200)
+            response.read()
+            client.close()
+        finally:
+            server.stop()
+            thread.join()
+            server.server_close()
+
+    def test_cache_is_bounded(self):
+        self._app.metadata_cache.max_entries = 1
+        self.assert_response('GET', '/static.txt', {}, 200)
+        self.assert_response('GET', '/no-such-file.txt', {}, 404)
+        self.assert_response('GET', '/', {}, 404)
+        self.assertEqual(len(self._app.metadata_cache), 1)
+
+
+class StaticClingWithContentCache(TemporaryTree):
+
+    def setUp(self):
+        super(StaticClingWithContentCache, self).setUp()
+        self.file_path = self.write('small.txt', b'small')
+        self.write('big.txt', b'b' * 100)
+        self._app = static.Cling(self.root, content_cache_bytes=64,
+                                 content_cache_max_file=50)
+
+    def test_small_files_are_served_from_memory(self):
+        self.assert_response('GET', '/small.txt', {}, 200, b'small',
+                             response_headers={'Content-Length': '5'})
+        self._app._file_like = None
+        self.assert_response('GET', '/small.txt', {}, 200, b'small',
+                             response_headers={'Content-Length': '5'})
+        self.assertEqual(self._app.content_cache.hits, 1)
+
+    def test_head_from_memory_has_no_body(self):
+        self.assert_response('GET', '/small.txt', {}, 200, b'small')
+        self.assert_response('HEAD', '/small.txt', {}, 200, b'',
+                             response_headers={'Content-Length': '5'})
+
+    def test_changed_files_are_reread(self):
+        self.assert_response('GET', '/small.txt', {}, 200, b'small')
+        with open(self.file_path, 'wb') as fp:
+            fp.write(b'changed')
+        self.assert_response('GET', '/small.txt', {}, 200, b'changed')
+
+    def test_big_files_are_not_cached(self):
+        self.assert_response('GET', '/big.txt', {}, 200, b'b' * 100)
+        self.assertEqual(len(self._app.content_cache), 0)
+
+    def test_byte_budget_evicts_least_recently_used(self):
+        for name in ('a', 'b', 'c'):
+            with open(path.join(self.root, name), 'wb') as fp:
+                fp.write(name.encode('ascii') * 30)
+            self.assert_response('GET', '/' + name, {}, 200)
+        cache = self._app.content_cache
+        self.assertEqual(cache.bytes, 60)
+        self.assertFalse(path.join(self.root, 'a') in cache)
+
+
+class StaticClingBodyTests(TemporaryTree):
+
+    def setUp(self):
+        super(StaticClingBodyTests, self).setUp()
+        self.content = bytes(bytearray(range(256))) * 1000
+        self.write('big.bin', self.content)
+
+    def get_app(self):
+        return static.Cling(self.root, block_size=4096)
+
+    def test_client_gets_content_length(self):
+        self.assert_response(
+            'GET', '/big.bin', {}, 200, self.content,
+            response_headers={'Content-Length': str(len(self.content))})
+
+    def test_head_gets_content_length(self):
+        self.assert_response(
+            'HEAD', '/big.bin', {}, 200, b'',
+            response_headers={'Content-Length': str(len(self.content))})
+
+    def test_file_wrapper_exposes_fileno_and_closes(self):
+        file_like = open(path.join(self.root, 'big.bin'), 'rb')
+        wrapper = static.FileWrapper(file_like, 4096)
+        self.assertEqual(wrapper.fileno(), file_like.fileno())
+        self.assertEqual(b''.join(wrapper), self.content)
+        self.assertTrue(file_like.closed)
+
+    def test_file_wrapper_reads_small_files(self):
+        with open(path.join(self.root, 'small.txt'), 'wb') as fp:
+            fp.write(b'small')
+        wrapper = static.FileWrapper(
+            open(path.join(self.root, 'small.txt'), 'rb'), 4096)
+        self.assertEqual(list(wrapper), [b'small'])
+
+
+class StaticClingRangeTests(TemporaryTree):
+
+    def setUp(self):
+        super(StaticClingRangeTests, self).setUp()
+        self.content = b'0123456789' * 1000
+        self.file_path = self.write('digits.txt', self.content)
+        self._app = static.Cling(self.root, block_size=4096)
+
+    def test_client_is_told_ranges_are_accepted(self):
+        self.assert_response('GET', '/digits.txt', {}, 200,
+                             response_headers={'Accept-Ranges': 'bytes'})
+
+    def test_client_can_get_a_range(self):
+        self.assert_response(
+            'GET', '/digits.txt', {'Range': 'bytes=5000-5004'},
+            206, b'01234',
+            response_headers={'Content-Range': 'bytes 5000-5004/10000',
+                              'Content-Length': '5'})
+
+    def test_client_can_get_an_open_ended_range(self):
+        self.assert_response(
+            'GET', '/digits.txt', {'Range': 'bytes=9995-'},
+            206, b'56789',
+            response_headers={'Content-Range': 'bytes 9995-9999/10000'})
+
+    def test_client_can_get_a_suffix_range(self):
+        self.assert_response(
+            'GET', '/digits.txt', {'Range': 'bytes=-3'}, 206, b'789')
+
+    def test_client_can_head_a_range(self):
+        self.assert_response(
+            'HEAD', '/digits.txt', {'Range': 'bytes=0-9'}, 206, b'',
+            response_headers={'Content-Length': '10'})
+
+    def test_client_can_get_several_ranges(self):
+        client = http_lib.HTTPConnection('statictest')
+        client.request('GET', '/digits.txt',
+                       headers={'Range': 'bytes=0-1,9998-'})
+        response = client.getresponse()
+        body = response.read()
+        self.assertEqual(response.status, 206)
+        content_type = response.getheader('Content-Type')
+        self.assertTrue(
+            content_type.startswith('multipart/byteranges; boundary='))
+        boundary = content_type.split('=', 1)[1].encode('ascii')
+        self.assertEqual(int(response.getheader('Content-Length')),
+                         len(body))
+        self.assertEqual(
+            body,
+            b'--' + boundary + b'\r\nContent-Type: text/plain\r\n'
+            b'Content-Range: bytes 0-1/10000\r\n\r\n01\r\n'
+            b'--' + boundary + b'\r\nContent-Type: text/plain\r\n'
+            b'Content-Range: bytes 9998-9999/10000\r\n\r\n89\r\n'
+            b'--' + boundary + b'--\r\n')
+
+    def test_client_gets_416_for_unsatisfiable_range(self):
+        self.assert_response(
+            'GET', '/digits.txt', {'Range': 'bytes=10000-'}, 416,
+            response_headers={'Content-Range': 'bytes */10000'})
+
+    def test_client_gets_416_for_open_range_past_the_end(self):
+        for header in ('bytes=10001-', 'bytes=20000-'):
+            self.assert_response(
+                'GET', '/digits.txt', {'Range': header}, 416,
+                response_headers={'Content-Range': 'bytes */10000'})
+
+    def test_open_range_past_the_end_is_skipped_among_others(self):
+        self.assert_response(
+            'GET', '/digits.txt', {'Range': 'bytes=20000-,0-1'}, 206, b'01')
+
+    def test_malformed_or_overlapping_ranges_get_the_whole_file(self):
+        for header in ('bytes=5-1', 'lines=1-2', 'bytes=0-5,3-8', 'bytes=x-'):
+            self.assert_response('GET', '/digits.txt', {'Range': header},
+                                 200, self.content)
+
+    def test_if_range_with_current_etag_gets_the_range(self):
+        etag = str(stat(self.file_path).st_mtime)
+        self.assert_response(
+            'GET', '/digits.txt', {'Range': 'bytes=0-1', 'If-Range': etag},
+            206, b'01')
+
+    def test_if_range_with_stale_validator_gets_the_whole_file(self):
+        self.assert_response(
+            'GET', '/digits.txt',
+            {'Range': 'bytes=0-1', 'If-Range': 'stale'},
+            200, self.content)
+
+    def test_ranges_come_from_the_content_cache(self):
+        self._app.content_cache = static.apps.LRUCache(10, 20000)
+        self._app.content_cache_max_file = 20000
+        for i in range(2):
+            self.assert_response(
+                'GET', '/digits.txt', {'Range': 'bytes=1-2'}, 206, b'12')
+        self.assertEqual(self._app.content_cache.hits, 1)
+
+    def test_ranges_apply_to_prezipped_content(self):
+        with open(self.file_path + '.gz', 'wb') as fp:
+            fp.write(b'zipped')
+        self.assert_response(
+            'GET', '/digits.txt',
+            {'Range': 'bytes=0-2', 'Accept-Encoding': 'gzip'},
+            206, b'zip',
+            response_headers={'Content-Encoding': 'gzip',
+                              'Content-Range': 'bytes 0-2/6'})
+
+
+class StaticShockRangeTests(Intercepted):
+
+    def get_app(self):
+        return static.Shock('tests/data/templates',
+                            (static.StringMagic(variables={'name': "Hamm"}),))
+
+    def test_magic_files_decline_ranges(self):
+        client = http_lib.HTTPConnection('statictest')
+        client.request('GET', '/index.html', headers={'Range': 'bytes=0-1'})
+        response = client.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.read(), b'Hello Hamm')
+        self.assertEqual(response.getheader('Accept-Ranges'), None)
+
+    def test_plain_files_in_shock_accept_ranges(self):
+        self.assert_response(
+            'GET', '/static.txt', {'Range': 'bytes=0-0'}, 206,
+            response_headers={'Content-Range': 'bytes 0-0/%d' % stat(
+                'tests/data/templates/static.txt').st_size})
+
+
+class StaticClingWithManifest(Intercepted):
+
+    def setUp(self):
+        self._app = static.Cling('tests/data/withindex', manifest=True)
+        super(StaticClingWithManifest, self).setUp()
+
+    def get_app(self):
+        return self._app
+
+    def test_client_can_get_a_static_file(self):
+        self.assert_response(
+            'GET', '/static.html', {}, 200,
+            file_content='tests/data/withindex/static.html')
+
+    def test_lookups_do_not_stat(self):
+        real_stat = static.apps.stat
+
+        def no_stat(full_path):
+            raise AssertionError('stat(%r)' % full_path)
+        static.apps.stat = no_stat
+        try:
+            self.assert_response(
+                'GET', '/subdir/', {}, 200,
+                file_content='tests/data/withindex/subdir/index.html')
+            self.assert_response('GET', '/no-such-file.txt', {}, 404)
+        finally:
+            static.apps.stat = real_stat
+
+    def test_client_gets_index_file_on_root(self):
+        self.assert_response(
+            'GET', '/', {}, 200,
+            file_content='tests/data/withindex/index.html')
+
+    def test_client_gets_301_on_subdirectory_with_no_trailing_slash(self):
+        self.assert_response(
+            'GET', '/subdir', {}, 301,
+            response_headers={'Location': 'http://statictest/subdir/'})
+
+    def test_client_cant_get_a_file_outside_the_manifest(self):
+        self.assert_response('GET', '/../__init__.py', {}, 404)
+
+    def test_manifest_built_by_the_cli_can_be_loaded(self):
+        manifest_dir = tempfile.mkdtemp()
+        try:
+            manifest_path = path.join(manifest_dir, 'manifest.json')
+            with open(os.devnull, 'w') as devnull:
+                stdout, sys.stdout = sys.stdout, devnull
+                try:
+                    static.cli.run(['manifest', 'tests/data/prezip',
+                                    manifest_path])
+                finally:
+                    sys.stdout = stdout
+            self._app = static.Cling('tests/data/prezip',
+                                     manifest=manifest_path)
+            self.assert_response(
+                'GET', '/static.txt', {'Accept-Encoding': 'gzip'}, 200,
+                response_headers={'Content-Encoding': 'gzip'},
+                file_content='tests/data/prezip/static.txt.gz')
+        finally:
+            shutil.rmtree(manifest_dir)
+
+
+class StaticClingWithCompression(TemporaryTree):
+
+    def setUp(self):
+        super(StaticClingWithCompression, self).setUp()
+        self.text = b'All work and no play makes Jack a dull boy.\n' * 100
+        self.write('text.txt', self.text)
+        self.write('image.png', self.text)
+        self._app = static.Cling(self.root, compress=['gzip'])
+
+    def get(self, path_info, headers):
+        client = http_lib.HTTPConnection('statictest')
+        client.request('GET', path_info, headers=headers)
+        response = client.getresponse()
+        return response, response.read()
+
+    def test_text_is_compressed_on_the_fly(self):
+        response, body = self.get('/text.txt', {'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.getheader('Content-Encoding'), 'gzip')
+        self.assertEqual(response.getheader('Vary'), 'Accept-Encoding')
+        self.assertEqual(int(response.getheader('Content-Length')),
+                         len(body))
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(body)).read(),
+                         self.text)
+
+    def test_compressed_bytes_are_cached(self):
+        for i in range(3):
+            self.get('/text.txt', {'Accept-Encoding': 'gzip'})
+        self.assertEqual(self._app.compressed_cache.misses, 1)
+        self.assertEqual(self._app.compressed_cache.hits, 2)
+
+    def test_identity_response_still_varies(self):
+        response, body = self.get('/text.txt', {})
+        self.assertEqual(body, self.text)
+        self.assertEqual(response.getheader('Content-Encoding'), None)
+        self.assertEqual(response.getheader('Vary'), 'Accept-Encoding')
+
+    def test_q_zero_refuses_a_coding(self):
+        response, body = self.get('/text.txt',
+                                  {'Accept-Encoding': 'gzip;q=0, br'})
+        self.assertEqual(body, self.text)
+        self.assertEqual(response.getheader('Content-Encoding'), None)
+
+    def test_compressed_etag_differs(self):
+        plain, _ = self.get('/text.txt', {})
+        zipped, _ = self.get('/text.txt', {'Accept-Encoding': 'gzip'})
+        self.assertEqual(zipped.getheader('ETag'),
+                         plain.getheader('ETag') + '-gzip')
+
+    def test_incompressible_types_are_sent_as_is(self):
+        response, body = self.get('/image.png', {'Accept-Encoding': 'gzip'})
+        self.assertEqual(body, self.text)
+        self.assertEqual(response.getheader('Vary'), None)
+
+
+class StaticClingPrezippedNegotiation(Intercepted):
+
+    def get_app(self):
+        return static.Cling('tests/data/prezip')
+
+    def test_prezipped_content_is_refused_with_q_zero(self):
+        self.assert_response(
+            'GET', '/static.txt', {'Accept-Encoding': 'gzip;q=0'}, 200,
+            file_content='tests/data/prezip/static.txt',
+            response_headers={'Vary': 'Accept-Encoding'})
+
+    def test_wildcard_accepts_prezipped_content(self):
+        self.assert_response(
+            'GET', '/static.txt', {'Accept-Encoding': '*'}, 200,
+            file_content='tests/data/prezip/static.txt.gz',
+            response_headers={'Content-Encoding': 'gzip'})
+
+
+class AcceptEncodingTests(TestCase):
+
+    def test_parse_accept_encoding(self):
+        self.assertEqual(
+            static.compression.parse_accept_encoding(
+                'gzip;q=0.5, br ;q=1.0, identity; q=0'),
+            {'gzip': 0.5, 'br': 1.0, 'identity': 0.0})
+
+    def test_choose_encoding_prefers_higher_q_then_order(self):
+        choose = static.compression.choose_encoding
+        accepted = {'gzip': 1.0, 'zstd': 0.5, 'br': 1.0}
+        self.assertEqual(choose(accepted, ('br', 'zstd', 'gzip')), 'br')
+        self.assertEqual(choose(accepted, ('zstd', 'gzip')), 'gzip')
+        self.assertEqual(choose({}, ('gzip',)), None)
+
+
+class PrecompressTests(TemporaryTree):
+
+    def setUp(self):
+        super(PrecompressTests, self).setUp()
+        self.css = b'body { color: red; }\n' * 500
+        self.write('style.css', self.css)
+        self.write('photo.png', b'x' * 5000)
+        self._app = static.Cling(self.root, precompressed=('br', 'gzip'))
+
+    def precompress(self, **kw):
+        return static.compression.precompress_tree(
+            self.root, ['gzip'], processes=1, **kw)
+
+    def test_compressible_files_get_siblings(self):
+        totals = self.precompress()
+        self.assertEqual(totals['siblings'], 1)
+        with gzip.open(path.join(self.root, 'style.css.gz')) as fp:
+            self.assertEqual(fp.read(), self.css)
+        self.assertFalse(path.exists(path.join(self.root, 'photo.png.gz')))
+
+    def test_up_to_date_siblings_are_skipped(self):
+        self.precompress()
+        self.assertEqual(self.precompress()['siblings'], 0)
+        self.assertEqual(self.precompress(force=True)['siblings'], 1)
+
+    def test_siblings_that_save_too_little_are_dropped(self):
+        self.precompress()
+        totals = self.precompress(force=True, min_saving=0.999)
+        self.assertEqual(totals['siblings'], 0)
+        self.assertFalse(path.exists(path.join(self.root, 'style.css.gz')))
+
+    def test_siblings_keep_the_type_of_the_original(self):
+        self.write('style.css.zst', b'zstandard')
+        self.write('style.css.br', b'brotli')
+        self._app = static.Cling(self.root, precompressed=('zstd', 'br'))
+        for coding, content in (('zstd', b'zstandard'), ('br', b'brotli')):
+            self.assert_response(
+                'GET', '/style.css', {'Accept-Encoding': coding}, 200,
+                content, response_headers={'Content-Encoding': coding,
+                                           'Content-Type': 'text/css'})
+
+    def test_cling_serves_the_preferred_sibling(self):
+        self.precompress()
+        with open(path.join(self.root, 'style.css.br'), 'wb') as fp:
+            fp.write(b'brotli')
+        self.assert_response(
+            'GET', '/style.css', {'Accept-Encoding': 'gzip, br'}, 200,
+            b'brotli', response_headers={'Content-Encoding': 'br',
+                                         'Vary': 'Accept-Encoding'})
+        self.assert_response(
+            'GET', '/style.css', {'Accept-Encoding': 'gzip'}, 200,
+            file_content=path.join(self.root, 'style.css.gz'),
+            response_headers={'Content-Encoding': 'gzip'})
+
+
+class StaticClingWithHashETags(TemporaryTree):
+
+    def setUp(self):
+        super(StaticClingWithHashETags, self).setUp()
+        self.file_path = self.write('static.txt', b'content')
+        self.etag = '"%s"' % static.etags.content_hash(self.file_path)
+        self.store = path.join(self.root, 'hashes')
+        self._app = static.Cling(self.root, etags='hash',
+                                 hash_store=self.store)
+
+    def test_etag_is_a_quoted_content_hash(self):
+        self.assert_response('GET', '/static.txt', {}, 200, b'content',
+                             response_headers={'ETag': self.etag})
+
+    def test_etag_survives_touching_the_file(self):
+        mtime = stat(self.file_path).st_mtime
+        os.utime(self.file_path, (mtime + 10, mtime + 10))
+        self.assert_response('GET', '/static.txt', {}, 200,
+                             response_headers={'ETag': self.etag})
+
+    def test_if_none_match_lists_are_parsed(self):
+        self.assert_response(
+            'GET', '/static.txt',
+            {'If-None-Match': '"other", W/%s' % self.etag}, 304, b'')
+        self.assert_response(
+            'GET', '/static.txt', {'If-None-Match': self.etag[:-3] + '"'},
+            200, b'content')
+
+    def test_if_none_match_wins_over_if_modified_since(self):
+        self.assert_response(
+            'GET', '/static.txt',
+            {'If-None-Match': '"other"',
+             'If-Modified-Since': formatdate(time.time())},
+            200, b'content')
+
+    def test_if_range_needs_a_strong_match(self):
+        self.assert_response(
+            'GET', '/static.txt',
+            {'Range': 'bytes=0-2', 'If-Range': self.etag}, 206, b'con')
+        self.assert_response(
+            'GET', '/static.txt',
+            {'Range': 'bytes=0-2', 'If-Range': 'W/' + self.etag},
+            200, b'content')
+
+    def test_hashes_are_stored_and_reloaded(self):
+        self.assert_response('GET', '/static.txt', {}, 200)
+        real_hash = static.apps.content_hash
+        static.apps.content_hash = None
+        try:
+            self._app = static.Cling(self.root, etags='hash',
+                                     hash_store=self.store)
+            self.assert_response('GET', '/static.txt', {}, 200,
+                                 response_headers={'ETag': self.etag})
+        finally:
+            static.apps.content_hash = real_hash
+
+    def test_manifest_hashes_are_used(self):
+        rows = static.manifest.build_manifest(self.root, hashes=True)
+        manifest_path = path.join(self.root, 'manifest.json')
+        static.manifest.write_manifest(rows, manifest_path)
+        real_hash = static.apps.content_hash
+        static.apps.content_hash = None
+        try:
+            self._app = static.Cling(self.root, etags='hash',
+                                     manifest=manifest_path)
+            self.assert_response('GET', '/static.txt', {}, 200,
+                                 response_headers={'ETag': self.etag})
+        finally:
+            static.apps.content_hash = real_hash
+
+
+class StaticClingWithCachePolicy(Intercepted):
+
+    def get_app(self):
+        policy = static.CachePolicy(
+            [static.CacheRule(prefix='/subdir/', no_cache=True),
+             static.CacheRule(extension='.html', max_age=60,
+                              stale_while_revalidate=30)],
+            default=static.CacheRule(max_age=300, private=True))
+        return static.Cling('tests/data/withindex', cache_policy=policy)
+
+    def test_first_matching_rule_applies(self):
+        self.assert_response(
+            'GET', '/subdir/', {}, 200,
+            response_headers={'Cache-Control': 'no-cache, public'})
+        self.assert_response(
+            'GET', '/static.html', {}, 200,
+            response_headers={
+                'Cache-Control':
+                    'public, max-age=60, stale-while-revalidate=30'})
+
+    def test_not_modified_responses_get_the_policy_too(self):
+        self.assert_response(
+            'GET', '/static.html',
+            {'If-Modified-Since': formatdate(time.time())}, 304,
+            response_headers={
+                'Cache-Control':
+                    'public, max-age=60, stale-while-revalidate=30'})
+
+
+class CachePolicyTests(TestCase):
+
+    def test_fingerprinted_paths_are_immutable(self):
+        policy = static.CachePolicy(
+            [static.CacheRule(extension='.js', max_age=60)])
+        immutable = [('Cache-Control', 'public, max-age=31536000, immutable')]
+        self.assertEqual(policy.headers('/css/app.3f9a1c.css'), immutable)
+        self.assertEqual(policy.headers('/app-0123456789abcdef.png'),
+                         immutable)
+        self.assertEqual(policy.headers('/v-20240101.txt'), immutable)
+        self.assertEqual(policy.headers('/js/app.js'),
+                         [('Cache-Control', 'public, max-age=60')])
+        self.assertEqual(policy.headers('/app.css'), [])
+
+    def test_hex_looking_words_are_not_fingerprints(self):
+        policy = static.CachePolicy()
+        for request_path in ('/the-facade.html', '/img/decade.png',
+                             '/release-123456.txt', '/a.3f9a1.css'):
+            self.assertEqual(policy.headers(request_path), [])
+
+    def test_rules_win_over_fingerprints(self):
+        policy = static.CachePolicy(
+            [static.CacheRule(prefix='/api/', no_store=True)])
+        self.assertEqual(policy.headers('/api/state.3f9a1c.json'),
+                         [('Cache-Control', 'no-store')])
+
+    def test_default_and_globs(self):
+        policy = static.CachePolicy(
+            [static.CacheRule(glob='/img/*.png', max_age=10)],
+            default=static.CacheRule(no_store=True), fingerprint=None)
+        self.assertEqual(policy.headers('/img/a.png'),
+                         [('Cache-Control', 'public, max-age=10')])
+        self.assertEqual(policy.headers('/app.3f9a1c.js'),
+                         [('Cache-Control', 'no-store')])
+
+
+class AsyncClingTests(TestCase):
+
+    def request(self, app, path_info, headers=(), method='GET',
+                extensions=None):
+        scope = {'type': 'http', 'method': method, 'path': path_info,
+                 'query_string': b'', 'root_path': '',
+                 'headers': [(k.lower().encode('latin-1'),
+                              v.encode('latin-1')) for k, v in headers],
+                 'server': ('statictest', 80), 'scheme': 'http'}
+        if extensions is not None:
+            scope['extensions'] = extensions
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(app(scope, receive, send))
+        start = messages[0]
+        headers = dict((k.decode('latin-1'), v.decode('latin-1'))
+                       for k, v in start['headers'])
+        return start['status'], headers, messages[1:]
+
+    def test_client_can_get_a_static_file_in_blocks(self):
+        app = static.asgi.AsyncCling('tests/data/withindex', block_size=4)
+        status, headers, messages = self.request(app, '/static.html')
+        with open('tests/data/withindex/static.html', 'rb') as fp:
+            content = fp.read()
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['content-length'], str(len(content)))
+        self.assertTrue(len(messages) > 2)
+        self.assertEqual(b''.join(m['body'] for m in messages), content)
+        self.assertFalse(messages[-1].get('more_body', False))
+        app.close()
+
+    def test_conditional_requests_and_redirects_work(self):
+        app = static.asgi.AsyncCling('tests/data/withindex')
+        status, headers, _ = self.request(
+            app, '/static.html',
+            [('If-Modified-Since', formatdate(time.time()))])
+        self.assertEqual(status, 304)
+        status, headers, _ = self.request(app, '/subdir')
+        self.assertEqual(status, 301)
+        self.assertEqual(headers['location'], 'http://statictest/subdir/')
+        app.close()
+
+    def test_zerocopysend_is_used_when_offered(self):
+        app = static.asgi.AsyncCling('tests/data/withindex')
+        status, headers, messages = self.request(
+            app, '/static.html', [('Range', 'bytes=1-3')],
+            extensions={'http.response.zerocopysend': {}})
+        self.assertEqual(status, 206)
+        self.assertEqual(messages[0]['type'], 'http.response.zerocopysend')
+        self.assertEqual((messages[0]['offset'], messages[0]['count']),
+                         (1, 3))
+        app.close()
+
+    def test_shock_renders_magic(self):
+        app = static.asgi.AsyncShock(
+            'tests/data/templates',
+            (static.StringMagic(variables={'name': "Hamm"}),))
+        status, headers, messages = self.request(app, '/index.html')
+        self.assertEqual(b''.join(m['body'] for m in messages),
+                         b'Hello Hamm')
+        self.assertEqual(headers['content-type'], 'text/html')
+        app.close()
+
+
+class CompiledTemplateCacheTests(TemporaryTree):
+
+    def setUp(self):
+        super(CompiledTemplateCacheTests, self).setUp()
+        self.template_path = self.write(
+            'page.html.mst', b'{{#items}}{{.}} {{/items}}{{color}}')
+        self.write('plain.txt.stp', b'$name')
+        self.string_magic = static.StringMagic(variables={'name': 'Hamm'})
+        self.moustache_magic = static.MoustacheMagic(
+            variables={'color': 'blue', 'items': [1, 2]})
+
+    def get_app(self):
+        return static.Shock(self.root,
+                            (self.string_magic, self.moustache_magic))
+
+    def test_templates_are_compiled_once(self):
+        for i in range(3):
+            self.assert_response('GET', '/page.html', {}, 200, b'1 2 blue')
+            self.assert_response('GET', '/plain.txt', {}, 200, b'Hamm')
+        self.assertEqual(self.moustache_magic.templates.misses, 1)
+        self.assertEqual(self.moustache_magic.templates.hits, 2)
+        self.assertEqual(self.string_magic.templates.misses, 1)
+
+    def test_changed_templates_are_recompiled(self):
+        self.assert_response('GET', '/page.html', {}, 200, b'1 2 blue')
+        with open(self.template_path, 'wb') as fp:
+            fp.write(b'{{color}}!')
+        self.assert_response('GET', '/page.html', {}, 200, b'blue!')
+
+    def test_compiled_templates_substitute_like_string_template(self):
+        source = u'$$ $a ${b} $missing ${ bad $c.$a'
+        variables = {'a': 1, 'b': 'two', 'c': u'\xe9'}
+        self.assertEqual(
+            static.apps.CompiledTemplate(source).safe_substitute(variables),
+            string.Template(source).safe_substitute(variables))
+
+
+class ShockMagicResolutionTests(Intercepted):
+
+    def setUp(self):
+        self.magics = [static.StringMagic(extension='.s%d' % i)
+                       for i in range(30)]
+        self.magics.append(static.StringMagic(variables={'name': "Hamm"}))
+        self.magics.append(static.MoustacheMagic(variables={'color': "red"}))
+        self._app = static.Shock('tests/data/templates', self.magics,
+                                 metadata_cache_size=100)
+        super(ShockMagicResolutionTests, self).setUp()
+
+    def get_app(self):
+        return self._app
+
+    def test_magic_is_found_among_many(self):
+        self.assert_response('GET', '/index.html', {}, 200, b"Hello Hamm",
+                             response_headers={'Content-Type': 'text/html'})
+        self.assert_response('GET', '/foo.css', {}, 200,
+                             b"body { color: red; }")
+
+    def test_first_registered_magic_wins(self):
+        first = static.StringMagic(variables={'name': "first"})
+        second = static.StringMagic(variables={'name': "second"})
+        self._app.magics = [first, second]
+        self.assert_response('GET', '/index.html', {}, 200, b"Hello first")
+
+    def test_magics_with_custom_matching_are_scanned(self):
+        class Everything(static.StringMagic):
+            def matches(self, full_path):
+                return full_path.endswith('.stp')
+        self._app.magics = [Everything(variables={'name': "scan"})]
+        self.assert_response('GET', '/index.html', {}, 200, b"Hello scan")
+
+    def test_cached_paths_skip_magic_matching(self):
+        self.assert_response('GET', '/index.html', {}, 200, b"Hello Hamm")
+        calls = []
+        match_magic = self._app._match_magic
+        self._app._match_magic = lambda p: calls.append(p) or match_magic(p)
+        self.assert_response('GET', '/index.html', {}, 200, b"Hello Hamm")
+        self.assertEqual(calls, [])
+
+    def test_plain_files_are_served_with_prezipped_siblings(self):
+        self._app = static.Shock('tests/data/prezip', self.magics)
+        self.assert_response(
+            'GET', '/static.txt', {'Accept-Encoding': 'gzip'}, 200,
+            file_content='tests/data/prezip/static.txt.gz',
+            response_headers={'Content-Encoding': 'gzip'})
+
+
+class ShockWithManifest(Intercepted):
+
+    def get_app(self):
+        return static.Shock('tests/data/templates',
+                            [static.StringMagic(variables={'name': 'Hamm'})],
+                            manifest=True)
+
+    def test_magic_files_are_rendered(self):
+        self.assert_response('GET', '/index.html', {}, 200, b'Hello Hamm',
+                             response_headers={'Content-Type': 'text/html'})
+
+    def test_plain_and_missing_files(self):
+        self.assert_response('GET', '/static.txt', {}, 200,
+                             file_content='tests/data/templates/static.txt')
+        self.assert_response('GET', '/nothere.html', {}, 404)
+
+    def test_async_shock_builds_a_manifest_too(self):
+        app = static.asgi.AsyncShock('tests/data/templates',
+                                     [static.StringMagic()], manifest=True)
+        self.assertTrue(app.app.manifest)
+        app.close()
+
+
+class ShockRenderedCacheTests(TemporaryTree):
+
+    def setUp(self):
+        super(ShockRenderedCacheTests, self).setUp()
+        self.template_path = self.write(
+            'page.html.stp', b'$name $HTTP_ACCEPT_LANGUAGE $HTTP_USER_AGENT')
+        self.magic = static.StringMagic(
+            variables={'name': 'Hamm'},
+            environ_keys=['HTTP_ACCEPT_LANGUAGE'])
+        self._app = static.Shock(self.root, [self.magic])
+
+    def get(self, headers=None):
+        client = http_lib.HTTPConnection('statictest')
+        client.request('GET', '/page.html', headers=headers or {})
+        response = client.getresponse()
+        return response, response.read()
+
+    def test_repeats_are_served_from_the_rendered_cache(self):
+        for i in range(3):
+            response, body = self.get({'Accept-Language': 'en'})
+            self.assertEqual(body, b'Hamm en $HTTP_USER_AGENT')
+        self.assertEqual(response.getheader('Content-Length'),
+                         str(len(body)))
+        self.assertEqual(self._app.rendered_cache.misses, 1)
+        self.assertEqual(self._app.rendered_cache.hits, 2)
+
+    def test_matching_etag_gets_not_modified(self):
+        response, body = self.get({'Accept-Language': 'en'})
+        etag = response.getheader('ETag')
+        self.assertTrue(etag.startswith('"'))
+        self.assert_response(
+            'GET', '/page.html',
+            {'Accept-Language': 'en', 'If-None-Match': etag}, 304)
+        self.assert_response(
+            'GET', '/page.html',
+            {'Accept-Language': 'fr', 'If-None-Match': etag}, 200,
+            b'Hamm fr $HTTP_USER_AGENT')
+
+    def test_varies_on_the_request_headers_it_renders(self):
+        response, body = self.get({'Accept-Language': 'en'})
+        self.assertEqual(response.getheader('Vary'), 'Accept-Language')
+        self.assert_response(
+            'GET', '/page.html', {'Accept-Language': 'en',
+                                  'If-None-Match': response.getheader('ETag')},
+            304, response_headers={'Vary': 'Accept-Language'})
+
+    def test_modified_since_alone_is_not_enough(self):
+        response, body = self.get({'Accept-Language': 'en'})
+        self.assert_response(
+            'GET', '/page.html',
+            {'Accept-Language': 'fr',
+             'If-Modified-Since': response.getheader('Last-Modified')},
+            200, b'Hamm fr $HTTP_USER_AGENT')
+
+    def test_etag_follows_variables_and_template(self):
+        etag = self.get()[0].getheader('ETag')
+        self.magic.variables['name'] = 'Clov'
+        response, body = self.get()
+        self.assertNotEqual(response.getheader('ETag'), etag)
+        self.assertEqual(body, b'Clov $HTTP_ACCEPT_LANGUAGE $HTTP_USER_AGENT')
+        etag = response.getheader('ETag')
+        with open(self.template_path, 'wb') as fp:
+            fp.write(b'$name!')
+        response, body = self.get()
+        self.assertNotEqual(response.getheader('ETag'), etag)
+        self.assertEqual(body, b'Clov!')
+
+    def test_undeclared_magics_are_rendered_every_time(self):
+        self._app.magics = [static.StringMagic(variables={'name': 'Hamm'})]
+        response, body = self.get({'User-Agent': 'test'})
+        self.assertEqual(body, b'Hamm $HTTP_ACCEPT_LANGUAGE test')
+        self.assertEqual(len(self._app.rendered_cache), 0)
+
+
+class ShockStreamingTests(TemporaryTree):
+
+    def setUp(self):
+        super(ShockStreamingTests, self).setUp()
+        self.lines = [u'line %d $name \xe9 ${name}!\n' % i
+                      for i in range(500)]
+        self.write('big.txt.stp', u''.join(self.lines).encode('utf-8')
+                   + b'no newline $name')
+        self.write('big.css.mst',
+                   b'{{#on}}\n' + b'x' * 5000 + b'\n{{/on}}{{color}}')
+        self._app = static.Shock(
+            self.root, [static.StringMagic(variables={'name': 'Hamm'}),
+                        static.MoustacheMagic(variables={'color': 'red',
+                                                         'on': True})],
+            block_size=64, stream_threshold=1024)
+
+    def test_big_string_templates_stream_like_they_render(self):
+        expected = string.Template(
+            u''.join(self.lines) + u'no newline $name').safe_substitute(
+                name='Hamm').encode('utf-8')
+        self.assert_response('GET', '/big.txt', {}, 200, expected)
+
+    def test_streams_come_in_chunks(self):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/big.txt'}
+        body = self._app(environ, lambda status, headers: None)
+        chunks = list(body)
+        self.assertTrue(len(chunks) > 100)
+        self.assertTrue(all(chunk.endswith(b'\n') for chunk in chunks[:-1]))
+
+    def test_long_lines_are_cut_between_placeholders(self):
+        line = u''.join(u'\xe9 $$name ${name}$name%d-' % i
+                        for i in range(400))
+        with open(path.join(self.root, 'long.txt.stp'), 'wb') as fp:
+            fp.write(line.encode('utf-8'))
+        self._app.magics[0].max_carry = 100
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/long.txt'}
+        chunks = list(self._app(environ, lambda status, headers: None))
+        self.assertTrue(len(chunks) > 10)
+        self.assertTrue(max(len(chunk) for chunk in chunks) < 300)
+        expected = string.Template(line).safe_substitute(name='Hamm')
+        self.assertEqual(b''.join(chunks), expected.encode('utf-8'))
+
+    def test_moustache_templates_are_not_streamed(self):
+        self.assert_response('GET', '/big.css', {}, 200,
+                             b'x' * 5000 + b'\nred')
+
+
+class RecordingInstrument(static.Instrument):
+
+    def __init__(self):
+        self.events = []
+        self.responses = []
+
+    def timing(self, event, seconds):
+        self.events.append(event)
+
+    def response(self, environ, status, bytes_sent, seconds):
+        self.responses.append((environ['PATH_INFO'], status, bytes_sent))
+
+
+class StaticClingWithMetrics(Intercepted):
+
+    def setUp(self):
+        self._app = static.Cling('tests/data/withindex',
+                                 metrics_path='/_metrics')
+        super(StaticClingWithMetrics, self).setUp()
+
+    def get_app(self):
+        return self._app
+
+    def metrics(self):
+        client = http_lib.HTTPConnection('statictest')
+        client.request('GET', '/_metrics')
+        response = client.getresponse()
+        self.assertEqual(response.status, 200)
+        return response.read().decode('utf-8').splitlines()
+
+    def test_responses_are_counted_by_status(self):
+        size = stat('tests/data/withindex/static.html').st_size
+        self.assert_response('GET', '/static.html', {}, 200)
+        self.assert_response('GET', '/static.html',
+                             {'If-Modified-Since': formatdate(time.time())},
+                             304)
+        client = http_lib.HTTPConnection('statictest')
+        client.request('GET', '/nothere.html')
+        not_found = client.getresponse().read()
+        lines = self.metrics()
+        self.assertTrue('static_requests_total{status="200"} 1' in lines)
+        self.assertTrue('static_requests_total{status="304"} 1' in lines)
+        self.assertTrue('static_requests_total{status="404"} 1' in lines)
+        self.assertTrue('static_bytes_sent_total %d'
+                        % (size + len(not_found)) in lines)
+        self.assertTrue('static_not_modified_ratio %r' % (1 / 3.0) in lines)
+        self.assertTrue('static_response_seconds_count 3' in lines)
+        self.assertTrue('static_cache_hits_total{cache="metadata"} 0'
+                        in lines)
+
+    def test_operations_get_histograms(self):
+        self.assert_response('GET', '/static.html', {}, 200)
+        lines = self.metrics()
+        for event in ('resolve', 'stat', 'open'):
+            self.assertTrue([line for line in lines if line.startswith(
+                'static_operation_seconds_count{event="%s"}' % event)])
+        self.assertTrue('static_operation_seconds_bucket{event="open",'
+                        'le="+Inf"} 1' in lines)
+
+    def test_uninstrumented_apps_are_left_alone(self):
+        app = static.Cling('tests/data/withindex')
+        self.assertEqual(app.instrument, None)
+        self.assertFalse('_full_path' in vars(app))
+
+
+class FileBodyInstrumentTests(TestCase):
+
+    def setUp(self):
+        self.instrument = RecordingInstrument()
+        self.app = static.Cling('tests/data/withindex',
+                                instrument=self.instrument)
+        self.size = stat('tests/data/withindex/static.html').st_size
+
+    def test_server_file_wrapper_is_kept_and_reported_on_close(self):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/static.html',
+                   'wsgi.file_wrapper': wsgiref.util.FileWrapper}
+        body = self.app(environ, lambda status, headers: None)
+        self.assertTrue(isinstance(body, wsgiref.util.FileWrapper))
+        self.assertEqual(self.instrument.responses, [])
+        # What socket.sendfile() leaves behind.
+        body.filelike.seek(self.size)
+        body.close()
+        body.close()
+        self.assertEqual(self.instrument.responses,
+                         [('/static.html', '200 OK', self.size)])
+
+    def test_bytes_are_those_read_before_close(self):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/static.html',
+                   'HTTP_RANGE': 'bytes=2-'}
+        body = self.app(environ, lambda status, headers: None)
+        self.assertTrue(hasattr(body, 'fileno'))
+        self.assertEqual(self.instrument.responses, [])
+        body.file_like.read(3)
+        body.close()
+        self.assertEqual(self.instrument.responses,
+                         [('/static.html', '206 Partial Content', 3)])
+
+    def test_sendfile_through_the_server(self):
+        server = static.server.PooledServer(
+            static.server.listen('127.0.0.1', 0), self.app, threads=1)
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.start()
+        try:
+            client = http_lib.HTTPConnection('127.0.0.1', server.server_port)
+            client.request('GET', '/static.html')
+            self.assertEqual(len(client.getresponse().read()), self.size)
+            client.close()
+        finally:
+            server.stop()
+            thread.join()
+            server.server_close()
+        self.assertEqual(self.instrument.responses,
+                         [('/static.html', '200 OK', self.size)])
+
+
+class ShockInstrumentTests(Intercepted):
+
+    def setUp(self):
+        self.instrument = RecordingInstrument()
+        self._app = static.Shock(
+            'tests/data/templates',
+            [static.StringMagic(variables={'name': "Hamm"})],
+            instrument=self.instrument, stream_threshold=0)
+        super(ShockInstrumentTests, self).setUp()
+
+    def get_app(self):
+        return self._app
+
+    def test_streamed_renders_are_metered(self):
+        self.assert_response('GET', '/index.html', {}, 200, b"Hello Hamm")
+        self.assertTrue('body' in self.instrument.events)
+        self.assertEqual(self.instrument.responses,
+                         [('/index.html', '200 OK', len(b"Hello Hamm"))])
+
+    def test_renders_are_timed(self):
+        self._app.stream_threshold = 1024
+        self.assert_response('GET', '/index.html', {}, 200, b"Hello Hamm")
+        self.assertTrue('render' in self.instrument.events)
+
+
+class PooledServerTests(TestCase):
+
+    def setUp(self):
+        self.server = static.server.PooledServer(
+            static.server.listen('127.0.0.1', 0),
+            static.Cling('tests/data/withindex'), threads=2)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.start()
+        self.port = self.server.server_port
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join()
+        self.server.server_close()
+
+    def test_connections_are_kept_alive(self):
+        client = http_lib.HTTPConnection('127.0.0.1', self.port)
+        client.request('GET', '/static.html')
+        response = client.getresponse()
+        with open('tests/data/withindex/static.html', 'rb') as fp:
+            self.assertEqual(response.read(), fp.read())
+        self.assertEqual(response.version, 11)
+        sock = client.sock
+        client.request('GET', '/')
+        response = client.getresponse()
+        self.assertEqual(response.status, 200)
+        response.read()
+        self.assertTrue(client.sock is sock)
+        client.close()
+
+    def test_http_10_closes_unless_asked(self):
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        sock.sendall(b'GET /static.html HTTP/1.0\r\n\r\n')
+        data = b''
+        for block in iter(lambda: sock.recv(4096), b''):
+            data += block
+        sock.close()
+        self.assertTrue(b'Connection: close' in data)
+
+    def test_idle_connections_do_not_hold_threads(self):
+        idle = []
+        for i in range(2):
+            client = http_lib.HTTPConnection('127.0.0.1', self.port)
+            client.request('GET', '/static.html')
+            client.getresponse().read()
+            idle.append(client)
+        client = http_lib.HTTPConnection('127.0.0.1', self.port, timeout=2)
+        client.request('GET', '/static.html')
+        self.assertEqual(client.getresponse().status, 200)
+        for client in idle + [client]:
+            client.close()
+
+    def test_idle_connections_are_closed(self):
+        self.server.keep_alive = 0.1
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        sock.settimeout(2)
+        self.assertEqual(sock.recv(4096), b'')
+        sock.close()
+
+
+class PreforkServerTests(TestCase):
+
+    def serve(self, directory, request_path, headers, *options):
+        """Run the CLI on directory and return its response to a GET."""
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        server = subprocess.Popen(
+            [sys.executable, '-c', 'import static.cli; static.cli.run()',
+             '127.0.0.1', str(port), directory,
+             '--workers', '2', '--threads', '2'] + list(options))
+        try:
+            deadline = time.time() + 10
+            while True:
+                try:
+                    client = http_lib.HTTPConnection('127.0.0.1', port)
+                    client.request('GET', request_path, headers=headers)
+                    break
+                except (IOError, OSError):
+                    if time.time() > deadline:
+                        raise
+                    time.sleep(0.05)
+            response = client.getresponse()
+            response.read()
+            client.close()
+            return response
+        finally:
+            server.send_signal(signal.SIGTERM)
+            self.assertEqual(server.wait(10), 0)
+
+    def test_workers_serve_and_stop_gracefully(self):
+        response = self.serve('tests/data/withindex', '/static.html', {})
+        self.assertEqual(response.status, 200)
+
+    def test_precompressed_siblings_are_served(self):
+        root = tempfile.mkdtemp()
+        try:
+            with open(path.join(root, 'app.css'), 'wb') as fp:
+                fp.write(b'body { color: blue; }\n' * 100)
+            with open(path.join(root, 'app.css.br'), 'wb') as fp:
+                fp.write(b'brotli bytes')
+            response = self.serve(root, '/app.css',
+                                  {'Accept-Encoding': 'gzip, br'},
+                                  '--precompressed', 'br,gzip')
+        finally:
+            shutil.rmtree(root)
+        self.assertEqual(response.getheader('Content-Encoding'), 'br')
+        self.assertEqual(response.getheader('Content-Length'), '12')
+
+
+class ArchiveClingTests(TemporaryTree):
+
+    def setUp(self):
+        super(ArchiveClingTests, self).setUp()
+        self.archive = path.join(self.root, 'site.zip')
+        self.stored = b'0123456789' * 10000
+        self.deflated = b'body { color: blue; }\n' * 100
+        with zipfile.ZipFile(self.archive, 'w') as archive:
+            archive.writestr('site/data.bin', self.stored,
+                             zipfile.ZIP_STORED)
+            archive.writestr('site/css/style.css', self.deflated,
+                             zipfile.ZIP_DEFLATED)
+            archive.writestr('site/index.html', b'<p>home</p>',
+                             zipfile.ZIP_STORED)
+            archive.writestr('other.txt', b'outside the prefix')
+        self._app = static.archive.ArchiveCling(self.archive, prefix='site')
+
+    def tearDown(self):
+        self._app.archive_map.close()
+        super(ArchiveClingTests, self).tearDown()
+
+    def test_stored_entries_are_served(self):
+        self.assert_response('GET', '/data.bin', {}, 200, self.stored,
+                             response_headers={
+                                 'Content-Length': str(len(self.stored))})
+        self.assert_response('GET', '/', {}, 200, b'<p>home</p>',
+                             response_headers={'Content-Type': 'text/html'})
+
+    def test_stored_entries_serve_ranges(self):
+        self.assert_response('GET', '/data.bin', {'Range': 'bytes=5-14'},
+                             206, self.stored[5:15])
+
+    def test_deflated_entries_pass_through_as_gzip(self):
+        client = http_lib.HTTPConnection('statictest')
+        client.request('GET', '/css/style.css',
+                       headers={'Accept-Encoding': 'gzip'})
+        response = client.getresponse()
+        self.assertEqual(response.getheader('Content-Encoding'), 'gzip')
+        self.assertEqual(response.getheader('Vary'), 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(response.read()), self.deflated)
+
+    def test_deflated_entries_are_inflated_for_other_clients(self):
+        self.assert_response('GET', '/css/style.css', {}, 200, self.deflated,
+                             response_headers={'Content-Type': 'text/css'})
+
+    def test_etags_come_from_crc(self):
+        crc = zipfile.ZipFile(self.archive).getinfo('site/data.bin').CRC
+        etag = '"%08x-%x"' % (crc, len(self.stored))
+        self.assert_response('GET', '/data.bin', {}, 200,
+                             response_headers={'ETag': etag})
+        self.assert_response('GET', '/data.bin', {'If-None-Match': etag}, 304)
+
+    def test_paths_outside_the_prefix_are_not_found(self):
+        self.assert_response('GET', '/other.txt', {}, 404)
+        self.assert_response('GET', '/../other.txt', {}, 404)
+
+    def test_directories_get_redirected(self):
+        self.assert_response('GET', '/css', {}, 301)
+
+    def test_zipped_packages_are_served_from_the_archive(self):
+        archive = path.join(self.root, 'zippedpkg.zip')
+        with zipfile.ZipFile(archive, 'w') as zipped:
+            zipped.writestr('zippedpkg/__init__.py', b'')
+            zipped.writestr('zippedpkg/static/hello.txt', b'hello')
+        sys.path.insert(0, archive)
+        try:
+            app = static.archive.package_cling('zippedpkg', 'static')
+        finally:
+            sys.path.remove(archive)
+            sys.modules.pop('zippedpkg', None)
+        self.assertTrue(isinstance(app, static.archive.ArchiveCling))
+        self._app.archive_map.close()
+        self._app = app
+        self.assert_response('GET', '/hello.txt', {}, 200, b'hello')
+
+
+class StaticClingWithNegativeCache(TemporaryTree):
+
+    def setUp(self):
+        super(StaticClingWithNegativeCache, self).setUp()
+        self.write('here.txt', b'here')
+        self._app = static.Cling(self.root, negative_cache_size=3,
+                                 negative_ttl=60)
+        self.stats = []
+        self.real_stat = static.apps.stat
+        static.apps.stat = lambda p: self.stats.append(p) or self.real_stat(p)
+
+    def tearDown(self):
+        static.apps.stat = self.real_stat
+        super(StaticClingWithNegativeCache, self).tearDown()
+
+    def test_repeat_misses_skip_stat(self):
+        self.assert_response('GET', '/missing.txt', {}, 404)
+        del self.stats[:]
+        for i in range(3):
+            self.assert_response('GET', '/missing.txt', {}, 404)
+        self.assertEqual(self.stats, [])
+        self.assert_response('GET', '/here.txt', {}, 200, b'here')
+
+    def test_misses_are_rechecked_when_the_directory_changes(self):
+        self._app.negative_ttl = 0
+        self.assert_response('GET', '/missing.txt', {}, 404)
+        del self.stats[:]
+        self.assert_response('GET', '/missing.txt', {}, 404)
+        self.assertEqual(self.stats, [self.root])
+        with open(path.join(self.root, 'missing.txt'), 'wb') as fp:
+            fp.write(b'new')
+        os.utime(self.root, (0, 0))
+        self.assert_response('GET', '/missing.txt', {}, 200, b'new')
+
+    def test_cache_is_bounded(self):
+        for i in range(10):
+            self.assert_response('GET', '/scan%d.php' % i, {}, 404)
+        self.assertEqual(len(self._app.missing_cache), 3)
+        self.assertTrue(self._app.root + '/scan9.php'
+                        in self._app.missing_cache)
+
+
+class StaticClingWithAutoindex(TemporaryTree):
+
+    def setUp(self):
+        super(StaticClingWithAutoindex, self).setUp()
+        os.mkdir(path.join(self.root, 'sub'))
+        os.mkdir(path.join(self.root, 'withindex'))
+        for name in ('b.txt', 'a&b.txt', '.hidden', 'withindex/index.html'):
+            self.write(name, b'12345')
+        self._app = static.Cling(self.root, autoindex=True,
+                                 autoindex_page_size=2)
+        self.scans = []
+        self.real_scan = static.autoindex.scan
+        static.autoindex.scan = lambda d: (self.scans.append(d)
+                                           or self.real_scan(d))
+
+    def tearDown(self):
+        static.autoindex.scan = self.real_scan
+        super(StaticClingWithAutoindex, self).tearDown()
+
+    def get_json(self, path_info, page=1):
+        body = self._app({'REQUEST_METHOD': 'GET', 'PATH_INFO': path_info,
+                          'QUERY_STRING': 'format=json&page=%d' % page},
+                         lambda status, headers: None)
+        return json.loads(b''.join(body).decode('utf-8'))
+
+    def get_html(self, query=''):
+        return b''.join(self._app(
+            {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/',
+             'QUERY_STRING': query},
+            lambda status, headers: None)).decode('utf-8')
+
+    def test_html_listing(self):
+        body = self.get_html()
+        self.assertTrue('Index of /' in body)
+        self.assertTrue('<a href="sub/">sub/</a>' in body)
+        self.assertTrue('href="?page=2"' in body)
+        body = self.get_html('page=2')
+        self.assertTrue('<a href="a%26b.txt">a&amp;b.txt</a>' in body)
+        self.assertTrue('href="?page=1"' in body)
+        self.assertFalse('hidden' in body)
+
+    def test_json_pages(self):
+        first = self.get_json('/')
+        self.assertEqual((first['total'], first['pages']), (4, 2))
+        self.assertEqual([(e['name'], e['type'], e['size'])
+                          for e in first['entries']],
+                         [('sub', 'directory', None),
+                          ('withindex', 'directory', None)])
+        second = self.get_json('/', 2)
+        self.assertEqual([(e['name'], e['size']) for e in second['entries']],
+                         [('a&b.txt', 5), ('b.txt', 5)])
+        self.assert_response('GET', '/?page=3', {}, 404)
+
+    def test_index_file_wins(self):
+        self.assert_response('GET', '/withindex/', {}, 200, b'12345')
+
+    def test_listing_is_cached_until_the_directory_changes(self):
+        self.assert_response('GET', '/sub/', {}, 200, response_headers={
+            'Content-Type': 'text/html; charset=utf-8', 'Vary': 'Accept'})
+        self.assert_response('GET', '/sub/', {}, 200)
+        self.assertEqual(self.scans, [self.root + '/sub/'])
+        with open(path.join(self.root, 'sub', 'new.txt'), 'wb') as fp:
+            fp.write(b'new')
+        os.utime(path.join(self.root, 'sub'), (0, 0))
+        self.assertEqual(self.get_json('/sub/')['entries'][0]['name'],
+                         'new.txt')
+        self.assertEqual(len(self.scans), 2)
+
+    def test_listing_not_modified(self):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/sub/',
+                   'HTTP_ACCEPT': 'application/json'}
+        statuses = []
+        self._app(environ, lambda status, headers: statuses.append(
+            (status, dict(headers))))
+        environ['HTTP_IF_NONE_MATCH'] = statuses[0][1]['ETag']
+        self._app(environ, lambda status, headers: statuses.append(
+            (status, dict(headers))))
+        self.assertEqual(statuses[0][1]['Content-Type'], 'application/json')
+        self.assertEqual(statuses[1][0], '304 Not Modified')
+
+    def test_off_by_default(self):
+        self._app.autoindex = False
+        self.assert_response('GET', '/sub/', {}, 404)
+
+
+class SharedCacheTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.name = path.join(self.directory, 'cache')
+        self.cache = static.shared.SharedCache(self.name, 8 * 1024,
+                                               block_size=1024, ways=4)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.directory)
+
+    def test_get_set_pop(self):
+        self.cache.set(('/a', 1.5, 3), ((1.5, 3, 7), b'abc'), 3)
+        self.assertEqual(self.cache.get(('/a', 1.5, 3)), ((1.5, 3, 7), b'abc'))
+        self.assertEqual(self.cache.get('/b'), None)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.cache.set('none', None)
+        self.assertEqual(self.cache.get('none', 'default'), None)
+        self.assertEqual(self.cache.pop(('/a', 1.5, 3)), ((1.5, 3, 7), b'abc'))
+        self.assertFalse(('/a', 1.5, 3) in self.cache)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_evicts_least_recently_used(self):
+        for i in range(7):
+            self.cache.set(i, b'x' * 1000)
+        time.sleep(0.001)
+        self.cache.get(0)
+        self.cache.set('big', b'y' * 2500)
+        self.assertTrue(0 in self.cache)
+        self.assertFalse(1 in self.cache)
+        self.assertEqual(self.cache.get('big'), b'y' * 2500)
+        self.assertTrue(self.cache.bytes <= self.cache.max_bytes)
+        self.cache.set('huge', b'z' * 9000)
+        self.assertFalse('huge' in self.cache)
+
+    def test_lookup_misses_a_slot_reused_while_reading(self):
+        self.cache.set('a', b'first')
+        cache = self.cache
+        first = cache._set_offset(cache._digest('a'))
+        other = next(key for key in range(1000)
+                     if cache._set_offset(cache._digest(key)) == first)
+        find = cache._find
+
+        def find_then_reuse(digest, first):
+            found = find(digest, first)
+            cache._find = find
+            cache.pop('a')
+            cache.set(other, b'other')
+            return found
+        cache._find = find_then_reuse
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get(other), b'other')
+
+    def test_shared_between_processes(self):
+        other = static.shared.SharedCache(self.name, 8 * 1024,
+                                          block_size=1024, ways=4)
+        pid = os.fork()
+        if pid == 0:
+            other.set('/from/child', b'hello')
+            os._exit(0)
+        os.waitpid(pid, 0)
+        other.close()
+        self.assertEqual(self.cache.get('/from/child'), b'hello')
+        self.assertRaises(ValueError, static.shared.SharedCache, self.name,
+                          16 * 1024, block_size=1024, ways=4)
+
+    def test_refuses_files_others_can_open(self):
+        name = path.join(self.directory, 'open')
+        with open(name, 'wb'):
+            pass
+        os.chmod(name, 0o644)
+        self.assertRaises(ValueError, static.shared.SharedCache, name,
+                          8 * 1024)
+        os.symlink(self.name, path.join(self.directory, 'link'))
+        self.assertRaises(OSError, static.shared.SharedCache,
+                          path.join(self.directory, 'link'), 8 * 1024,
+                          block_size=1024, ways=4)
+
+    def test_anonymous_cache_is_shared_with_children(self):
+        cache = static.shared.SharedCache(None, 8 * 1024, block_size=1024)
+        self.assertEqual(cache.path, None)
+        pid = os.fork()
+        if pid == 0:
+            cache.set('/from/child', b'hello')
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(cache.get('/from/child'), b'hello')
+        cache.unlink()
+        cache.close()
+
+    def test_cling_content_cache(self):
+        app = static.Cling('tests/data/withindex', content_cache=self.cache)
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/static.html'}
+        first = b''.join(app(environ, lambda status, headers: None))
+        second = b''.join(app(environ, lambda status, headers: None))
+        self.assertEqual(first, second)
+        self.assertEqual(self.cache.hits, 1)
+
+
+class ImportTests(TestCase):
+
+    def test_cling_needs_only_the_standard_library(self):
+        loaded = subprocess.check_output(
+            [sys.executable, '-c',
+             'import sys, static; print(static.__version__.strip()); '
+             'print(" ".join(sorted(set(m.split(".")[0] '
+             'for m in sys.modules))))'],
+            universal_newlines=True).split('\n')
+        with open('static/VERSION') as fp:
+            self.assertEqual(loaded[0], fp.read().strip())
+        modules = loaded[1].split()
+        for heavy in ('pkg_resources', 'pystache', 'brotli', 'zstandard'):
+            self.assertFalse(heavy in modules)
+
+    def test_pystache_loaded_by_moustache_magic(self):
+        magic = static.MoustacheMagic()
+        self.assertEqual(magic.renderer.render(magic.compile('{{a}}'),
+                                               {'a': 'b'}), 'b')
+
+
+class AccessLogTests(TestCase):
+
+    entry = (0.0, '10.0.0.1', None, 'GET', '/a "b"', 'x=1', 'HTTP/1.1',
+             None, 'curl/8', '200', 1234, 0.0025)
+
+    def request(self, app, path_info, **environ):
+        environ.update({'REQUEST_METHOD': 'GET', 'PATH_INFO': path_info,
+                        'REMOTE_ADDR': '127.0.0.1',
+                        'SERVER_PROTOCOL': 'HTTP/1.1'})
+        body = app(environ, lambda status, headers: None)
+        data = b''.join(body)
+        if hasattr(body, 'close'):
+            body.close()
+        return data
+
+    def test_formats(self):
+        common = static.access.format_entry(self.entry, 'common')
+        self.assertTrue(common.startswith('10.0.0.1 - - ['))
+        self.assertTrue(common.endswith(
+            '] "GET /a \\"b\\"?x=1 HTTP/1.1" 200 1234'))
+        combined = static.access.format_entry(self.entry, 'combined',
+                                              timing=True)
+        self.assertTrue(combined.endswith(' 200 1234 "-" "curl/8" 2500'))
+        logged = json.loads(static.access.format_entry(self.entry, 'json'))
+        self.assertEqual((logged['path'], logged['status'],
+                          logged['bytes_sent'], logged['seconds']),
+                         ('/a "b"', 200, 1234, 0.0025))
+
+    def test_logs_every_response_in_the_background(self):
+        output = io.StringIO()
+        log = static.AccessLog(output, 'json')
+        app = static.Cling('tests/data/withindex', access_log=log,
+                           metrics_path='/metrics')
+        self.request(app, '/static.html')
+        self.request(app, '/missing', HTTP_USER_AGENT='test')
+        metrics = self.request(app, '/metrics')
+        log.close()
+        lines = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([(line['path'], line['status']) for line in lines],
+                         [('/static.html', 200), ('/missing', 404)])
+        with open('tests/data/withindex/static.html', 'rb') as fp:
+            self.assertEqual(lines[0]['bytes_sent'], len(fp.read()))
+        self.assertEqual(lines[1]['user_agent'], 'test')
+        self.assertTrue(b'static_requests_total{status="404"} 1' in metrics)
+
+    def test_drops_when_full(self):
+        log = static.AccessLog(io.StringIO(), max_queue=2)
+        log._pid = os.getpid()
+        app = static.Cling('tests/data/withindex', access_log=log)
+        for i in range(3):
+            self.request(app, '/static.html')
+        self.assertEqual(log.dropped, 1)
+        self.assertEqual(app._load_info.__name__, '_load_info')
+
+    def test_writes_to_a_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            log_path = path.join(directory, 'access.log')
+            log = static.AccessLog(log_path, 'common')
+            app = static.Cling('tests/data/withindex', access_log=log)
+            self.request(app, '/static.html')
+            log.close()
+            with open(log_path) as fp:
+                self.assertTrue(' "GET /static.html HTTP/1.1" 200 '
+                                in fp.read())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_stderr_logger_is_set_up_once(self):
+        for i in range(3):
+            static.Cling('tests/data/withindex', log_name='static-once')
+        self.assertEqual(len(logging.getLogger('static-once').handlers), 1)
+
+
+class SingleFlightTests(TestCase):
+
+    def run_concurrently(self, function, count=5):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(function()))
+                   for i in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def test_concurrent_calls_share_one_result(self):
+        flights = static.cache.SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            release.wait(5)
+            return len(calls)
+        threads, results = self.run_concurrently(
+            lambda: flights.call('key', slow))
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, [1] * 5)
+        self.assertEqual(flights.coalesced, 4)
+        self.assertEqual(flights.call('key', lambda: 'again'), 'again')
+
+    def test_waiters_give_up_after_the_timeout(self):
+        flights = static.cache.SingleFlight(timeout=0.05)
+        stuck = threading.Event()
+        leader = threading.Thread(
+            target=lambda: flights.call('key', stuck.wait, 5))
+        leader.start()
+        time.sleep(0.02)
+        try:
+            self.assertEqual(flights.call('key', lambda: 'own'), 'own')
+        finally:
+            stuck.set()
+            leader.join()
+
+    def test_waiters_retry_when_the_leader_fails(self):
+        flights = static.cache.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        errors = []
+
+        def failing():
+            started.set()
+            release.wait(5)
+            raise IOError('boom')
+
+        def lead():
+            try:
+                flights.call('key', failing)
+            except IOError as error:
+                errors.append(error)
+        leader = threading.Thread(target=lead)
+        leader.start()
+        started.wait(5)
+        threads, results = self.run_concurrently(
+            lambda: flights.call('key', lambda: 'retried'), 1)
+        time.sleep(0.02)
+        release.set()
+        leader.join()
+        threads[0].join()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(results, ['retried'])
+
+
+class ShockCoalescingTests(TestCase):
+
+    def test_concurrent_misses_render_once(self):
+        root = tempfile.mkdtemp()
+        try:
+            with open(path.join(root, 'page.html.stp'), 'wb') as fp:
+                fp.write(b'$name')
+            app = static.Shock(root, [static.StringMagic(
+                variables={'name': 'Hamm'}, environ_keys=[])])
+            render = app._render
+            renders = []
+
+            def slow_render(*args):
+                renders.append(1)
+                time.sleep(0.1)
+                return render(*args)
+            app._render = slow_render
+            bodies = []
+
+            def get():
+                bodies.append(b''.join(app(
+                    {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/page.html'},
+                    lambda status, headers: None)))
+            threads = [threading.Thread(target=get) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(bodies, [b'Hamm'] * 4)
+            self.assertEqual(len(renders), 1)
+            self.assertEqual(app.flights.coalesced, 3)
+        finally:
+            shutil.rmtree(root)
+
+
+class StaticClingWithImageVariants(TemporaryTree):
+
+    chrome = 'image/avif,image/webp,image/apng,image/*,*/*;q=0.8'
+
+    def setUp(self):
+        super(StaticClingWithImageVariants, self).setUp()
+        for name, size in (('photo.jpg', 1000), ('photo.jpg.webp', 500),
+                           ('photo.jpg.avif', 300), ('plain.png', 100),
+                           ('big.png', 100), ('big.png.webp', 200)):
+            self.write(name, name.encode('ascii') * (size // len(name) + 1))
+        self._app = static.Cling(self.root, metadata_cache_size=10,
+                                 metadata_ttl=None,
+                                 image_variants=('image/avif', 'image/webp'))
+        self.stats = []
+        self.real_stat = static.apps.stat
+        static.apps.stat = lambda p: self.stats.append(p) or self.real_stat(p)
+
+    def tearDown(self):
+        static.apps.stat = self.real_stat
+        super(StaticClingWithImageVariants, self).tearDown()
+
+    def get(self, path_info, accept):
+        client = http_lib.HTTPConnection('statictest')
+        client.request('GET', path_info, headers={'Accept': accept})
+        response = client.getresponse()
+        return response, response.read()
+
+    def test_smallest_accepted_variant_is_served(self):
+        response, body = self.get('/photo.jpg', self.chrome)
+        self.assertTrue(body.startswith(b'photo.jpg.avif'))
+        self.assertEqual(response.getheader('Content-Type'), 'image/avif')
+        self.assertEqual(response.getheader('Vary'), 'Accept')
+        self.assertTrue(response.getheader('ETag').strip('"')
+                        .endswith('-avif'))
+        response, body = self.get('/photo.jpg', 'image/webp,*/*')
+        self.assertTrue(body.startswith(b'photo.jpg.webp'))
+        self.assertEqual(response.getheader('Content-Type'), 'image/webp')
+
+    def test_wildcards_get_the_original(self):
+        response, body = self.get('/photo.jpg', 'image/*,*/*;q=0.8')
+        self.assertTrue(body.startswith(b'photo.jpgphoto.jpg'))
+        self.assertEqual(response.getheader('Content-Type'), 'image/jpeg')
+        self.assertEqual(response.getheader('Vary'), 'Accept')
+
+    def test_bigger_variants_and_images_without_any(self):
+        response, body = self.get('/big.png', self.chrome)
+        self.assertEqual(response.getheader('Content-Type'), 'image/png')
+        self.assertEqual(response.getheader('Vary'), 'Accept')
+        response, body = self.get('/plain.png', self.chrome)
+        self.assertEqual(response.getheader('Vary'), None)
+
+    def test_availability_is_cached(self):
+        for accept in (self.chrome, 'image/webp', '*/*'):
+            self.get('/photo.jpg', accept)
+        del self.stats[:]
+        for accept in (self.chrome, 'image/webp', '*/*'):
+            self.get('/photo.jpg', accept)
+        self.assertEqual(self.stats, [])
+
+    def test_availability_is_cached_without_metadata_cache(self):
+        self.write('photo.jpg.webp.gz', b'gzipped webp')
+        self._app = static.Cling(self.root, metadata_ttl=None,
+                                 image_variants=('image/avif', 'image/webp'))
+        for accept in (self.chrome, 'image/webp', '*/*'):
+            self.get('/photo.jpg', accept)
+        del self.stats[:]
+        self.get('/photo.jpg', 'image/webp')
+        self.assertEqual(self.stats, [os.path.join(self.root, 'photo.jpg')])
+
+    def test_sibling_cache_is_checked_against_the_original(self):
+        self._app = static.Cling(self.root, metadata_ttl=None,
+                                 image_variants=('image/avif', 'image/webp'))
+        response, body = self.get('/big.png', self.chrome)
+        self.assertEqual(response.getheader('Content-Type'), 'image/png')
+        self.write('big.png', b'big.png' * 100)
+        self.write('big.png.avif', b'avif')
+        response, body = self.get('/big.png', self.chrome)
+        self.assertEqual(response.getheader('Content-Type'), 'image/avif')
+
+
+class TraversalWithCachesTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.root = path.join(self.directory, 'root')
+        os.mkdir(self.root)
+        with open(path.join(self.directory, 'secret.txt'), 'wb') as fp:
+            fp.write(b'SECRET')
+        with open(path.join(self.directory, 'secret.txt.stp'), 'wb') as fp:
+            fp.write(b'SECRET $name')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get(self, app, path_info):
+        statuses = []
+        body = b''.join(app({'REQUEST_METHOD': 'GET',
+                             'PATH_INFO': path_info},
+                            lambda status, headers: statuses.append(status)))
+        return statuses[0], body
+
+    def test_no_escape_with_caches_on(self):
+        kw = dict(metadata_cache_size=100, negative_cache_size=100)
+        for app in (static.Cling(self.root, **kw),
+                    static.Shock(self.root, [static.StringMagic()], **kw),
+                    static.Shock(self.root + '/', [static.StringMagic()],
+                                 **kw)):
+            for i in range(3):
+                for path_info in ('/../secret.txt', '/../root/../secret.txt',
+                                  '/..', '../secret.txt'):
+                    status, body = self.get(app, path_info)
+                    self.assertEqual(status, '404 Not Found')
+                    self.assertFalse(b'SECRET' in body)
+
+
+class FileWrapperTruncationTests(TestCase):
+
+    def test_file_truncated_while_served(self):
+        directory = tempfile.mkdtemp()
+        try:
+            file_path = path.join(directory, 'big.bin')
+            with open(file_path, 'wb') as fp:
+                fp.write(b'x' * 4096 * 8)
+            blocks = iter(static.FileWrapper(open(file_path, 'rb'), 4096))
+            self.assertEqual(len(next(blocks)), 4096)
+            with open(file_path, 'r+b') as fp:
+                fp.truncate(4096 * 2)
+            self.assertEqual(sum(len(block) for block in blocks), 4096)
+        finally:
+            shutil.rmtree(directory)
+
+
+class PooledServerBodyTests(TestCase):
+
+    def setUp(self):
+        self.server = static.server.PooledServer(
+            static.server.listen('127.0.0.1', 0),
+            static.Cling('tests/data/withindex'), threads=2, keep_alive=2)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join()
+        self.server.server_close()
+
+    def exchange(self, data):
+        sock = socket.create_connection(('127.0.0.1',
+                                         self.server.server_port))
+        sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+        received = b''
+        for block in iter(lambda: sock.recv(4096), b''):
+            received += block
+        sock.close()
+        return received
+
+    def test_unread_body_is_not_a_request(self):
+        smuggled = b'GET /static.html HTTP/1.1\r\nHost: x\r\n\r\n'
+        received = self.exchange(
+            b'POST /static.html HTTP/1.1\r\nHost: x\r\n'
+            b'Content-Length: %d\r\n\r\n%s'
+            b'GET /index.html HTTP/1.1\r\nHost: x\r\n'
+            b'Connection: close\r\n\r\n' % (len(smuggled), smuggled))
+        self.assertEqual(received.count(b'HTTP/1.1 '), 2)
+        self.assertEqual(received[:12], b"HTTP/1.1 405")
+        with open('tests/data/withindex/index.html', 'rb') as fp:
+            self.assertTrue(received.endswith(fp.read()))
+
+    def test_chunked_bodies_close_the_connection(self):
+        received = self.exchange(
+            b'POST /static.html HTTP/1.1\r\nHost: x\r\n'
+            b'Transfer-Encoding: chunked\r\n\r\n'
+            b'26\r\nGET /static.html HTTP/1.1\r\nHost: x\r\n\r\n\r\n0\r\n\r\n')
+        self.assertEqual(received.count(b'HTTP/1.1 '), 1)
+        self.assertTrue(b'Connection: close' in received)